@@ -1,21 +1,39 @@
-from email import message_from_string
+import argparse
+from email.utils import formatdate
+import importlib
+from itertools import chain, repeat
 import json
 import logging
+import math
+import os
 import random
-from StringIO import StringIO
-from threading import Thread
+import signal
+import socket
+import tempfile
+from threading import Event, Thread
 import time
 import urlparse
 
-from flask import Flask, request, Response, g
-from httpbin.helpers import get_dict, status_code
-from twisted.internet import protocol, reactor
-from twisted.web.server import Site
-from twisted.web.wsgi import WSGIResource
-from werkzeug.routing import Rule
-from werkzeug.http import parse_accept_header
-
-from .morse import morsedict
+from twisted.internet import protocol, reactor, task
+from twisted.internet.threads import blockingCallFromThread
+from twisted.protocols.policies import TimeoutMixin
+
+from . import logs, morse
+from .accesslog import (DEFAULT_BACKUP_COUNT as DEFAULT_ACCESS_LOG_BACKUPS,
+                        DEFAULT_MAX_BYTES as DEFAULT_ACCESS_LOG_MAX_BYTES,
+                        AccessLog, AccessLogFactory)
+from .cache import LRUCache
+from .decisions import Decisions, DecisionLog, DecisionReplay
+from .counters import (DEFAULT_MAX_ENTRIES, DEFAULT_TTL, RetryCounterStore,
+                       SQLiteCounterStore)
+from .logs import log_in_background
+from .metrics import MetricsFactory, ServerMetrics
+from .parser import MAX_HEAD_SIZE, HeadTooLarge, RequestParser
+from .producers import (CHUNK_SIZE, IteratorProducer, RepeatedBytesProducer,
+                        StreamingProducer)
+from .throttle import ThrottleScheduler
+from .trickle import TrickleScheduler
+from .workers import Supervisor, reuse_port_socket
 
 logger = logging.getLogger("hamms")
 logger.setLevel(logging.INFO)
@@ -24,11 +42,138 @@ __version__ = '1.3'
 SERVER_HEADER = 'Hamms/{version}'.format(version=__version__)
 
 BASE_PORT = 5500
+# Offset of the port that serves every mode, picked per request.
+DISPATCH_PORT = 17
+# Offset of the port that hands each connection to a mode picked by a
+# seeded schedule.
+CHAOS_PORT = 20
+# Offset of the admin port, which serves /metrics.
+ADMIN_PORT = 99
+# Every mode, with the offset of the port it listens on.
+MODES = [
+    ('listen-forever', 1),
+    ('empty-immediate', 2),
+    ('empty-on-receive', 3),
+    ('malformed-immediate', 4),
+    ('malformed-on-receive', 5),
+    ('slow-byte', 6),
+    ('very-slow-byte', 7),
+    ('sleep', 8),
+    ('status', 9),
+    ('overrun', 10),
+    ('large-header', 11),
+    ('retries', 12),
+    ('drop-random', 13),
+    ('unparseable', 14),
+    ('toolong-content', 15),
+    ('incomplete', 16),
+    ('dispatch', DISPATCH_PORT),
+    ('throttle', 18),
+    ('huge', 19),
+    ('chaos', CHAOS_PORT),
+    ('admin', ADMIN_PORT),
+]
+# Modes served by twisted.web sites rather than raw protocols.
+WEB_MODES = frozenset(['sleep', 'retries', 'unparseable', 'toolong-content'])
+# Modes the chaos port never picks, since they aren't failure modes.
+CHAOS_EXCLUDED = frozenset(['dispatch', 'chaos', 'admin'])
+# Modes the chaos port only picks if they're given a weight: a huge body or
+# a throttled one would take up most of a test's time.
+CHAOS_OPT_IN = frozenset(['huge', 'throttle'])
+# Event loops the raw ports can run on; see HammsServer.
+BACKENDS = ('twisted', 'asyncio')
+# Modes the asyncio backend can run: the raw ones that don't need Twisted's
+# producers.
+ASYNCIO_MODES = frozenset([
+    'listen-forever', 'empty-immediate', 'empty-on-receive',
+    'malformed-immediate', 'malformed-on-receive', 'slow-byte',
+    'very-slow-byte', 'drop-random', 'incomplete',
+])
+# --loop choice -> use_uvloop argument for hamms.aio.new_event_loop.
+UVLOOP_CHOICES = {'auto': None, 'asyncio': False, 'uvloop': True}
+ASYNCIO_MISSING = ("the asyncio backend needs Python 3, or trollius on "
+                   "Python 2: pip install hamms[asyncio]")
+# Bounds for the thread pool each WSGI app gets; the upper bound matches the
+# reactor's own thread pool.
+DEFAULT_MIN_THREADS = 0
+DEFAULT_MAX_THREADS = 10
+# Body bytes the Content-Length overrun port sends after promising 3.
+DEFAULT_OVERRUN_SIZE = 1024 * 1024
+# Keep-alive limits for the raw ports that support it: responses per
+# connection, and seconds an idle connection is held open.
+DEFAULT_KEEP_ALIVE_REQUESTS = 100
+DEFAULT_KEEP_ALIVE_TIMEOUT = 5.0
+# Body size and bytes per second for the throttled port.
+DEFAULT_THROTTLE_SIZE = 64 * 1024
+DEFAULT_THROTTLE_RATE = 8 * 1024
+# Default body size for the huge body port.
+DEFAULT_HUGE_SIZE = 1024 * 1024 * 1024
+# Shared buffer for bodies and headers made of repeated 'a's.
+A_CHUNK = 'a' * CHUNK_SIZE
+# The same buffer framed as one chunk of a chunked body.
+A_CHUNK_FRAMED = '{size:x}\r\n{chunk}\r\n'.format(size=CHUNK_SIZE,
+                                                    chunk=A_CHUNK)
+
+class Listeners(object):
+    """ Handles to everything :func:`listen` started.
+
+    :ivar dict ports: listening ports, keyed by port offset.
+    :ivar dict pools: :class:`MeteredThreadPool` instances, keyed by app name.
+    :ivar trickle: the :class:`~hamms.trickle.TrickleScheduler` shared by the
+        slow-byte ports.
+    :ivar throttle: the :class:`~hamms.throttle.ThrottleScheduler` shared by
+        the throttled port.
+    :ivar access_log: the :class:`~hamms.accesslog.AccessLog` requests are
+        recorded in, or None.
+    :ivar metrics: the :class:`~hamms.metrics.ServerMetrics` served on the
+        admin port.
+    :ivar retry_cache: the counter store behind the retries port, or None if
+        that port isn't listening.
+    :ivar chaos: the :class:`~hamms.chaos.ChaosSchedule` behind the chaos
+        port, or None if that port isn't listening.
+    :ivar decisions: the :class:`~hamms.decisions.Decisions` the drop-random
+        and chaos ports make their choices through.
+    """
+
+    def __init__(self, access_log=None, decisions=None):
+        self.ports = {}
+        self.pools = {}
+        self.trickle = TrickleScheduler()
+        self.throttle = ThrottleScheduler()
+        self.access_log = access_log
+        self.metrics = ServerMetrics()
+        self.metrics.add_collector(self._collect)
+        self.retry_cache = None
+        self.chaos = None
+        self.decisions = decisions if decisions is not None else Decisions()
+
+    def _collect(self):
+        metrics = self.metrics
+        for name, pool in self.pools.items():
+            stats = pool.stats()
+            metrics.pool_threads.labels(name).set(stats['threads'])
+            metrics.pool_busy.labels(name).set(stats['busy'])
+            metrics.pool_queued.labels(name).set(stats['queued'])
+        metrics.timers.labels().set(self.trickle.active)
+        metrics.throttled.labels().set(self.throttle.active)
+
+    def pool_stats(self):
+        return dict((name, pool.stats()) for name, pool in self.pools.items())
+
+    def reset(self):
+        """ Forget state earlier requests left behind, such as the retries
+        counters, so the next client starts from scratch. """
+        if self.retry_cache is not None:
+            self.retry_cache.clear()
+        if self.chaos is not None:
+            self.chaos.reset()
+        self.decisions.reset()
+
+    def mode_ports(self):
+        """ Mode name -> the port number it listens on. """
+        return dict((name, self.ports[offset].getHost().port)
+                    for name, offset in MODES if offset in self.ports)
 
-class HammsSite(Site):
-    def getResourceFor(self, request):
-        request.setHeader('Server', SERVER_HEADER)
-        return Site.getResourceFor(self, request)
 
 class HammsServer(object):
     """ Start the hamms server in a thread.
@@ -41,75 +186,392 @@ class HammsServer(object):
         hs.stop()
 
     :param int beginning_port: Hamms will start servers on all ports from
-        beginning_port to beginning_port + 14.
+        beginning_port to beginning_port + 99. Pass 0 to listen on ports the
+        OS picks instead, so parallel test runs can't collide; ``start``
+        returns the port for each mode.
+    :param int min_threads: Minimum number of threads in each app's pool.
+    :param int max_threads: Maximum number of threads in each app's pool.
+    :param int overrun_size: Number of body bytes the Content-Length overrun
+        port sends after promising 3.
+    :param int retries_max_keys: Maximum number of retry counters to keep.
+    :param float retries_ttl: Seconds a retry counter lives after its last
+        update.
+    :param str retries_db: Keep retry counters in this SQLite database
+        instead of in memory, so several hamms processes can share them.
+    :param str access_log: Record every request as a line of JSON in this
+        file.
+    :param bool keep_alive: Let clients keep connections to the large header
+        and drop-random ports open with a Connection: keep-alive header.
+    :param list modes: Only listen for these modes, given by name or port
+        offset, e.g. ``['status', 12]``. By default every port listens.
+    :param dict chaos_weights: Mode name or offset -> how often the chaos
+        port picks that mode, relative to the others. By default it picks
+        every mode equally often, except huge and throttle, which send
+        gigabyte or slowly paced bodies and are only picked if they're
+        given a weight.
+    :param int chaos_seed: Seed for the chaos port's schedule, so a run can
+        be repeated exactly. By default one is picked at random; the admin
+        port's ``/chaos`` reports it.
+    :param str record_decisions: Record the choices the drop-random and
+        chaos ports make in this file (see :mod:`hamms.decisions`).
+    :param str replay_decisions: Make the choices recorded in this file
+        again, instead of random ones.
+    :param bool log_in_background: Move the root logger's handlers behind
+        a queue, as ``python -m hamms`` does, so request logs are formatted
+        and written in a background thread instead of on the reactor's.
+        :meth:`stop` gives the handlers back. Off by default, since the
+        handlers belong to the process embedding hamms.
+    :param float timeout: Seconds to wait for the server to be ready.
+
+    ``start`` returns once every port is accepting connections, with a dict
+    of mode name -> port number, also kept as :attr:`ports`.
+
+    With ``backend='asyncio'``, the raw ports run on an asyncio event loop
+    in a thread of their own instead of the reactor (see :mod:`hamms.aio`),
+    and the server can be stopped and started again. uvloop is used if it's
+    installed, unless ``use_uvloop`` is False. Only ``beginning_port``,
+    ``keep_alive``, ``modes`` and ``log_in_background`` apply to that
+    backend.
     """
 
-    def start(self, beginning_port=BASE_PORT):
+    def __init__(self, backend='twisted', use_uvloop=None):
+        if backend not in BACKENDS:
+            raise ValueError("unknown backend: {0}".format(backend))
+        if backend == 'asyncio' and not asyncio_available():
+            raise ImportError(ASYNCIO_MISSING)
+        self.backend = backend
+        self.use_uvloop = use_uvloop
+        self.log_listener = None
+
+    def start(self, beginning_port=BASE_PORT, min_threads=DEFAULT_MIN_THREADS,
+              max_threads=DEFAULT_MAX_THREADS,
+              overrun_size=DEFAULT_OVERRUN_SIZE,
+              retries_max_keys=DEFAULT_MAX_ENTRIES, retries_ttl=DEFAULT_TTL,
+              retries_db=None, access_log=None, keep_alive=False, modes=None,
+              chaos_weights=None, chaos_seed=None, record_decisions=None,
+              replay_decisions=None, log_in_background=False,
+              timeout=10.0):
         self.beginning_port = beginning_port
-        self.retry_cache = {}
-
-        listen(reactor, base_port=self.beginning_port, retry_cache=self.retry_cache)
-
-        if not reactor.running:
+        if log_in_background and self.log_listener is None:
+            self.log_listener = logs.log_in_background()
+        if self.backend == 'asyncio':
+            return self._start_loop(beginning_port, keep_alive, modes)
+        self.retry_cache = retry_store(retries_db, retries_max_keys,
+                                       retries_ttl)
+        self.access_log = AccessLog(access_log) if access_log else None
+        self.decisions = decision_source(record_decisions, replay_decisions)
+        kwargs = dict(base_port=self.beginning_port,
+                      retry_cache=self.retry_cache, min_threads=min_threads,
+                      max_threads=max_threads, overrun_size=overrun_size,
+                      access_log=self.access_log, keep_alive=keep_alive,
+                      modes=modes, chaos_weights=chaos_weights,
+                      chaos_seed=chaos_seed, decisions=self.decisions)
+
+        if reactor.running:
+            # Another server started the reactor in its own thread, which is
+            # the only one that may touch it.
+            self.listeners = blockingCallFromThread(reactor, listen, reactor,
+                                                    **kwargs)
+        else:
+            self.listeners = listen(reactor, **kwargs)
+            ready = Event()
+            reactor.callWhenRunning(ready.set)
             self.t = Thread(target=reactor.run, args=(False,))
             self.t.daemon = True
             self.t.start()
+            if not ready.wait(timeout):
+                raise RuntimeError("hamms did not start within {0} "
+                                   "seconds".format(timeout))
+        self.ports = self.listeners.mode_ports()
+        return self.ports
+
+    def _start_loop(self, beginning_port, keep_alive, modes):
+        from . import aio
+        loop = aio.new_event_loop(self.use_uvloop)
+        try:
+            self.listeners = loop.run_until_complete(aio.listen(
+                loop, beginning_port, modes, keep_alive=keep_alive))
+        except Exception:
+            loop.close()
+            raise
+        self.loop = loop
+        self.t = Thread(target=loop.run_forever)
+        self.t.daemon = True
+        self.t.start()
+        self.ports = self.listeners.mode_ports()
+        return self.ports
+
+    def pool_stats(self):
+        """ Saturation statistics for each app's thread pool. """
+        return self.listeners.pool_stats()
 
     def stop(self):
-        reactor.stop()
-
-def listen(_reactor, base_port=BASE_PORT, retry_cache=None):
+        if self.backend == 'asyncio':
+            self.loop.call_soon_threadsafe(self.listeners.close)
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.t.join()
+            self.loop.close()
+        else:
+            reactor.stop()
+        if self.log_listener is not None:
+            self.log_listener.restore()
+            self.log_listener = None
+
+def retry_store(path=None, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL):
+    """ A counter store for the retries port: in memory, or in the SQLite
+    database at ``path`` if one is given. """
+    if path:
+        return SQLiteCounterStore(path, max_entries=max_entries, ttl=ttl)
+    return RetryCounterStore(max_entries=max_entries, ttl=ttl)
+
+def asyncio_available():
+    """ Whether the asyncio backend can run: on Python 3, or on Python 2 with
+    trollius installed (``pip install hamms[asyncio]``). """
+    for name in ('asyncio', 'trollius'):
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            continue
+        return True
+    return False
+
+def select_modes(modes=None):
+    """ The set of mode names in ``modes``, which may name each mode or give
+    its port offset. None selects every mode. """
+    if modes is None:
+        return set(name for name, port in MODES)
+    offsets = dict((str(port), name) for name, port in MODES)
+    names = set(name for name, port in MODES)
+    selected = set()
+    for mode in modes:
+        mode = offsets.get(str(mode).strip(), str(mode).strip())
+        if mode not in names:
+            raise ValueError("Unknown mode {mode!r}; pick from {names}".format(
+                mode=mode, names=', '.join(name for name, port in MODES)))
+        selected.add(mode)
+    return selected
+
+def listen(_reactor, base_port=BASE_PORT, retry_cache=None,
+           min_threads=DEFAULT_MIN_THREADS, max_threads=DEFAULT_MAX_THREADS,
+           overrun_size=DEFAULT_OVERRUN_SIZE, reuse_port=False,
+           access_log=None, keep_alive=False,
+           keep_alive_requests=DEFAULT_KEEP_ALIVE_REQUESTS,
+           keep_alive_timeout=DEFAULT_KEEP_ALIVE_TIMEOUT, single_port=False,
+           modes=None, chaos_weights=None, chaos_seed=None, decisions=None):
+    """ Listen on the ports for ``modes``, a list of mode names or port
+    offsets (see :data:`MODES`), or on every port if it's None. Only the
+    selected modes are built, so twisted.web and Flask aren't imported unless
+    one of them needs it. The chaos port also builds the modes it picks
+    from, whether or not they have ports of their own.
+
+    Each mode listens on ``base_port`` plus its offset, or if ``base_port``
+    is 0, on a port the OS picks; see :meth:`Listeners.mode_ports`.
+
+    The drop-random and chaos ports make their choices through
+    ``decisions``, a :class:`~hamms.decisions.Decisions`, which is closed
+    when the reactor shuts down. By default they're made at random and not
+    recorded.
+    """
     # in likelihood there is no benefit to passing in the reactor as only one of
     # them can ever run at a time.
-    retry_cache = retry_cache or {}
-    retries_app = create_retries_app(retry_cache)
-
-    sleep_resource = WSGIResource(reactor, reactor.getThreadPool(), sleep_app)
-    sleep_site = HammsSite(sleep_resource)
-
-    status_resource = WSGIResource(reactor, reactor.getThreadPool(), status_app)
-    status_site = HammsSite(status_resource)
-
-    large_header_resource = WSGIResource(reactor, reactor.getThreadPool(),
-                                         large_header_app)
-    large_header_site = HammsSite(large_header_resource)
-
-    retries_resource = WSGIResource(reactor, reactor.getThreadPool(), retries_app)
-    retries_site = HammsSite(retries_resource)
-
-    unparseable_resource = WSGIResource(reactor, reactor.getThreadPool(),
-                                        unparseable_app)
-    unparseable_site = HammsSite(unparseable_resource)
-
-    toolong_content_resource = WSGIResource(reactor, reactor.getThreadPool(),
-                                        toolong_content_app)
-    toolong_content_site = HammsSite(toolong_content_resource)
-
-    _reactor.listenTCP(base_port + ListenForeverServer.PORT, ListenForeverFactory())
-    _reactor.listenTCP(base_port + EmptyStringTerminateImmediatelyServer.PORT,
-                      EmptyStringTerminateImmediatelyFactory())
-    _reactor.listenTCP(base_port + EmptyStringTerminateOnReceiveServer.PORT,
-                      EmptyStringTerminateOnReceiveFactory())
-    _reactor.listenTCP(base_port + MalformedStringTerminateImmediatelyServer.PORT,
-                      MalformedStringTerminateImmediatelyFactory())
-    _reactor.listenTCP(base_port + MalformedStringTerminateOnReceiveServer.PORT,
-                      MalformedStringTerminateOnReceiveFactory())
-    _reactor.listenTCP(base_port + FiveSecondByteResponseServer.PORT,
-                      FiveSecondByteResponseFactory())
-    _reactor.listenTCP(base_port + ThirtySecondByteResponseServer.PORT,
-                      ThirtySecondByteResponseFactory())
-    _reactor.listenTCP(base_port + sleep_app.PORT, sleep_site)
-    _reactor.listenTCP(base_port + status_app.PORT, status_site)
-    _reactor.listenTCP(base_port + SendDataPastContentLengthServer.PORT,
-                      SendDataPastContentLengthFactory())
-    _reactor.listenTCP(base_port + large_header_app.PORT, large_header_site)
-    _reactor.listenTCP(base_port + retries_app.PORT, retries_site)
-    _reactor.listenTCP(base_port + DropRandomRequestsServer.PORT,
-                       DropRandomRequestsFactory())
-    _reactor.listenTCP(base_port + unparseable_app.PORT, unparseable_site)
-    _reactor.listenTCP(base_port + IncompleteResponseServer.PORT,
-                       IncompleteResponseFactory())
-    _reactor.listenTCP(base_port + toolong_content_app.PORT, toolong_content_site)
+    if not base_port and reuse_port:
+        raise ValueError("reuse_port needs a fixed base_port")
+    selected = select_modes(modes)
+    if single_port:
+        selected.add('dispatch')
+    needed = set(selected)
+    if 'chaos' in selected:
+        chaos_weights = _chaos_weights(chaos_weights)
+        needed.update(chaos_weights)
+    listeners = Listeners(access_log, decisions)
+    # Port offset -> a socket bound to a port the OS picked, not yet adopted
+    # by the reactor. Bound up front so metrics can be labelled with the
+    # port number.
+    sockets = {}
+
+    def port_number(offset):
+        if base_port or (single_port and
+                         offset not in (DISPATCH_PORT, ADMIN_PORT)):
+            return base_port + offset
+        if offset not in sockets:
+            sockets[offset] = _ephemeral_socket()
+        return sockets[offset].getsockname()[1]
+
+    def listen_on(offset, factory):
+        number = port_number(offset)
+        if offset in sockets:
+            port = _adopt_socket(_reactor, sockets.pop(offset), factory)
+        else:
+            port = _listen_tcp(_reactor, number, factory, reuse_port)
+        listeners.ports[offset] = port
+
+    def wsgi_site(name, app):
+        from .web import wsgi_site
+        return wsgi_site(_reactor, listeners, name, app, min_threads,
+                         max_threads)
+
+    def sleep_site():
+        from .web import HammsSite, SleepResource
+        return HammsSite(SleepResource())
+
+    def retries_site():
+        from .apps import create_retries_app
+        cache = retry_cache if retry_cache is not None else RetryCounterStore()
+        listeners.retry_cache = cache
+        return wsgi_site('retries', create_retries_app(cache))
+
+    def unparseable_site():
+        from .web import HammsSite, UnparseableResource
+        return HammsSite(UnparseableResource())
+
+    def toolong_content_site():
+        from .apps import toolong_content_app
+        return wsgi_site('toolong_content', toolong_content_app)
+
+    def label_port(mode):
+        # Modes only the chaos port uses are counted under its port, rather
+        # than binding one of their own that nothing listens on.
+        if mode in selected:
+            return dict(MODES)[mode]
+        return CHAOS_PORT
+
+    keep_alive = dict(keep_alive=keep_alive,
+                      max_requests=keep_alive_requests,
+                      idle_timeout=keep_alive_timeout)
+    builders = {
+        'listen-forever': ListenForeverFactory,
+        'empty-immediate': EmptyStringTerminateImmediatelyFactory,
+        'empty-on-receive': EmptyStringTerminateOnReceiveFactory,
+        'malformed-immediate': MalformedStringTerminateImmediatelyFactory,
+        'malformed-on-receive': MalformedStringTerminateOnReceiveFactory,
+        'slow-byte': lambda: FiveSecondByteResponseFactory(listeners.trickle),
+        'very-slow-byte':
+            lambda: ThirtySecondByteResponseFactory(listeners.trickle),
+        'sleep': sleep_site,
+        'status': lambda: StatusFactory(listeners.metrics,
+                                        port_number(label_port('status')),
+                                        **keep_alive),
+        'overrun': lambda: SendDataPastContentLengthFactory(overrun_size),
+        'large-header': lambda: LargeHeaderFactory(**keep_alive),
+        'retries': retries_site,
+        'drop-random': lambda: DropRandomRequestsFactory(
+            listeners.decisions, **keep_alive),
+        'unparseable': unparseable_site,
+        'incomplete': IncompleteResponseFactory,
+        'toolong-content': toolong_content_site,
+        'throttle': lambda: ThrottledResponseFactory(listeners.throttle,
+                                                     **keep_alive),
+        'huge': lambda: HugeBodyFactory(**keep_alive),
+    }
+
+    # Mode name -> web resource or raw factory, for the dispatch port.
+    dispatch = {}
+    # Mode name -> factory, for the chaos port.
+    factories = {}
+    for mode, port in MODES:
+        if mode not in builders or mode not in needed:
+            continue
+        factory = builders[mode]()
+        port = label_port(mode)
+        if mode in WEB_MODES:
+            factory.port = port_number(port)
+            factory.mode = mode
+            factory.metrics = listeners.metrics
+            factory.access_log = access_log
+            resource = factory.resource
+        else:
+            if access_log is not None:
+                factory = AccessLogFactory(factory, access_log, mode)
+            resource = factory
+        factories[mode] = factory
+        if mode not in selected:
+            continue
+        dispatch[mode] = resource
+        if single_port:
+            continue
+        listen_on(port, MetricsFactory(factory, listeners.metrics,
+                                       port_number(port), mode))
+
+    if 'chaos' in selected:
+        from .chaos import ChaosFactory, ChaosSchedule
+        listeners.chaos = ChaosSchedule(chaos_weights, chaos_seed)
+        logger.info("chaos seed: {seed}".format(seed=listeners.chaos.seed))
+        factory = ChaosFactory(listeners.chaos, factories,
+                               listeners.decisions)
+        dispatch['chaos'] = factory
+        if not single_port:
+            listen_on(CHAOS_PORT, MetricsFactory(
+                factory, listeners.metrics, port_number(CHAOS_PORT), 'chaos'))
+
+    if 'dispatch' in selected:
+        from .dispatch import HandoverFactory, HandoverResource
+        from .web import DispatchSite
+        for mode, factory in dispatch.items():
+            if mode not in WEB_MODES:
+                dispatch[mode] = HandoverResource(factory)
+        if 'status' in dispatch:
+            # The dispatch port keeps status requests on the HTTP channel,
+            # so the connection can still be used for other modes.
+            from .apps import status_app
+            dispatch['status'] = wsgi_site('status', status_app).resource
+        dispatch_site = DispatchSite(dispatch)
+        dispatch_site.port = port_number(DISPATCH_PORT)
+        dispatch_site.mode = 'dispatch'
+        dispatch_site.metrics = listeners.metrics
+        dispatch_site.access_log = access_log
+        listen_on(DISPATCH_PORT, MetricsFactory(
+            HandoverFactory(dispatch_site), listeners.metrics,
+            dispatch_site.port, 'dispatch'))
+    if 'admin' in selected:
+        from .web import AdminResource, HammsSite
+        listen_on(ADMIN_PORT, HammsSite(AdminResource(listeners)))
+    if access_log is not None:
+        _reactor.addSystemEventTrigger('after', 'shutdown', access_log.close)
+    _reactor.addSystemEventTrigger('after', 'shutdown',
+                                   listeners.decisions.close)
+    # Every socket bound for a label should have been adopted by now.
+    for sock in sockets.values():
+        sock.close()
+    return listeners
+
+def _listen_tcp(_reactor, port, factory, reuse_port=False):
+    if not reuse_port:
+        return _reactor.listenTCP(port, factory)
+    return _adopt_socket(_reactor, reuse_port_socket(port), factory)
+
+def _chaos_weights(weights=None):
+    """ Mode name -> weight, from ``weights``, which may name each mode or
+    give its port offset. None weighs every mode the chaos port can pick
+    equally, except the slow ones in :data:`CHAOS_OPT_IN`. """
+    if weights is None:
+        return dict((name, 1) for name, port in MODES
+                    if name not in CHAOS_EXCLUDED | CHAOS_OPT_IN)
+    named = {}
+    for mode, weight in weights.items():
+        name, = select_modes([mode])
+        if name in CHAOS_EXCLUDED:
+            raise ValueError("the chaos port can't pick {0}".format(name))
+        named[name] = weight
+    return named
+
+def _ephemeral_socket(backlog=50):
+    """ A listening socket on a port the OS picks. """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind(('', 0))
+        sock.listen(backlog)
+        sock.setblocking(False)
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+def _adopt_socket(_reactor, sock, factory):
+    try:
+        return _reactor.adoptStreamPort(sock.fileno(), socket.AF_INET, factory)
+    finally:
+        # adoptStreamPort duplicates the file descriptor.
+        sock.close()
 
 
 def get_remote_host(transport):
@@ -126,34 +588,174 @@ def get_port(transport):
         return "<port>"
 
 def get_header(header_name, data):
-    try:
-        rline, raw_headers = data.split('\r\n', 1)
-        headers = message_from_string(raw_headers)
-        return headers.get(header_name, "")
-    except Exception:
-        return ""
+    """ The value of the first ``header_name`` header in the request head at
+    the start of ``data``, or "" if there isn't one.
 
-def _log_t(transport, data, status=None):
-    ipaddr = get_remote_host(transport)
-    port = get_port(transport)
-    ua = get_header('user-agent', data)
-    return _log(ipaddr, port, data, status=status, ua=ua)
+    Only the head is scanned, and at most MAX_HEAD_SIZE bytes of it.
+    """
+    head = data[:MAX_HEAD_SIZE]
+    end = head.find('\r\n\r\n')
+    if end >= 0:
+        head = head[:end + 2]
+    needle = '\r\n' + header_name.lower() + ':'
+    start = head.lower().find(needle)
+    if start < 0:
+        return ""
+    start += len(needle)
+    end = head.find('\r\n', start)
+    return head[start:end if end >= 0 else len(head)].strip()
 
-def _log(ipaddr, port, data, status=None, ua=""):
+def get_query(data):
+    """ Parse the query string out of the request line in ``data``. """
     try:
-        topline = data.split('\r\n')[0]
-        return "{ipaddr} {port} \"{topline}\" {status} \"{ua}\"".format(
-            ipaddr=ipaddr, port=port, topline=topline, ua=ua, status=status or "-")
+        method, url, http_vsn = data.split('\r\n', 1)[0].split(' ')
+        return urlparse.parse_qs(urlparse.urlparse(url).query)
     except Exception:
-        logger.exception("caught exception while formatting log")
-        return "<data received>"
+        return {}
+
+# Fraction of requests to log, keyed by port offset. Ports that aren't
+# listed log every request.
+LOG_SAMPLE_RATES = {}
+# Kept apart from the random state the ports pick failures with.
+_log_sampler = random.Random()
+
+def _should_log(port_offset):
+    if not logger.isEnabledFor(logging.INFO):
+        return False
+    rate = LOG_SAMPLE_RATES.get(port_offset, 1)
+    return rate >= 1 or _log_sampler.random() < rate
+
+def _topline(data):
+    end = data.find('\r\n', 0, MAX_HEAD_SIZE)
+    return data[:end if end >= 0 else MAX_HEAD_SIZE]
+
+def _log(ipaddr, port, topline, status=None, ua=""):
+    # Arguments are passed through to the logger so the line is only
+    # formatted by the handler, off the reactor thread.
+    logger.info('%s %s "%s" %s "%s"', ipaddr, port, topline, status or "-", ua)
+
+class HammsProtocol(protocol.Protocol):
+    """ Base class for the raw protocol ports. """
+
+    PORT = None
+    logged = False
+
+    def log(self, data, status=None):
+        """ Log the request at the start of ``data``. Only the first call on a
+        connection logs, subject to the port's sample rate. """
+        if self.logged:
+            return
+        self.logged = True
+        # Picked up by the access log when the connection closes.
+        self.request_line = _topline(data)
+        self.status = status
+        if _should_log(self.PORT):
+            _log(get_remote_host(self.transport), get_port(self.transport),
+                 _topline(data), status=status,
+                 ua=get_header('user-agent', data))
+
+class RequestProtocol(HammsProtocol, TimeoutMixin):
+    """ Base class for raw ports that answer once a whole request head has
+    arrived, however it was split across reads.
+
+    Subclasses implement ``requestReceived(head)``, which is called with a
+    :class:`~hamms.parser.RequestHead` for each request on the connection.
+    It either closes the connection or, once its response is complete,
+    calls :meth:`endResponse`; requests that arrive in the meantime wait.
+
+    A connection is kept open for more requests if the request has
+    ``?keepalive=1``, or if ``keep_alive`` is set and the client asked for it
+    with its Connection header. It is closed after ``max_requests``
+    responses, or once it has been idle for ``idle_timeout`` seconds.
+    """
 
-class ListenForeverServer(protocol.Protocol):
+    keep_alive = False
+    max_requests = DEFAULT_KEEP_ALIVE_REQUESTS
+    idle_timeout = DEFAULT_KEEP_ALIVE_TIMEOUT
+
+    parser = None
+    busy = False
+    served = 0
+    _dispatching = False
+
+    def dataReceived(self, data):
+        if self.parser is None:
+            self.parser = RequestParser()
+            self.waiting = []
+        try:
+            self.waiting.extend(self.parser.feed(data))
+        except HeadTooLarge:
+            self.log(self.parser.buffer)
+            self.transport.loseConnection()
+            return
+        self._dispatch()
+
+    def _dispatch(self):
+        # A loop rather than recursion from endResponse, so a long run of
+        # pipelined requests can't overflow the stack.
+        if self._dispatching:
+            return
+        self._dispatching = True
+        try:
+            while (self.waiting and not self.busy and
+                   not self.transport.disconnecting):
+                self.busy = True
+                self.logged = False
+                self.setTimeout(None)
+                self.requestReceived(self.waiting.pop(0))
+        finally:
+            self._dispatching = False
+
+    def requestReceived(self, head):
+        raise NotImplementedError()
+
+    def keepAlive(self, head):
+        """ Whether to keep the connection open after answering ``head``. """
+        if self.served + 1 >= self.max_requests:
+            return False
+        if 'keepalive' in head.query:
+            return head.query['keepalive'][-1] not in ('0', 'false')
+        return self.keep_alive and head.keep_alive()
+
+    def endResponse(self, keep_alive):
+        """ The response is complete: close the connection, or wait for the
+        next request on it. """
+        self.busy = False
+        self.served += 1
+        if not keep_alive:
+            self.transport.loseConnection()
+            return
+        self.setTimeout(self.idle_timeout)
+        self._dispatch()
+
+    def connectionLost(self, reason):
+        self.setTimeout(None)
+
+
+class RequestFactory(protocol.Factory):
+    """ Build ``protocol``, a :class:`RequestProtocol`, with the given
+    keep-alive settings. """
+
+    def __init__(self, keep_alive=False,
+                 max_requests=DEFAULT_KEEP_ALIVE_REQUESTS,
+                 idle_timeout=DEFAULT_KEEP_ALIVE_TIMEOUT):
+        self.keep_alive = keep_alive
+        self.max_requests = max_requests
+        self.idle_timeout = idle_timeout
+
+    def buildProtocol(self, addr):
+        p = self.protocol()
+        p.keep_alive = self.keep_alive
+        p.max_requests = self.max_requests
+        p.idle_timeout = self.idle_timeout
+        return p
+
+class ListenForeverServer(HammsProtocol):
 
     PORT = 1
 
     def dataReceived(self, data):
-        logger.info(_log_t(self.transport, data))
+        self.log(data)
 
 
 class ListenForeverFactory(protocol.Factory):
@@ -161,11 +763,11 @@ class ListenForeverFactory(protocol.Factory):
         return ListenForeverServer()
 
 
-class EmptyStringTerminateImmediatelyServer(protocol.Protocol):
+class EmptyStringTerminateImmediatelyServer(HammsProtocol):
     PORT = 2
 
     def dataReceived(self, data):
-        logger.info(_log_t(self.transport, data))
+        self.log(data)
 
     def connectionMade(self):
         self.transport.write('')
@@ -177,12 +779,12 @@ class EmptyStringTerminateImmediatelyFactory(protocol.Factory):
         return EmptyStringTerminateImmediatelyServer()
 
 
-class EmptyStringTerminateOnReceiveServer(protocol.Protocol):
+class EmptyStringTerminateOnReceiveServer(HammsProtocol):
 
     PORT = 3
 
     def dataReceived(self, data):
-        logger.info(_log_t(self.transport, data))
+        self.log(data)
         self.transport.write('')
         self.transport.loseConnection()
 
@@ -192,12 +794,12 @@ class EmptyStringTerminateOnReceiveFactory(protocol.Factory):
         return EmptyStringTerminateOnReceiveServer()
 
 
-class MalformedStringTerminateImmediatelyServer(protocol.Protocol):
+class MalformedStringTerminateImmediatelyServer(HammsProtocol):
 
     PORT = 4
 
     def dataReceived(self, data):
-        logger.info(_log_t(self.transport, data))
+        self.log(data)
 
     def connectionMade(self):
         self.transport.write('foo bar')
@@ -209,12 +811,12 @@ class MalformedStringTerminateImmediatelyFactory(protocol.Factory):
         return MalformedStringTerminateImmediatelyServer()
 
 
-class MalformedStringTerminateOnReceiveServer(protocol.Protocol):
+class MalformedStringTerminateOnReceiveServer(HammsProtocol):
 
     PORT = 5
 
     def dataReceived(self, data):
-        logger.info(_log_t(self.transport, data))
+        self.log(data)
         self.transport.write('foo bar')
         self.transport.loseConnection()
 
@@ -228,74 +830,100 @@ class MalformedStringTerminateOnReceiveFactory(protocol.Factory):
 empty_response = ('HTTP/1.1 204 No Content\r\n'
                   'Server: {hdr}\r\n\r\n'.format(hdr=SERVER_HEADER))
 
-class FiveSecondByteResponseServer(protocol.Protocol):
+class SlowByteResponseServer(RequestProtocol):
+    """ Send back ``empty_response`` one byte every INTERVAL seconds.
 
-    PORT = 6
+    Pass ``?bytes=<int>&interval=<float>`` to send a different number of
+    bytes per interval, e.g. ``?interval=0.25`` for one byte every 250ms.
+    """
 
-    def _send_byte(self, byte):
-        self.transport.write(byte)
+    INTERVAL = None
+    stream = None
+    trickle = None
 
-    def dataReceived(self, data):
+    def requestReceived(self, head):
+        if self.stream is not None:
+            return
         try:
-            timer = 5
-            for byte in empty_response:
-                reactor.callLater(timer, self._send_byte, byte)
-                timer += 5
-            reactor.callLater(timer, self.transport.loseConnection)
-            logger.info(_log_t(self.transport, data, status=204))
-        except Exception:
-            logger.info(_log_t(self.transport, data))
-
+            chunk_size = int(head.query.get('bytes', [1])[0])
+            interval = float(head.query.get('interval', [self.INTERVAL])[0])
+            if chunk_size <= 0 or not interval > 0 or not _finite(interval):
+                raise ValueError(chunk_size, interval)
+        except ValueError:
+            self.log(head.raw, status=400)
+            _bad_request(self.transport, 'Please pass a positive integer '
+                                         'bytes and a finite positive '
+                                         'interval')
+            return
+        self.stream = self.trickle.add(self.transport, empty_response,
+                                       chunk_size=chunk_size,
+                                       interval=interval)
+        self.log(head.raw, status=204)
+
+    def connectionLost(self, reason):
+        RequestProtocol.connectionLost(self, reason)
+        if self.stream is not None:
+            self.stream.cancel()
+
+
+class SlowByteResponseFactory(protocol.Factory):
+    def __init__(self, trickle=None):
+        self.trickle = trickle or TrickleScheduler()
 
-class FiveSecondByteResponseFactory(protocol.Factory):
     def buildProtocol(self, addr):
-        return FiveSecondByteResponseServer()
+        p = self.protocol()
+        p.trickle = self.trickle
+        return p
 
 
-class ThirtySecondByteResponseServer(protocol.Protocol):
+class FiveSecondByteResponseServer(SlowByteResponseServer):
 
-    PORT = 7
+    PORT = 6
+    INTERVAL = 5
 
-    def _send_byte(self, byte):
-        self.transport.write(byte)
 
-    def dataReceived(self, data):
-        try:
-            timer = 30
-            for byte in empty_response:
-                reactor.callLater(timer, self._send_byte, byte)
-                timer += 30
-            reactor.callLater(timer, self.transport.loseConnection)
-            logger.info(_log_t(self.transport, data, status=204))
-        except Exception:
-            logger.info(_log_t(self.transport, data))
+class FiveSecondByteResponseFactory(SlowByteResponseFactory):
+    protocol = FiveSecondByteResponseServer
 
 
-class ThirtySecondByteResponseFactory(protocol.Factory):
-    def buildProtocol(self, addr):
-        return ThirtySecondByteResponseServer()
+class ThirtySecondByteResponseServer(SlowByteResponseServer):
+
+    PORT = 7
+    INTERVAL = 30
+
 
+class ThirtySecondByteResponseFactory(SlowByteResponseFactory):
+    protocol = ThirtySecondByteResponseServer
 
-class SendDataPastContentLengthServer(protocol.Protocol):
+
+OVERRUN_HEADERS = ('HTTP/1.1 200 OK\r\n'
+                   'Server: {server}\r\n'
+                   'Content-Type: text/plain\r\n'
+                   'Content-Length: 3\r\n'
+                   'Connection: keep-alive\r\n'
+                   '\r\n'.format(server=SERVER_HEADER))
+
+class SendDataPastContentLengthServer(HammsProtocol):
 
     PORT = 10
+    size = DEFAULT_OVERRUN_SIZE
 
     def dataReceived(self, data):
-        logger.info(_log_t(self.transport, data, status=200))
+        self.log(data, status=200)
 
     def connectionMade(self):
-        self.transport.write('HTTP/1.1 200 OK\r\n'
-                             'Server: {server}\r\n'
-                             'Content-Type: text/plain\r\n'
-                             'Content-Length: 3\r\n'
-                             'Connection: keep-alive\r\n'
-                             '\r\n{body}'.format(server=SERVER_HEADER,
-                                                 body='a'*1024*1024))
-        self.transport.loseConnection()
+        RepeatedBytesProducer(self.transport, A_CHUNK, self.size,
+                              prefix=OVERRUN_HEADERS,
+                              finished=self.transport.loseConnection).start()
 
 class SendDataPastContentLengthFactory(protocol.Factory):
+    def __init__(self, size=DEFAULT_OVERRUN_SIZE):
+        self.size = size
+
     def buildProtocol(self, addr):
-        return SendDataPastContentLengthServer()
+        p = SendDataPastContentLengthServer()
+        p.size = self.size
+        return p
 
 def success_response(content_type, response):
     return ('HTTP/1.1 200 OK\r\n'
@@ -304,36 +932,68 @@ def success_response(content_type, response):
             '{response}'.format(ctype=content_type, server=SERVER_HEADER,
                                 response=response))
 
-class DropRandomRequestsServer(protocol.Protocol):
+def keep_alive_response(content_type, response):
+    """ Like :func:`success_response`, but framed with a Content-Length so
+    the connection can carry another request. """
+    return ('HTTP/1.1 200 OK\r\n'
+            'Server: {server}\r\n'
+            'Content-Type: {ctype}\r\n'
+            'Content-Length: {length}\r\n'
+            'Connection: keep-alive\r\n\r\n'
+            '{response}'.format(ctype=content_type, server=SERVER_HEADER,
+                                length=len(response), response=response))
+
+SUCCESS = success_response('application/json', '{"success": true}')
+SUCCESS_KEEP_ALIVE = keep_alive_response('application/json',
+                                         '{"success": true}')
+
+class DropRandomRequestsServer(RequestProtocol):
 
     PORT = 13
 
-    def dataReceived(self, data):
-        body = data.split('\r\n')
-        try:
-            method, url, http_vsn = body[0].split(' ')
-        except Exception:
+    # Set by the factory; this one is for protocols built without one.
+    decisions = Decisions()
+
+    def requestReceived(self, head):
+        if not head.valid:
             # we got weird data, just fail
-            logger.info(_log_t(self.transport, data))
+            self.log(head.raw)
             self.transport.loseConnection()
+            return
 
-        o = urlparse.urlparse(url)
-        query = urlparse.parse_qs(o.query)
-        if 'failrate' in query:
-            failrate = query['failrate'].pop()
-        else:
+        try:
+            failrate = float(head.query.get('failrate', [0.05])[-1])
+        except ValueError:
             failrate = 0.05
-        if random.random() >= float(failrate):
-            logger.info(_log_t(self.transport, data, status=200))
-            self.transport.write(
-                success_response('application/json', '{"success": true}'))
+        decisions = self.decisions
+        # 1 answers the request, 0 drops it.
+        answer = decisions.decide(
+            self.PORT, lambda: int(decisions.random.random() >= failrate))
+        if answer:
+            self.log(head.raw, status=200)
+            if self.keepAlive(head):
+                self.transport.write(SUCCESS_KEEP_ALIVE)
+                self.endResponse(True)
+                return
+            self.transport.write(SUCCESS)
         else:
-            logger.info(_log_t(self.transport, data))
+            self.log(head.raw)
         self.transport.loseConnection()
 
-class DropRandomRequestsFactory(protocol.Factory):
+class DropRandomRequestsFactory(RequestFactory):
+    """ :param decisions: the :class:`~hamms.decisions.Decisions` to decide
+        which requests to drop with; by default, a new one. """
+
+    protocol = DropRandomRequestsServer
+
+    def __init__(self, decisions=None, **kwargs):
+        RequestFactory.__init__(self, **kwargs)
+        self.decisions = decisions if decisions is not None else Decisions()
+
     def buildProtocol(self, addr):
-        return DropRandomRequestsServer()
+        p = RequestFactory.buildProtocol(self, addr)
+        p.decisions = self.decisions
+        return p
 
 
 
@@ -349,10 +1009,13 @@ INCOMPLETE_XML = '<?xml version="1.0" ?><response><status type="http">200 foo'
 INCOMPLETE_PLAIN = 'incomplete document respo'
 INCOMPLETE_HTML = '<!doctype html><html><head><title>incomplete'
 
-class IncompleteResponseServer(protocol.Protocol):
+class IncompleteResponseServer(RequestProtocol):
     PORT = 16
-    def dataReceived(self, data):
-        accept_header_value = get_header('Accept', data)
+    def requestReceived(self, head):
+        self.log(head.raw, status=200)
+        # Imported here so the other raw ports can start without werkzeug.
+        from werkzeug.http import parse_accept_header
+        accept_header_value = head.header('Accept')
         accept_cls = parse_accept_header(accept_header_value)
         self.transport.write('HTTP/1.1 200 OK\r\n')
         if 'text/html' == accept_cls.best:
@@ -374,225 +1037,699 @@ class IncompleteResponseFactory(protocol.Factory):
         return IncompleteResponseServer()
 
 
-sleep_app = Flask(__name__)
-sleep_app.PORT = 8
-status_app = Flask(__name__)
-status_app.PORT = 9
-large_header_app = Flask(__name__)
-large_header_app.PORT = 11
-unparseable_app = Flask(__name__)
-unparseable_app.PORT = 14
-toolong_content_app = Flask(__name__)
-toolong_content_app.PORT = 15
-
-def create_retries_app(cache):
-    retries_app = Flask(__name__)
-    retries_app.PORT = 12
-    retries_app.cache = cache
-
-    # we want the retries app to listen on all methods
-    retries_app.url_map.add(Rule('/', endpoint='index'))
-    @retries_app.endpoint("index")
-    def check_retries():
-        json_hdr = {'Content-Type': 'application/json'}
-        key = request.args.get('key', 'default')
-        tries = request.args.get('tries', 3)
+class ThrottledResponseServer(RequestProtocol):
+    """ Send a body of ``?size=<int>`` bytes at ``?rate=<int>`` bytes a
+    second, as if over a slow link.
+
+    ``?jitter=<float>`` varies the rate on every tick by up to that fraction
+    either way. ``?stall=<float>`` stops sending for that many seconds once
+    ``?stall_at=<int>`` bytes of the body (by default, half) have been sent.
+    """
+
+    PORT = 18
+    throttle = None
+    stream = None
+
+    def requestReceived(self, head):
+        query = head.query
         try:
-            tries = int(tries)
-        except Exception:
-            return Response(status=400, headers=json_hdr, response=json.dumps({
-                'error': 'Please pass an integer number of tries',
-                'key': key,
-                'success': False,
-            }))
-
-        if key in retries_app.cache:
-            retries_app.cache[key] -= 1
+            size = int(query.get('size', [DEFAULT_THROTTLE_SIZE])[0])
+            rate = float(query.get('rate', [DEFAULT_THROTTLE_RATE])[0])
+            jitter = float(query.get('jitter', [0])[0])
+            stall = float(query.get('stall', [0])[0])
+            stall_at = int(query.get('stall_at', [size // 2])[0])
+            if (size < 0 or not rate > 0 or not 0 <= jitter <= 1 or
+                    not stall >= 0 or not _finite(rate) or
+                    not _finite(stall)):
+                raise ValueError(size, rate, jitter, stall)
+        except ValueError:
+            self.log(head.raw, status=400)
+            _bad_request(self.transport, 'Please pass a non-negative integer '
+                                         'size, a finite positive rate, a '
+                                         'jitter between 0 and 1 and a finite '
+                                         'non-negative stall')
+            return
+
+        self.log(head.raw, status=200)
+        keep_alive = self.keepAlive(head)
+        self.transport.write(
+            'HTTP/1.1 200 OK\r\n'
+            'Server: {server}\r\n'
+            'Content-Type: application/octet-stream\r\n'
+            'Content-Length: {length}\r\n'
+            'Connection: {connection}\r\n\r\n'.format(
+                server=SERVER_HEADER, length=size,
+                connection='keep-alive' if keep_alive else 'close'))
+        self.stream = self.throttle.add(
+            self.transport, size, rate, chunk=A_CHUNK, jitter=jitter,
+            stall_at=stall_at if stall else None, stall=stall,
+            finished=lambda: self.endResponse(keep_alive))
+
+    def connectionLost(self, reason):
+        RequestProtocol.connectionLost(self, reason)
+        if self.stream is not None:
+            self.stream.cancel()
+
+
+class ThrottledResponseFactory(RequestFactory):
+    protocol = ThrottledResponseServer
+
+    def __init__(self, throttle, **kwargs):
+        RequestFactory.__init__(self, **kwargs)
+        self.throttle = throttle
+
+    def buildProtocol(self, addr):
+        p = RequestFactory.buildProtocol(self, addr)
+        p.throttle = self.throttle
+        return p
+
+
+# A chunk whose size line isn't hex.
+MALFORMED_CHUNK = 'zzzz\r\n' + 'a' * 16 + '\r\n'
+
+def _huge_body(size):
+    """ ``size`` bytes of 'a's, or an endless stream if size is None. """
+    if size is None:
+        return repeat(A_CHUNK)
+    full, rest = divmod(size, CHUNK_SIZE)
+    return chain(repeat(A_CHUNK, full), [A_CHUNK[:rest]] if rest else [])
+
+def _chunked_body(size, malformed_at=None):
+    """ ``size`` bytes of 'a's (endless if None) with chunked framing. If
+    ``malformed_at`` is set, a chunk with a malformed size line is sent once
+    that many bytes have been, and the body stops there. """
+    sent = 0
+    while size is None or sent < size:
+        if malformed_at is not None and sent >= malformed_at:
+            yield MALFORMED_CHUNK
+            return
+        n = CHUNK_SIZE
+        if size is not None:
+            n = min(n, size - sent)
+        if malformed_at is not None:
+            n = min(n, malformed_at - sent)
+        if n == CHUNK_SIZE:
+            yield A_CHUNK_FRAMED
         else:
-            retries_app.cache[key] = int(tries) - 1
-
-        if retries_app.cache[key] <= 0:
-            data = {
-                'key': key,
-                'tries_remaining': retries_app.cache[key],
-                'success': True
-            }
-            return Response(response=json.dumps(data), status=200,
-                            headers=json_hdr)
+            yield '{size:x}\r\n{chunk}\r\n'.format(size=n, chunk=A_CHUNK[:n])
+        sent += n
+    if malformed_at is not None:
+        yield MALFORMED_CHUNK
+        return
+    yield '0\r\n\r\n'
+
+class HugeBodyServer(RequestProtocol):
+    """ Send a body of ``?size=<int>`` bytes (1GB by default), or an endless
+    one with ``?size=inf``, as fast as the client will read it.
+
+    ``?chunked=1`` sends it with chunked transfer encoding, and
+    ``?malformed_at=<int>`` sends a chunk with an invalid size line after
+    that many bytes of the body. The body is written from shared buffers by
+    a push producer, so hamms' memory stays flat however big the body is.
+    """
+
+    PORT = 19
+    producer = None
+
+    def requestReceived(self, head):
+        query = head.query
+        try:
+            size = query.get('size', [DEFAULT_HUGE_SIZE])[0]
+            size = None if size == 'inf' else int(size)
+            chunked = query.get('chunked', ['0'])[0] not in ('0', 'false')
+            malformed_at = query.get('malformed_at', [None])[0]
+            if malformed_at is not None:
+                malformed_at = int(malformed_at)
+                chunked = True
+            if (size is not None and size < 0) or \
+                    (malformed_at is not None and malformed_at < 0):
+                raise ValueError(size, malformed_at)
+        except ValueError:
+            self.log(head.raw, status=400)
+            _bad_request(self.transport, 'Please pass a non-negative integer '
+                                         'or "inf" for size, and a '
+                                         'non-negative integer for '
+                                         'malformed_at')
+            return
+
+        self.log(head.raw, status=200)
+        # Only a body that ends properly can be followed by another request.
+        keep_alive = (size is not None and malformed_at is None and
+                      self.keepAlive(head))
+        headers = ['HTTP/1.1 200 OK',
+                   'Server: {server}'.format(server=SERVER_HEADER),
+                   'Content-Type: application/octet-stream']
+        if chunked:
+            headers.append('Transfer-Encoding: chunked')
+            body = _chunked_body(size, malformed_at)
         else:
-            msg = 'The server had an error. Try again {retry_times} more {time_p}'
-            time_p = 'time' if retries_app.cache[key] == 1 else 'times'
-            content = {
-                'error': msg.format(retry_times=retries_app.cache[key], time_p=time_p),
-                'tries_remaining': retries_app.cache[key],
-                'key': key,
-                'success': False,
-            }
-            return Response(response=json.dumps(content), status=500,
-                            headers=json_hdr)
-
-    @retries_app.route("/counters", methods=['POST'])
-    def reset():
-        key = request.values.get('key', 'default')
-        tries = request.values.get('tries', 3)
+            if size is not None:
+                headers.append('Content-Length: {size}'.format(size=size))
+            body = _huge_body(size)
+        headers.append('Connection: {connection}'.format(
+            connection='keep-alive' if keep_alive else 'close'))
+        self.transport.write('\r\n'.join(headers) + '\r\n\r\n')
+        self.producer = StreamingProducer(
+            self.transport, body, finished=lambda: self.endResponse(keep_alive))
+        self.producer.start()
+
+    def connectionLost(self, reason):
+        RequestProtocol.connectionLost(self, reason)
+        if self.producer is not None:
+            self.producer.stopProducing()
+
+
+class HugeBodyFactory(RequestFactory):
+    protocol = HugeBodyServer
+
+
+# Same headers httpbin's get_dict('headers') hides from its output.
+HIDDEN_HEADERS = frozenset([
+    'x-varnish', 'x-request-start', 'x-heroku-queue-depth', 'x-real-ip',
+    'x-forwarded-proto', 'x-forwarded-protocol', 'x-forwarded-ssl',
+    'x-heroku-queue-wait-time', 'x-forwarded-for', 'x-heroku-dynos-in-use',
+    'x-forwarded-port', 'runscope-service',
+])
+
+def _echo_headers(pairs):
+    """ Render (name, value) pairs the way httpbin's get_dict('headers')
+    does. """
+    headers = {}
+    for name, value in pairs:
+        if name.lower() in HIDDEN_HEADERS:
+            continue
+        name = '-'.join(part.capitalize() for part in name.split('-'))
+        headers[name] = value
+    return {'headers': headers}
+
+def _finite(value):
+    return not (math.isinf(value) or math.isnan(value))
+
+def _bad_request(transport, message):
+    body = json.dumps({'error': message, 'success': False})
+    transport.write('HTTP/1.1 400 Bad Request\r\n'
+                    'Server: {server}\r\n'
+                    'Content-Type: application/json\r\n'
+                    'Content-Length: {length}\r\n'
+                    'Connection: close\r\n'
+                    '\r\n{body}'.format(server=SERVER_HEADER,
+                                         length=len(body), body=body))
+    transport.loseConnection()
+
+# Header blocks up to this size are kept in LARGE_HEADER_BLOCKS; larger ones
+# are streamed in chunks instead.
+LARGE_HEADER_CACHE_LIMIT = 1024 * 1024
+LARGE_HEADER_BLOCKS = LRUCache(maxsize=16)
+
+def _header_lines(size, count):
+    """ Yield ``count`` Cookie header lines of ``size`` bytes each, in
+    pieces of about CHUNK_SIZE bytes. """
+    line_size = len('Cookie: \r\n') + size
+    if line_size <= CHUNK_SIZE:
+        line = 'Cookie: ' + A_CHUNK[:size] + '\r\n'
+        per_chunk = CHUNK_SIZE // line_size
+        full, rest = divmod(count, per_chunk)
+        group = line * per_chunk
+        for _ in xrange(full):
+            yield group
+        if rest:
+            yield line * rest
+        return
+    for _ in xrange(count):
+        yield 'Cookie: '
+        remaining = size
+        while remaining > CHUNK_SIZE:
+            yield A_CHUNK
+            remaining -= CHUNK_SIZE
+        yield A_CHUNK[:remaining] + '\r\n'
+
+def _header_block(size, count):
+    """ The rendered Cookie headers for (size, count), or None if the block
+    is too large to cache and should be streamed. """
+    if count * (size + len('Cookie: \r\n')) > LARGE_HEADER_CACHE_LIMIT:
+        return None
+    block = LARGE_HEADER_BLOCKS.get((size, count))
+    if block is None:
+        block = ''.join(_header_lines(size, count))
+        LARGE_HEADER_BLOCKS.set((size, count), block)
+    return block
+
+class LargeHeaderServer(RequestProtocol):
+    """ Respond with ``?count=<int>`` (default 1) Cookie headers that are each
+    ``?size=<int>`` bytes long (default 63KB), and echo the request headers
+    in the body.
+    """
+
+    PORT = 11
+
+    def requestReceived(self, head):
         try:
-            tries = int(tries)
-        except Exception:
-            return Response(status=400, headers=json_hdr, response=json.dumps({
-                'error': 'Please pass an integer number of tries',
-                'key': key,
-                'success': False,
-            }))
-
-        retries_app.cache[key] = tries
-
-        content = {
-            'key': key,
-            'tries_remaining': tries,
-            'success': True,
-        }
-        return Response(response=json.dumps(content), status=200,
-                        headers={'Content-Type': 'application/json'})
-
-    @retries_app.route("/counters", methods=['GET'])
-    def counter():
-        content = {'counters': retries_app.cache, 'success': True}
-        return Response(response=json.dumps(content), status=200,
-                        headers={'Content-Type': 'application/json'})
-
-    @retries_app.after_request
-    def retries_header(resp):
-        _log_flask(resp.status_code)
-        resp.headers['Server'] = 'hamms'
-        return resp
-
-    return retries_app
-
-@sleep_app.route("/")
-def sleep():
-    n = request.values.get('sleep', 5)
-    time.sleep(float(n))
-    hdrs = get_dict('headers')
-    return Response(response=json.dumps(hdrs), status=200,
-                    headers={'Content-Type': 'application/json'})
-
-@status_app.route("/")
-def status():
-    n = request.values.get('status', 200)
-    return status_code(int(n))
-
-@large_header_app.route("/")
-def large_header():
-    n = request.values.get('size', 63*1024)
-    req_headers = get_dict('headers')
-    resp_headers = {
-        'Content-Type': 'application/json',
-        'Cookie': 'a'*int(n)
-    }
-    return Response(response=json.dumps(req_headers), status=200,
-                    headers=resp_headers)
-
-@unparseable_app.route("/")
-def unparseable():
-
-    def _morse():
-        hdr = {'Content-Type': 'text/morse'}
-        message = " STOP ".join([
-            "DEAREST ANN",
-            "TIMES ARE HARD",
-            "MY TREADMILL DESK DOESNT RECLINE ALL THE WAY",
-            "THE KITCHEN HASNT HAD SOYLENT FOR TWO WHOLE DAYS",
-            "HOW IS ANYONE SUPPOSED TO PROGRAM IN THESE CONDITIONS",
-            "PLEASE SEND HELP",
-        ]) + " STOP"
-        morse_message = StringIO()
-        for i, letter in enumerate(message):
-            morse_message.write(morsedict[letter])
-        return Response(response=morse_message.getvalue(), headers=hdr)
-
-    if 'text/morse' not in request.accept_mimetypes:
-        return _morse()
-
-    elif not request.accept_mimetypes.accept_json:
-        hdr = {'Content-Type': 'application/json'}
-        resp = {
-            'status': 200,
-            'message': 'This is a JSON response. You did not ask for JSON data.',
-        }
-        return Response(response=json.dumps(resp), headers=hdr)
-
-    elif not request.accept_mimetypes.accept_html:
-        hdr = {'Content-Type': 'text/html'}
-        return Response(response="<!doctype html><html><head><title>Your API is Broken</title></head><body>This should be JSON.</body></html>", headers=hdr)
-
-    elif 'text/csv' not in request.accept_mimetypes:
-        hdr = {'Content-Type': 'text/csv'}
-        return Response(response="message,status\nThis is a CSV response that your code almost certainly can't parse", headers=hdr)
+            size = int(head.query.get('size', [63*1024])[0])
+            count = int(head.query.get('count', [1])[0])
+            if size < 0 or count < 0:
+                raise ValueError(size, count)
+        except ValueError:
+            self.log(head.raw, status=400)
+            _bad_request(self.transport, 'Please pass non-negative integer '
+                                         'values for size and count')
+            return
+
+        self.log(head.raw, status=200)
+        body = json.dumps(_echo_headers(head.headers))
+        keep_alive = self.keepAlive(head)
+        status = ('HTTP/1.1 200 OK\r\n'
+                  'Server: {server}\r\n'
+                  'Content-Type: application/json\r\n'
+                  'Content-Length: {length}\r\n'
+                  'Connection: {connection}\r\n'.format(
+                      server=SERVER_HEADER, length=len(body),
+                      connection='keep-alive' if keep_alive else 'close'))
+        block = _header_block(size, count)
+        if block is not None:
+            self.transport.writeSequence([status, block, '\r\n', body])
+            self.endResponse(keep_alive)
+        else:
+            pieces = chain([status], _header_lines(size, count),
+                           ['\r\n' + body])
+            IteratorProducer(self.transport, pieces,
+                             finished=lambda: self.endResponse(keep_alive)
+                             ).start()
+
+
+class LargeHeaderFactory(RequestFactory):
+    protocol = LargeHeaderServer
+
+# In the order Flask lists them in an Allow header.
+STATUS_METHODS = ('HEAD', 'OPTIONS', 'GET')
+
+# The date, and the Date header for it, that the status port sends.
+_date_header = [None, '']
+
+def _date():
+    now = int(time.time())
+    if _date_header[0] != now:
+        _date_header[:] = [now, 'Date: {0}\r\n'.format(
+            formatdate(now, usegmt=True))]
+    return _date_header[1]
+
+class StatusServer(RequestProtocol):
+    """ Answer like ``status_app``, from responses rendered once when the
+    factory is built, so each request costs one parse and one write rather
+    than a trip through the WSGI thread pool, Flask and httpbin.
+
+    Connections are kept alive whenever an HTTP/1.1 client asks, as Twisted
+    does for the web ports. """
+
+    PORT = 9
+
+    def keepAlive(self, head):
+        return head.version == 'HTTP/1.1' and RequestProtocol.keepAlive(
+            self, head)
+
+    def requestReceived(self, head):
+        started = time.time()
+        response = self.factory.respond(head)
+        self.log(head.raw, status=response.code)
+        keep_alive = self.keepAlive(head)
+        if head.version == 'HTTP/1.0':
+            # Twisted closes HTTP/1.0 connections without saying so.
+            version, connection = 'HTTP/1.0', ''
+        else:
+            version = 'HTTP/1.1'
+            connection = '' if keep_alive else 'Connection: close\r\n'
+        self.transport.write(''.join([
+            version, ' ', response.status, '\r\n', _date(), connection,
+            response.headers, '\r\n',
+            '' if head.method == 'HEAD' else response.body]))
+        self.factory.record(response.code, started)
+        self.endResponse(keep_alive)
+
+
+class StatusFactory(RequestFactory):
+    """ Render every response :class:`StatusServer` is likely to send.
 
+    :param metrics: a :class:`~hamms.metrics.ServerMetrics` to count
+        requests in, under ``port``; optional.
+    """
+
+    protocol = StatusServer
+
+    def __init__(self, metrics=None, port=None, **kwargs):
+        # Rendering needs Flask, so it's only imported for this port.
+        from .apps import StatusTable
+        kwargs['keep_alive'] = True
+        RequestFactory.__init__(self, **kwargs)
+        self.table = StatusTable()
+        self.metrics = metrics
+        self.port = port
+        self.counters = {}
+        if metrics is not None:
+            self.duration = metrics.request_duration.labels(port, 'status')
+
+    def buildProtocol(self, addr):
+        p = RequestFactory.buildProtocol(self, addr)
+        p.factory = self
+        return p
+
+    def respond(self, head):
+        """ The :class:`~hamms.apps.StatusResponse` for the request
+        ``head``. """
+        table = self.table
+        if head.path != '/':
+            return table.not_found
+        if head.method not in STATUS_METHODS:
+            return table.not_allowed
+        if head.method == 'OPTIONS':
+            return table.options
+        query = head.target.partition('?')[2]
+        values = urlparse.parse_qs(query, keep_blank_values=True) if query \
+            else {}
+        try:
+            code = int(values.get('status', [200])[0])
+        except ValueError:
+            return table.error
+        return table.get(code)
+
+    def record(self, code, started):
+        if self.metrics is None:
+            return
+        counter = self.counters.get(code)
+        if counter is None:
+            counter = self.counters[code] = self.metrics.requests.labels(
+                self.port, 'status', code)
+        counter.inc()
+        self.duration.observe(time.time() - started)
+
+MORSE_MESSAGE = " STOP ".join([
+    "DEAREST ANN",
+    "TIMES ARE HARD",
+    "MY TREADMILL DESK DOESNT RECLINE ALL THE WAY",
+    "THE KITCHEN HASNT HAD SOYLENT FOR TWO WHOLE DAYS",
+    "HOW IS ANYONE SUPPOSED TO PROGRAM IN THESE CONDITIONS",
+    "PLEASE SEND HELP",
+]) + " STOP"
+
+# Every body the unparseable port can send, rendered once:
+# (content type, body).
+UNPARSEABLE_MORSE = ('text/morse', morse.encode(MORSE_MESSAGE))
+UNPARSEABLE_JSON = ('application/json', json.dumps({
+    'status': 200,
+    'message': 'This is a JSON response. You did not ask for JSON data.',
+}))
+UNPARSEABLE_HTML = ('text/html', "<!doctype html><html><head><title>Your API is Broken</title></head><body>This should be JSON.</body></html>")
+UNPARSEABLE_CSV = ('text/csv', "message,status\nThis is a CSV response that your code almost certainly can't parse")
+
+# Accept header value -> one of the variants above.
+UNPARSEABLE_VARIANTS = LRUCache(maxsize=256)
+
+def unparseable_variant(accept):
+    """ Pick a content type the Accept header value ``accept`` can't handle.
+    """
+    variant = UNPARSEABLE_VARIANTS.get(accept)
+    if variant is not None:
+        return variant
+
+    # Imported here so the raw ports can start without werkzeug.
+    from werkzeug.datastructures import MIMEAccept
+    from werkzeug.http import parse_accept_header
+    accept_mimetypes = parse_accept_header(accept, MIMEAccept)
+    if 'text/morse' not in accept_mimetypes:
+        variant = UNPARSEABLE_MORSE
+    elif not accept_mimetypes.accept_json:
+        variant = UNPARSEABLE_JSON
+    elif not accept_mimetypes.accept_html:
+        variant = UNPARSEABLE_HTML
+    elif 'text/csv' not in accept_mimetypes:
+        variant = UNPARSEABLE_CSV
     else:
         # */* or similar, return morse.
-        return _morse()
-
-@toolong_content_app.route("/")
-def toolong():
-    r = Response()
-    r.automatically_set_content_length = False
-    r.headers['Content-Length'] = 2300
-    if (request.accept_mimetypes.best == 'application/json' or
-        request.accept_mimetypes.best == '*/*'):
-        r.headers['Content-Type'] = 'application/json'
-        r.set_data(INCOMPLETE_JSON)
-    elif request.accept_mimetypes.best == 'text/html':
-        r.headers['Content-Type'] = 'text/html'
-        r.set_data(INCOMPLETE_HTML)
-    elif request.accept_mimetypes.best == 'text/plain':
-        r.headers['Content-Type'] = 'text/plain'
-        r.set_data(INCOMPLETE_PLAIN)
-    elif (request.accept_mimetypes.best == 'text/xml' or
-          request.accept_mimetypes.best == 'application/xml'):
-        r.headers['Content-Type'] = 'text/xml'
-        r.set_data(INCOMPLETE_XML)
-    else:
-        r.headers['Content-Type'] = 'application/json'
-        r.set_data(INCOMPLETE_JSON)
-    return r
-
-def _get_port_from_url(url):
-    urlo = urlparse.urlparse(url)
+        variant = UNPARSEABLE_MORSE
+    UNPARSEABLE_VARIANTS.set(accept, variant)
+    return variant
+
+def parse_args(argv=None):
+    return _parser().parse_args(argv)
+
+def _parser():
+    parser = argparse.ArgumentParser(
+        prog='hamms', description='Malformed servers to test your HTTP client')
+    parser.add_argument('--port', type=int, default=BASE_PORT,
+                        help='first port in the range hamms listens on, or 0 '
+                             'to listen on ports the OS picks')
+    parser.add_argument('--min-threads', type=int,
+                        default=DEFAULT_MIN_THREADS,
+                        help="minimum number of threads in each app's pool")
+    parser.add_argument('--max-threads', type=int,
+                        default=DEFAULT_MAX_THREADS,
+                        help="maximum number of threads in each app's pool")
+    parser.add_argument('--pool-stats-interval', type=float, default=0,
+                        help='log thread pool statistics every N seconds')
+    parser.add_argument('--overrun-size', type=int,
+                        default=DEFAULT_OVERRUN_SIZE,
+                        help='bytes sent past Content-Length on port 10')
+    parser.add_argument('--retries-max-keys', type=int,
+                        default=DEFAULT_MAX_ENTRIES,
+                        help='maximum number of retry counters to keep')
+    parser.add_argument('--retries-ttl', type=float, default=DEFAULT_TTL,
+                        help='seconds a retry counter lives after its last '
+                             'update')
+    parser.add_argument('--retries-db',
+                        help='keep retry counters in this SQLite database, '
+                             'shared with other hamms processes')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='run N worker processes sharing every port')
+    parser.add_argument('--reuse-port', action='store_true',
+                        help='bind ports with SO_REUSEPORT so other '
+                             'processes can bind them too')
+    parser.add_argument('--log-sample', action='append', metavar='PORT=RATE',
+                        help='only log a RATE fraction of requests to the '
+                             'port at offset PORT, e.g. 13=0.01; repeatable')
+    parser.add_argument('--access-log', metavar='PATH',
+                        help='record every request as a line of JSON in '
+                             'PATH; {pid} is replaced with the process id')
+    parser.add_argument('--access-log-max-bytes', type=int,
+                        default=DEFAULT_ACCESS_LOG_MAX_BYTES,
+                        help='rotate the access log once it is this big')
+    parser.add_argument('--access-log-backups', type=int,
+                        default=DEFAULT_ACCESS_LOG_BACKUPS,
+                        help='number of rotated access logs to keep')
+    parser.add_argument('--keep-alive', action='store_true',
+                        help='honor Connection: keep-alive on ports 11 and '
+                             '13; ?keepalive=1 works either way')
+    parser.add_argument('--keep-alive-requests', type=int,
+                        default=DEFAULT_KEEP_ALIVE_REQUESTS,
+                        help='close a kept-alive connection after this many '
+                             'responses')
+    parser.add_argument('--keep-alive-timeout', type=float,
+                        default=DEFAULT_KEEP_ALIVE_TIMEOUT,
+                        help='close a kept-alive connection after this many '
+                             'idle seconds')
+    parser.add_argument('--single-port', action='store_true',
+                        help='only listen on the dispatch port (offset 17) '
+                             'and the admin port')
+    parser.add_argument('--ports', metavar='MODES',
+                        help='comma separated modes to listen for, by name '
+                             'or port offset, e.g. status,12 (default: all)')
+    parser.add_argument('--chaos-weights', metavar='MODE=WEIGHT,...',
+                        help='how often the chaos port (offset 20) picks each '
+                             'mode, e.g. status=3,drop-random=1 (default: '
+                             'every mode equally, but never huge or '
+                             'throttle)')
+    parser.add_argument('--chaos-seed', type=int,
+                        help="seed for the chaos port's schedule, to repeat "
+                             "an earlier run (default: random, and logged)")
+    parser.add_argument('--record-decisions', metavar='PATH',
+                        help='record the choices the drop-random and chaos '
+                             'ports make in PATH; {pid} is replaced with the '
+                             'process id')
+    parser.add_argument('--replay-decisions', metavar='PATH',
+                        help='make the choices recorded in PATH with '
+                             '--record-decisions again, instead of random ones')
+    parser.add_argument('--backend', choices=BACKENDS, default='twisted',
+                        help='event loop to run the ports on; asyncio only '
+                             'runs the raw modes that need nothing else from '
+                             'Twisted (offsets 1-7, 13 and 16)')
+    parser.add_argument('--loop', dest='event_loop', default='auto',
+                        choices=('auto', 'asyncio', 'uvloop'),
+                        help='with --backend asyncio, the event loop to use; '
+                             'auto uses uvloop if it is installed')
+    parser.add_argument('--ports-file', metavar='PATH',
+                        help='once listening, write the port each mode '
+                             'listens on to PATH, as JSON')
+    return parser
+
+def _parse_log_sample(values):
+    rates = {}
+    for value in values or []:
+        port, rate = value.split('=', 1)
+        rates[int(port)] = float(rate)
+    return rates
+
+def _parse_chaos_weights(value):
+    if not value:
+        return None
+    weights = {}
+    for pair in value.split(','):
+        mode, weight = pair.split('=', 1)
+        weights[mode] = float(weight)
+    return weights
+
+def decision_source(record=None, replay=None, clock=None):
+    """ The :class:`~hamms.decisions.Decisions` to make choices with: one
+    that records them in the file ``record``, replays them from the file
+    ``replay``, or neither. """
+    if record and replay:
+        raise ValueError("can't record decisions while replaying them")
+    if record:
+        return DecisionLog(record, clock=clock)
+    if replay:
+        return DecisionReplay(replay)
+    return Decisions()
+
+def _worker_argv(options):
+    """ Command line arguments that start a worker with ``options``. """
+    # Option name -> the flag that sets it, which isn't always the name.
+    flags = dict((action.dest, action.option_strings[0])
+                 for action in _parser()._actions if action.option_strings)
+    argv = ['--reuse-port']
+    for name, value in sorted(options.items()):
+        if name in ('workers', 'reuse_port') or value is None or value is False:
+            continue
+        flag = flags[name]
+        if value is True:
+            argv.append(flag)
+        elif isinstance(value, list):
+            for item in value:
+                argv.extend([flag, str(item)])
+        else:
+            argv.extend([flag, str(value)])
+    return argv
+
+def _log_pool_stats(listeners):
+    for name, stats in sorted(listeners.pool_stats().items()):
+        logger.info("pool {name}: {busy}/{max_threads} busy, {queued} queued, "
+                    "avg wait {wait_avg:.4f}s, max wait {wait_max:.4f}s".format(
+                        name=name, **stats))
+
+def _write_ports_file(path, mode_ports):
+    # Written under another name and renamed, so anyone polling for the file
+    # never reads half of it.
+    partial = path + '.partial'
+    with open(partial, 'w') as f:
+        json.dump(mode_ports, f, sort_keys=True)
+    os.rename(partial, path)
+
+def _run_loop(port, modes, keep_alive, keep_alive_requests,
+              keep_alive_timeout, ports_file, use_uvloop,
+              record_decisions=None, replay_decisions=None):
+    """ Serve the raw ports on an asyncio event loop until interrupted. """
+    from . import aio
+    listener = log_in_background()
+    loop = aio.new_event_loop(use_uvloop)
+    decisions = decision_source(record_decisions, replay_decisions,
+                                aio.LoopClock(loop))
     try:
-        host, port = urlo.netloc.split(':')
-        return port
-    except Exception:
-        return "<port>"
-
-def _log_flask(status):
-    port = _get_port_from_url(request.url)
-    url_line = "{method} {url} HTTP/1.0".format(
-        method=request.method.upper(), url=request.full_path)
-    ua = request.headers.get('user-agent', '')
-    logger.info(_log(request.remote_addr, port, url_line, status, ua=ua))
-
-@sleep_app.after_request
-def log_sleep(resp):
-    _log_flask(resp.status_code)
-    return resp
-
-@status_app.after_request
-def log_status(resp):
-    _log_flask(resp.status_code)
-    return resp
-
-@large_header_app.after_request
-def log_large_header(resp):
-    _log_flask(resp.status_code)
-    return resp
-
-def main(port=BASE_PORT):
+        listeners = loop.run_until_complete(aio.listen(
+            loop, port, modes, keep_alive=keep_alive,
+            keep_alive_requests=keep_alive_requests,
+            keep_alive_timeout=keep_alive_timeout, decisions=decisions))
+        logger.info("Listening on {name}...".format(name=aio.loop_name(loop)))
+        if not port:
+            logger.info("Ports: {ports}".format(
+                ports=json.dumps(listeners.mode_ports(), sort_keys=True)))
+        if ports_file:
+            _write_ports_file(ports_file, listeners.mode_ports())
+        # Stop as the reactor does, so the decision log is written out.
+        loop.add_signal_handler(signal.SIGTERM, loop.stop)
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        listeners.close()
+    finally:
+        decisions.close()
+        loop.close()
+        listener.stop()
+
+def main(port=BASE_PORT, min_threads=DEFAULT_MIN_THREADS,
+         max_threads=DEFAULT_MAX_THREADS, pool_stats_interval=0,
+         overrun_size=DEFAULT_OVERRUN_SIZE,
+         retries_max_keys=DEFAULT_MAX_ENTRIES, retries_ttl=DEFAULT_TTL,
+         retries_db=None, workers=1, reuse_port=False, log_sample=None,
+         access_log=None,
+         access_log_max_bytes=DEFAULT_ACCESS_LOG_MAX_BYTES,
+         access_log_backups=DEFAULT_ACCESS_LOG_BACKUPS, keep_alive=False,
+         keep_alive_requests=DEFAULT_KEEP_ALIVE_REQUESTS,
+         keep_alive_timeout=DEFAULT_KEEP_ALIVE_TIMEOUT, single_port=False,
+         ports=None, ports_file=None, backend='twisted', event_loop='auto',
+         chaos_weights=None, chaos_seed=None, record_decisions=None,
+         replay_decisions=None):
+    # Captured first thing, so it only holds the arguments.
+    options = dict(locals())
     logging.basicConfig()
+    modes = ports.split(',') if ports else None
+    # Fail on a bad name before starting any workers.
+    select_modes(modes)
+    weights = _chaos_weights(_parse_chaos_weights(chaos_weights))
+    LOG_SAMPLE_RATES.update(_parse_log_sample(log_sample))
+    if backend == 'asyncio':
+        if workers > 1 or reuse_port:
+            raise ValueError("the asyncio backend doesn't support --workers "
+                             "or --reuse-port")
+        _run_loop(port, modes, keep_alive, keep_alive_requests,
+                  keep_alive_timeout, ports_file, UVLOOP_CHOICES[event_loop],
+                  record_decisions, replay_decisions)
+        return
+    if workers > 1:
+        if not port:
+            raise ValueError("--workers needs a fixed --port")
+        if replay_decisions:
+            # Which worker accepts a connection is up to the kernel.
+            raise ValueError("--replay-decisions needs a single worker")
+        if record_decisions and '{pid}' not in record_decisions:
+            raise ValueError("--record-decisions needs a {pid} placeholder "
+                             "to run several workers")
+        if retries_db is None:
+            # Workers need to share retry counters to keep their semantics.
+            options['retries_db'] = os.path.join(tempfile.mkdtemp(),
+                                                 'retries.db')
+        if access_log and '{pid}' not in access_log:
+            # Rotation renames the file out from under the other workers.
+            logger.warning("--access-log has no {pid} placeholder, so every "
+                           "worker will write to the same file")
+        logger.info("Starting {n} workers...".format(n=workers))
+        Supervisor(_worker_argv(options), workers).run()
+        return
+
+    listener = log_in_background()
+    reactor.addSystemEventTrigger('after', 'shutdown', listener.stop)
     logger.info("Listening...")
-    listen(reactor, port)
+    retry_cache = retry_store(retries_db, retries_max_keys, retries_ttl)
+    requests_log = None
+    if access_log:
+        requests_log = AccessLog(access_log, max_bytes=access_log_max_bytes,
+                                 backup_count=access_log_backups)
+    listeners = listen(reactor, port, retry_cache=retry_cache,
+                       min_threads=min_threads, max_threads=max_threads,
+                       overrun_size=overrun_size, reuse_port=reuse_port,
+                       access_log=requests_log, keep_alive=keep_alive,
+                       keep_alive_requests=keep_alive_requests,
+                       keep_alive_timeout=keep_alive_timeout,
+                       single_port=single_port, modes=modes,
+                       chaos_weights=weights, chaos_seed=chaos_seed,
+                       decisions=decision_source(record_decisions,
+                                                 replay_decisions))
+    if not port:
+        # The ports were picked by the OS, so tell whoever started us.
+        logger.info("Ports: {ports}".format(
+            ports=json.dumps(listeners.mode_ports(), sort_keys=True)))
+    if ports_file:
+        _write_ports_file(ports_file, listeners.mode_ports())
+    if pool_stats_interval > 0:
+        task.LoopingCall(_log_pool_stats, listeners).start(
+            pool_stats_interval, now=False)
     reactor.run()
 
 
 if __name__ == "__main__":
-    main()
+    main(**vars(parse_args()))
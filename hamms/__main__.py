@@ -1,5 +1,5 @@
-from hamms import main
+from hamms import main, parse_args
 
 
 if __name__ == "__main__":
-    main()
+    main(**vars(parse_args()))
@@ -0,0 +1,192 @@
+import json
+import os
+try:
+    from Queue import Empty, Full, Queue
+except ImportError:
+    from queue import Empty, Full, Queue
+from threading import Thread
+import time
+
+from twisted.internet.error import ConnectionDone
+from twisted.protocols.policies import ProtocolWrapper, WrappingFactory
+
+DEFAULT_MAX_BYTES = 100 * 1024 * 1024
+DEFAULT_BACKUP_COUNT = 5
+DEFAULT_QUEUE_SIZE = 100000
+DEFAULT_BATCH_SIZE = 1000
+
+
+class AccessLog(object):
+    """ Write one JSON object per request to a rotating file.
+
+    :meth:`record` only puts the record on a bounded queue; a background
+    thread serializes records and writes them in batches. If the queue is
+    full, because the disk is stalled, records are dropped and counted in
+    ``dropped`` rather than blocking the caller.
+
+    :param str path: file to write to. ``{pid}`` is replaced with the process
+        id, so several workers can log side by side.
+    :param int max_bytes: rotate the file once it grows past this size.
+    :param int backup_count: number of rotated files to keep.
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES,
+                 backup_count=DEFAULT_BACKUP_COUNT,
+                 queue_size=DEFAULT_QUEUE_SIZE, batch_size=DEFAULT_BATCH_SIZE):
+        self.path = path.format(pid=os.getpid())
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.batch_size = batch_size
+        self.queue = Queue(queue_size)
+        self.dropped = 0
+        self.written = 0
+        self.file = open(self.path, 'a')
+        self.thread = Thread(target=self._run, name='hamms-access-log')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def record(self, entry):
+        try:
+            self.queue.put_nowait(entry)
+        except Full:
+            self.dropped += 1
+
+    def close(self):
+        """ Write out everything that is queued, then close the file. """
+        self.queue.put(None)
+        self.thread.join()
+
+    def stats(self):
+        return {
+            'written': self.written,
+            'dropped': self.dropped,
+            'queued': self.queue.qsize(),
+        }
+
+    def _run(self):
+        while True:
+            # Block for the first record, then take whatever else is
+            # already waiting, up to batch_size.
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            closing = None in batch
+            lines = [json.dumps(entry) for entry in batch if entry is not None]
+            if lines:
+                self.file.write('\n'.join(lines) + '\n')
+                self.file.flush()
+                self.written += len(lines)
+                if self.file.tell() >= self.max_bytes:
+                    self._rotate()
+            if closing:
+                self.file.close()
+                return
+
+    def _rotate(self):
+        self.file.close()
+        if self.backup_count > 0:
+            for i in range(self.backup_count - 1, 0, -1):
+                src = '{path}.{i}'.format(path=self.path, i=i)
+                if os.path.exists(src):
+                    os.rename(src, '{path}.{i}'.format(path=self.path, i=i + 1))
+            os.rename(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+        self.file = open(self.path, 'a')
+
+
+def _peer(transport):
+    try:
+        return transport.getPeer().host
+    except Exception:
+        return None
+
+
+class AccessLogProtocol(ProtocolWrapper):
+    """ Count the bytes a raw protocol writes, and record the connection in
+    the access log when it closes. """
+
+    def __init__(self, factory, wrappedProtocol):
+        ProtocolWrapper.__init__(self, factory, wrappedProtocol)
+        self.started = time.time()
+        self.bytes_sent = 0
+        self.closed_by_server = False
+        self.port = None
+
+    def makeConnection(self, transport):
+        # The socket is gone by the time connectionLost runs.
+        self.port = transport.getHost().port
+        ProtocolWrapper.makeConnection(self, transport)
+
+    def write(self, data):
+        self.bytes_sent += len(data)
+        ProtocolWrapper.write(self, data)
+
+    def writeSequence(self, data):
+        self.bytes_sent += sum(len(piece) for piece in data)
+        ProtocolWrapper.writeSequence(self, data)
+
+    def loseConnection(self):
+        self.closed_by_server = True
+        ProtocolWrapper.loseConnection(self)
+
+    def abortConnection(self):
+        self.closed_by_server = True
+        self.transport.abortConnection()
+
+    def connectionLost(self, reason):
+        if self.closed_by_server:
+            close_reason = 'server'
+        elif reason.check(ConnectionDone):
+            close_reason = 'client'
+        else:
+            close_reason = reason.type.__name__
+        protocol = self.wrappedProtocol
+        self.factory.access_log.record({
+            'time': self.started,
+            'port': self.port,
+            'mode': self.factory.mode,
+            'peer': _peer(self),
+            'request': getattr(protocol, 'request_line', None),
+            'status': getattr(protocol, 'status', None),
+            'bytes_sent': self.bytes_sent,
+            'duration': time.time() - self.started,
+            'close_reason': close_reason,
+        })
+        ProtocolWrapper.connectionLost(self, reason)
+
+
+class AccessLogFactory(WrappingFactory):
+    """ Wrap a raw protocol factory so every connection is recorded in
+    ``access_log`` under the name ``mode``. """
+
+    protocol = AccessLogProtocol
+
+    def __init__(self, wrappedFactory, access_log, mode):
+        WrappingFactory.__init__(self, wrappedFactory)
+        self.access_log = access_log
+        self.mode = mode
+
+    def logPrefix(self):
+        return self.wrappedFactory.logPrefix()
+
+
+def request_record(request, mode, close_reason='finished'):
+    """ The access log record for a twisted.web request. """
+    started = getattr(request, 'hamms_started', None) or time.time()
+    return {
+        'time': started,
+        'port': request.getHost().port,
+        'mode': mode,
+        'peer': request.getClientIP(),
+        'request': '{method} {uri} {version}'.format(
+            method=request.method, uri=request.uri,
+            version=request.clientproto),
+        'status': request.code,
+        'bytes_sent': request.sentLength,
+        'duration': time.time() - started,
+        'close_reason': close_reason,
+    }
@@ -0,0 +1,302 @@
+""" The raw ports on an asyncio event loop instead of the Twisted reactor.
+
+For test suites that already run an asyncio loop, so they don't need a
+reactor in a second thread::
+
+    listeners = loop.run_until_complete(hamms.aio.listen(loop, base_port=0))
+    port = listeners.mode_ports()['drop-random']
+
+or, from a coroutine, ``listeners = await hamms.aio.listen(loop)``.
+``HammsServer(backend='asyncio')`` runs them on a loop of its own instead.
+
+The modes are the same protocol classes the reactor runs. Each connection
+is an asyncio protocol that hands its events to one of them, with a
+transport and clock that map the few Twisted calls they make onto the loop.
+Only the modes in :data:`hamms.ASYNCIO_MODES` can run this way; the others
+need twisted.web or Twisted's producers.
+
+On Python 2, asyncio's backport, trollius, is used. :func:`new_event_loop`
+picks uvloop when it's installed.
+"""
+import functools
+import socket
+
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        from . import ASYNCIO_MISSING
+        raise ImportError(ASYNCIO_MISSING)
+
+from twisted.internet.address import IPv4Address
+from twisted.internet.error import ConnectionDone, ConnectionLost
+from twisted.python.failure import Failure
+
+from . import (ASYNCIO_MODES, BASE_PORT, DEFAULT_KEEP_ALIVE_REQUESTS,
+               DEFAULT_KEEP_ALIVE_TIMEOUT, MODES, DropRandomRequestsFactory,
+               EmptyStringTerminateImmediatelyFactory,
+               EmptyStringTerminateOnReceiveFactory,
+               FiveSecondByteResponseFactory, IncompleteResponseFactory,
+               ListenForeverFactory,
+               MalformedStringTerminateImmediatelyFactory,
+               MalformedStringTerminateOnReceiveFactory,
+               ThirtySecondByteResponseFactory, select_modes)
+from .trickle import TrickleScheduler
+
+def new_event_loop(use_uvloop=None):
+    """ A new event loop: uvloop's if it's installed, asyncio's otherwise.
+    Pass ``use_uvloop=True`` to fail if uvloop isn't installed, or False to
+    always use asyncio's. """
+    if use_uvloop is not False:
+        try:
+            import uvloop
+        except ImportError:
+            if use_uvloop:
+                raise
+        else:
+            return uvloop.new_event_loop()
+    return asyncio.new_event_loop()
+
+
+def loop_name(loop):
+    """ 'uvloop' or 'asyncio', for logs and benchmark reports. """
+    if type(loop).__module__.startswith('uvloop'):
+        return 'uvloop'
+    return 'asyncio'
+
+
+class DelayedCall(object):
+    """ An asyncio timer handle, with the parts of Twisted's DelayedCall
+    that LoopingCall and TimeoutMixin use. """
+
+    def __init__(self, loop, delay, func):
+        self.loop = loop
+        self.func = func
+        self.called = False
+        self.cancelled = False
+        self.handle = loop.call_later(delay, self._call)
+
+    def _call(self):
+        self.called = True
+        self.func()
+
+    def active(self):
+        return not (self.called or self.cancelled)
+
+    def cancel(self):
+        self.cancelled = True
+        self.handle.cancel()
+
+    def reset(self, delay):
+        self.handle.cancel()
+        self.handle = self.loop.call_later(delay, self._call)
+
+
+class LoopClock(object):
+    """ An IReactorTime provider that schedules calls on an asyncio loop, for
+    the schedulers and timeouts the modes use. """
+
+    def __init__(self, loop):
+        self.loop = loop
+
+    def seconds(self):
+        return self.loop.time()
+
+    def callLater(self, delay, func, *args, **kwargs):
+        return DelayedCall(self.loop, delay,
+                           functools.partial(func, *args, **kwargs))
+
+
+def _address(pair):
+    return IPv4Address('TCP', pair[0], pair[1])
+
+
+class LoopTransport(object):
+    """ An asyncio transport, with the parts of Twisted's ITransport that
+    the modes use. """
+
+    disconnecting = False
+
+    def __init__(self, loop, transport):
+        self.loop = loop
+        self.transport = transport
+        # Set while the protocol's connectionMade runs. trollius starts
+        # reading only after connection_made returns, even if the transport
+        # was closed, and then reads from whatever socket reuses the fd.
+        self.starting = False
+
+    def write(self, data):
+        if data and not self.disconnecting:
+            self.transport.write(data)
+
+    def writeSequence(self, data):
+        self.write(''.join(data))
+
+    def loseConnection(self):
+        # close() still writes out anything that's buffered.
+        if not self.disconnecting:
+            self.disconnecting = True
+            if not self.transport.get_write_buffer_size():
+                # Like the reactor, send the FIN now rather than when the
+                # loop gets around to closing the socket.
+                try:
+                    self.transport.get_extra_info('socket').shutdown(
+                        socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+            if self.starting:
+                self.loop.call_soon(self.transport.close)
+            else:
+                self.transport.close()
+
+    def abortConnection(self):
+        self.disconnecting = True
+        self.transport.abort()
+
+    def getPeer(self):
+        return _address(self.transport.get_extra_info('peername'))
+
+    def getHost(self):
+        return _address(self.transport.get_extra_info('sockname'))
+
+
+class BridgeProtocol(asyncio.Protocol):
+    """ Run a protocol from the Twisted ``factory`` on an asyncio
+    connection. """
+
+    def __init__(self, factory, clock):
+        self.factory = factory
+        self.clock = clock
+        self.protocol = None
+
+    def connection_made(self, transport):
+        self.transport = LoopTransport(self.clock.loop, transport)
+        self.protocol = self.factory.buildProtocol(self.transport.getPeer())
+        # TimeoutMixin schedules its timeouts with this.
+        self.protocol.callLater = self.clock.callLater
+        self.transport.starting = True
+        try:
+            self.protocol.makeConnection(self.transport)
+        finally:
+            self.transport.starting = False
+
+    def data_received(self, data):
+        if not self.transport.disconnecting:
+            self.protocol.dataReceived(data)
+
+    def eof_received(self):
+        # Returning nothing closes the connection, as the reactor does when
+        # a client half-closes.
+        return None
+
+    def connection_lost(self, exc):
+        self.transport.disconnecting = True
+        if exc is None:
+            reason = Failure(ConnectionDone())
+        else:
+            reason = Failure(ConnectionLost(str(exc)))
+        self.protocol.connectionLost(reason)
+
+
+class Listeners(object):
+    """ Handles to everything :func:`listen` started.
+
+    :ivar dict servers: asyncio servers, keyed by port offset.
+    :ivar trickle: the :class:`~hamms.trickle.TrickleScheduler` shared by the
+        slow-byte ports, driven by the loop.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.clock = LoopClock(loop)
+        self.trickle = TrickleScheduler(clock=self.clock)
+        self.servers = {}
+
+    def mode_ports(self):
+        """ Mode name -> the port number it listens on. """
+        return dict((name, self.servers[offset].sockets[0].getsockname()[1])
+                    for name, offset in MODES if offset in self.servers)
+
+    def close(self):
+        """ Stop listening. Connections that are already open stay open. """
+        for server in self.servers.values():
+            server.close()
+
+
+def listen(loop=None, base_port=BASE_PORT, modes=None, keep_alive=False,
+           keep_alive_requests=DEFAULT_KEEP_ALIVE_REQUESTS,
+           keep_alive_timeout=DEFAULT_KEEP_ALIVE_TIMEOUT, decisions=None):
+    """ Listen on the ports for ``modes`` (by default, every mode in
+    :data:`hamms.ASYNCIO_MODES`) on ``loop``, as :func:`hamms.listen` does on
+    the reactor. Returns a future for the :class:`Listeners`, done once every
+    port is listening.
+
+    The drop-random port decides which requests to drop through
+    ``decisions``, a :class:`~hamms.decisions.Decisions`. Give a
+    :class:`~hamms.decisions.DecisionLog` a :class:`LoopClock` to flush with.
+
+    :raises ValueError: if a mode can't run on asyncio.
+    """
+    if loop is None:
+        loop = asyncio.get_event_loop()
+    selected = ASYNCIO_MODES if modes is None else select_modes(modes)
+    unsupported = selected - ASYNCIO_MODES
+    if unsupported:
+        raise ValueError("the asyncio backend can't run: {0}".format(
+            ', '.join(sorted(unsupported))))
+    listeners = Listeners(loop)
+    keep_alive = dict(keep_alive=keep_alive,
+                      max_requests=keep_alive_requests,
+                      idle_timeout=keep_alive_timeout)
+    builders = {
+        'listen-forever': ListenForeverFactory,
+        'empty-immediate': EmptyStringTerminateImmediatelyFactory,
+        'empty-on-receive': EmptyStringTerminateOnReceiveFactory,
+        'malformed-immediate': MalformedStringTerminateImmediatelyFactory,
+        'malformed-on-receive': MalformedStringTerminateOnReceiveFactory,
+        'slow-byte': lambda: FiveSecondByteResponseFactory(listeners.trickle),
+        'very-slow-byte':
+            lambda: ThirtySecondByteResponseFactory(listeners.trickle),
+        'drop-random': lambda: DropRandomRequestsFactory(decisions,
+                                                         **keep_alive),
+        'incomplete': IncompleteResponseFactory,
+    }
+
+    offsets = []
+    starting = []
+    for mode, offset in MODES:
+        if mode not in selected:
+            continue
+        factory = builders[mode]()
+        port = base_port + offset if base_port else 0
+        offsets.append(offset)
+        starting.append(asyncio.ensure_future(loop.create_server(
+            functools.partial(BridgeProtocol, factory, listeners.clock),
+            '0.0.0.0', port), loop=loop))
+
+    result = asyncio.Future(loop=loop)
+    if not starting:
+        result.set_result(listeners)
+        return result
+
+    def close(future):
+        if not future.cancelled() and future.exception() is None:
+            future.result().close()
+
+    def started(future):
+        if future.cancelled():
+            result.cancel()
+        elif future.exception() is not None:
+            # Don't leave the other ports listening, including ones that
+            # are still starting.
+            for server in starting:
+                server.add_done_callback(close)
+            result.set_exception(future.exception())
+        else:
+            listeners.servers.update(zip(offsets, future.result()))
+            result.set_result(listeners)
+
+    asyncio.gather(*starting).add_done_callback(started)
+    return result
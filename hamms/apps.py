@@ -0,0 +1,252 @@
+""" The Flask apps behind the retries and too-long-content ports, and the
+one the status port is rendered from. Flask, werkzeug and httpbin are only
+imported once :func:`hamms.listen` needs one of these. """
+import json
+import urlparse
+
+from flask import Flask, current_app, request, Response
+from httpbin.helpers import status_code
+from twisted.web.http import NO_BODY_CODES
+from werkzeug.exceptions import (InternalServerError, MethodNotAllowed,
+                                 NotFound)
+from werkzeug.routing import Rule
+
+from . import (INCOMPLETE_HTML, INCOMPLETE_JSON, INCOMPLETE_PLAIN,
+               INCOMPLETE_XML, SERVER_HEADER, STATUS_METHODS, _log,
+               _should_log)
+
+
+# Header names twisted.web doesn't just capitalize word by word.
+HEADER_CASES = {
+    'content-md5': 'Content-MD5',
+    'dnt': 'DNT',
+    'etag': 'ETag',
+    'p3p': 'P3P',
+    'te': 'TE',
+    'www-authenticate': 'WWW-Authenticate',
+    'x-xss-protection': 'X-XSS-Protection',
+}
+
+def _header_case(name):
+    """ ``name`` cased the way twisted.web writes it. """
+    name = name.lower()
+    return HEADER_CASES.get(name) or '-'.join(part.capitalize()
+                                              for part in name.split('-'))
+
+
+status_app = Flask(__name__)
+status_app.PORT = 9
+toolong_content_app = Flask(__name__)
+toolong_content_app.PORT = 15
+
+def create_retries_app(cache):
+    """ :param cache: a :class:`~hamms.counters.RetryCounterStore` holding the
+        retry counters. """
+    retries_app = Flask(__name__)
+    retries_app.PORT = 12
+    retries_app.cache = cache
+    json_hdr = {'Content-Type': 'application/json'}
+
+    # we want the retries app to listen on all methods
+    retries_app.url_map.add(Rule('/', endpoint='index'))
+    @retries_app.endpoint("index")
+    def check_retries():
+        key = request.args.get('key', 'default')
+        tries = request.args.get('tries', 3)
+        try:
+            tries = int(tries)
+        except Exception:
+            return Response(status=400, headers=json_hdr, response=json.dumps({
+                'error': 'Please pass an integer number of tries',
+                'key': key,
+                'success': False,
+            }))
+
+        remaining = retries_app.cache.decrement(key, tries)
+
+        if remaining <= 0:
+            data = {
+                'key': key,
+                'tries_remaining': remaining,
+                'success': True
+            }
+            return Response(response=json.dumps(data), status=200,
+                            headers=json_hdr)
+        else:
+            msg = 'The server had an error. Try again {retry_times} more {time_p}'
+            time_p = 'time' if remaining == 1 else 'times'
+            content = {
+                'error': msg.format(retry_times=remaining, time_p=time_p),
+                'tries_remaining': remaining,
+                'key': key,
+                'success': False,
+            }
+            return Response(response=json.dumps(content), status=500,
+                            headers=json_hdr)
+
+    @retries_app.route("/counters", methods=['POST'])
+    def reset():
+        key = request.values.get('key', 'default')
+        tries = request.values.get('tries', 3)
+        try:
+            tries = int(tries)
+        except Exception:
+            return Response(status=400, headers=json_hdr, response=json.dumps({
+                'error': 'Please pass an integer number of tries',
+                'key': key,
+                'success': False,
+            }))
+
+        retries_app.cache.set(key, tries)
+
+        content = {
+            'key': key,
+            'tries_remaining': tries,
+            'success': True,
+        }
+        return Response(response=json.dumps(content), status=200,
+                        headers={'Content-Type': 'application/json'})
+
+    @retries_app.route("/counters", methods=['GET'])
+    def counter():
+        content = {
+            'counters': retries_app.cache.snapshot(),
+            'stats': retries_app.cache.stats(),
+            'success': True,
+        }
+        return Response(response=json.dumps(content), status=200,
+                        headers={'Content-Type': 'application/json'})
+
+    @retries_app.after_request
+    def retries_header(resp):
+        _log_flask(resp.status_code)
+        resp.headers['Server'] = 'hamms'
+        return resp
+
+    return retries_app
+
+@status_app.route("/")
+def status():
+    n = request.values.get('status', 200)
+    return status_code(int(n))
+
+# Status codes the status port renders at startup; others are rendered when
+# they're asked for.
+STATUS_CODES = range(100, 600)
+
+class StatusResponse(object):
+    """ One response from ``status_app``, rendered to the bytes Twisted's
+    WSGI container would send, apart from the Date and Connection headers.
+    """
+
+    __slots__ = ('code', 'status', 'headers', 'body')
+
+    def __init__(self, response, environ):
+        body, status, headers = response.get_wsgi_response(environ)
+        self.code = response.status_code
+        self.status = status
+        self.body = ''.join(body)
+        names = set(name.lower() for name, value in headers)
+        if self.code in NO_BODY_CODES:
+            # Twisted sends neither a body nor a length for these.
+            self.body = ''
+            headers = [(name, value) for name, value in headers
+                       if name.lower() != 'content-length']
+        elif 'content-length' not in names:
+            # Nor does werkzeug for 1xx codes, so Twisted chunks the body.
+            headers = [('Transfer-Encoding', 'chunked')] + headers
+            if self.body:
+                self.body = '{0:x}\r\n{1}\r\n'.format(len(self.body),
+                                                        self.body)
+            self.body += '0\r\n\r\n'
+        self.headers = ''.join(
+            '{0}: {1}\r\n'.format(_header_case(name), value)
+            for name, value in headers + [('Server', SERVER_HEADER)])
+
+def _render(environ, code=None, error=None):
+    if error is not None:
+        response = error.get_response(environ)
+    elif code is None:
+        response = status_app.make_default_options_response()
+    else:
+        response = status_code(code)
+    return StatusResponse(response, environ)
+
+def render_status(code=None, error=None):
+    """ Render what ``status_app`` answers for ``?status=<code>``, or the
+    werkzeug HTTP exception ``error``. """
+    with status_app.test_request_context('/') as context:
+        return _render(context.request.environ, code, error)
+
+class StatusTable(object):
+    """ Every response the status port is likely to send, rendered once. """
+
+    def __init__(self):
+        # One request context for the lot; setting one up costs more than
+        # rendering a response.
+        with status_app.test_request_context('/') as context:
+            environ = context.request.environ
+            self.responses = dict((code, _render(environ, code))
+                                  for code in STATUS_CODES)
+            self.not_found = _render(environ, error=NotFound())
+            self.not_allowed = _render(
+                environ, error=MethodNotAllowed(valid_methods=STATUS_METHODS))
+            self.options = _render(environ)
+            self.error = _render(environ, error=InternalServerError())
+
+    def get(self, code):
+        """ The response for ``?status=<code>``. """
+        response = self.responses.get(code)
+        if response is not None:
+            return response
+        try:
+            return render_status(code)
+        except Exception:
+            # Flask would have failed the same way.
+            return self.error
+
+@toolong_content_app.route("/")
+def toolong():
+    r = Response()
+    r.automatically_set_content_length = False
+    r.headers['Content-Length'] = 2300
+    if (request.accept_mimetypes.best == 'application/json' or
+        request.accept_mimetypes.best == '*/*'):
+        r.headers['Content-Type'] = 'application/json'
+        r.set_data(INCOMPLETE_JSON)
+    elif request.accept_mimetypes.best == 'text/html':
+        r.headers['Content-Type'] = 'text/html'
+        r.set_data(INCOMPLETE_HTML)
+    elif request.accept_mimetypes.best == 'text/plain':
+        r.headers['Content-Type'] = 'text/plain'
+        r.set_data(INCOMPLETE_PLAIN)
+    elif (request.accept_mimetypes.best == 'text/xml' or
+          request.accept_mimetypes.best == 'application/xml'):
+        r.headers['Content-Type'] = 'text/xml'
+        r.set_data(INCOMPLETE_XML)
+    else:
+        r.headers['Content-Type'] = 'application/json'
+        r.set_data(INCOMPLETE_JSON)
+    return r
+
+def _get_port_from_url(url):
+    urlo = urlparse.urlparse(url)
+    try:
+        host, port = urlo.netloc.split(':')
+        return port
+    except Exception:
+        return "<port>"
+
+def _log_flask(status):
+    if not _should_log(current_app.PORT):
+        return
+    port = _get_port_from_url(request.url)
+    url_line = "{method} {url} HTTP/1.0".format(
+        method=request.method.upper(), url=request.full_path)
+    ua = request.headers.get('user-agent', '')
+    _log(request.remote_addr, port, url_line, status, ua=ua)
+
+@status_app.after_request
+def log_status(resp):
+    _log_flask(resp.status_code)
+    return resp
@@ -0,0 +1,388 @@
+""" Measure how much load each hamms port can take.
+
+Usage::
+
+    python -m hamms.bench --concurrency 20 --duration 5 --output bench.json
+
+Starts hamms in a subprocess, then for each port opens connections from
+``--concurrency`` threads for ``--duration`` seconds. Each connection sends
+one request and reads until the server closes it or ``--timeout`` passes.
+The results, one entry per port, are written as JSON so runs against
+different releases can be compared.
+
+With ``--backends twisted,asyncio,uvloop``, each port is loaded on each
+event loop in turn, to pick the fastest for the connection counts you need;
+ports a backend can't run are skipped.
+
+With ``--startup N``, it instead starts hamms N times and reports how long
+``import hamms`` takes and how long each start takes to accept connections::
+
+    python -m hamms.bench --startup 20 --modes 9
+"""
+import argparse
+from contextlib import closing
+import json
+import math
+import os
+import platform
+import socket
+import subprocess
+import sys
+from threading import Thread
+import time
+
+from . import ASYNCIO_MODES, BASE_PORT, MODES as SERVER_MODES, __version__
+
+# Mode -> request path, for modes that take parameters. Paths pick
+# parameters that make the slow ports finish quickly; the ports that never
+# answer are still measured, but only ever time out.
+PATHS = {
+    'slow-byte': '/?bytes=1024&interval=0.01',
+    'very-slow-byte': '/?bytes=1024&interval=0.01',
+    'sleep': '/?sleep=0',
+    'status': '/?status=200',
+    'retries': '/?key=bench&tries=1',
+    'drop-random': '/?failrate=0.5',
+    'throttle': '/?size=1024&rate=1048576',
+    'huge': '/?size=1048576',
+    'chaos': '/?sleep=0&bytes=1024&interval=0.01&size=1024&rate=1048576',
+}
+# Ports that aren't failure modes of their own.
+SKIPPED = frozenset(['dispatch', 'admin'])
+# (port offset, mode, request path) for each port to load.
+MODES = [(offset, mode, PATHS.get(mode, '/')) for mode, offset in SERVER_MODES
+         if mode not in SKIPPED]
+
+# Backend name -> arguments that start hamms on it.
+BACKEND_ARGS = {
+    'twisted': [],
+    'asyncio': ['--backend', 'asyncio', '--loop', 'asyncio'],
+    'uvloop': ['--backend', 'asyncio', '--loop', 'uvloop'],
+}
+
+REQUEST = ('GET {path} HTTP/1.1\r\n'
+           'Host: 127.0.0.1:{port}\r\n'
+           'User-Agent: hamms-bench/{version}\r\n'
+           'Connection: close\r\n\r\n')
+
+
+def percentile(values, fraction):
+    """ The nearest-rank percentile of sorted ``values``. """
+    if not values:
+        return None
+    rank = int(math.ceil(fraction * len(values)))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+def exchange(port, request, timeout):
+    """ Send ``request`` on a new connection and read until the server closes
+    it. Returns (outcome, bytes received), where outcome is 'ok', 'timeout',
+    'refused' or 'error'. """
+    try:
+        sock = socket.create_connection(('127.0.0.1', port), timeout)
+    except socket.timeout:
+        return 'timeout', 0
+    except socket.error:
+        return 'refused', 0
+    received = 0
+    with closing(sock):
+        try:
+            sock.sendall(request)
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    return 'ok', received
+                received += len(data)
+        except socket.timeout:
+            return 'timeout', received
+        except socket.error:
+            return 'error', received
+
+
+class Load(object):
+    """ Drive one port from ``concurrency`` threads for ``duration``
+    seconds. """
+
+    def __init__(self, port, path, concurrency, duration, timeout):
+        self.port = port
+        self.request = REQUEST.format(path=path, port=port, version=__version__)
+        self.concurrency = concurrency
+        self.duration = duration
+        self.timeout = timeout
+        self.latencies = []
+        self.outcomes = {}
+        self.received = 0
+
+    def _worker(self, deadline):
+        # Each thread keeps its own results, merged once it's done, so the
+        # threads never contend on shared state.
+        latencies = []
+        outcomes = {}
+        received = 0
+        while time.time() < deadline:
+            started = time.time()
+            outcome, count = exchange(self.port, self.request, self.timeout)
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+            received += count
+            if outcome == 'ok':
+                latencies.append(time.time() - started)
+        self.latencies.extend(latencies)
+        for outcome, count in outcomes.items():
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + count
+        self.received += received
+
+    def run(self):
+        started = time.time()
+        deadline = started + self.duration
+        threads = [Thread(target=self._worker, args=(deadline,))
+                   for _ in range(self.concurrency)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.time() - started
+
+
+def server_cpu(pid):
+    """ Seconds of CPU time process ``pid`` has used, or None if that can't
+    be read on this platform. """
+    try:
+        with open('/proc/{pid}/stat'.format(pid=pid)) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except (IOError, OSError):
+        return None
+    # utime and stime are fields 14 and 15; fields[0] is field 3.
+    ticks = int(fields[11]) + int(fields[12])
+    return ticks / float(os.sysconf('SC_CLK_TCK'))
+
+
+def bench_mode(base_port, offset, mode, path, pid, concurrency, duration,
+               timeout):
+    load = Load(base_port + offset, path, concurrency, duration, timeout)
+    cpu_before = server_cpu(pid) if pid else None
+    elapsed = load.run()
+    cpu_after = server_cpu(pid) if pid else None
+
+    latencies = sorted(load.latencies)
+    connections = sum(load.outcomes.values())
+    result = {
+        'port': base_port + offset,
+        'offset': offset,
+        'mode': mode,
+        'path': path,
+        'elapsed': elapsed,
+        'connections': connections,
+        'requests': len(latencies),
+        'outcomes': load.outcomes,
+        'bytes_received': load.received,
+        'connections_per_sec': connections / elapsed,
+        'requests_per_sec': len(latencies) / elapsed,
+        'latency': {
+            'p50': percentile(latencies, 0.5),
+            'p90': percentile(latencies, 0.9),
+            'p99': percentile(latencies, 0.99),
+            'max': latencies[-1] if latencies else None,
+        },
+        'server_cpu': None,
+        'server_cpu_percent': None,
+    }
+    if cpu_before is not None and cpu_after is not None:
+        result['server_cpu'] = cpu_after - cpu_before
+        result['server_cpu_percent'] = 100 * result['server_cpu'] / elapsed
+    return result
+
+
+def start_server(base_port, server_args, offsets=None):
+    """ Start hamms in a subprocess and wait until it accepts connections.
+    If ``offsets`` is given, only those ports are started. """
+    # Per-request log lines would cost the server more than some of the
+    # requests do.
+    quiet = []
+    for offset, mode, path in MODES:
+        quiet.extend(['--log-sample', '{0}=0'.format(offset)])
+    if offsets:
+        quiet.extend(['--ports', ','.join(str(o) for o in offsets)])
+    wait_port = base_port + (offsets[0] if offsets else 16)
+    devnull = open(os.devnull, 'w')
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'hamms', '--port', str(base_port)] + quiet +
+        server_args, stdout=devnull, stderr=devnull)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError("hamms exited with status {0}".format(
+                server.returncode))
+        try:
+            socket.create_connection(('127.0.0.1', wait_port), 1).close()
+            return server
+        except socket.error:
+            time.sleep(0.01)
+    server.terminate()
+    raise RuntimeError("hamms did not start listening within 30 seconds")
+
+
+def import_time():
+    """ Seconds a fresh interpreter takes to ``import hamms``. """
+    output = subprocess.check_output([
+        sys.executable, '-c',
+        'import time; started = time.time(); import hamms; '
+        'print(time.time() - started)'])
+    return float(output)
+
+
+def bench_startup(base_port, runs, offsets, server_args):
+    """ Start and stop hamms ``runs`` times, timing each start. """
+    imports = sorted(import_time() for _ in range(runs))
+    starts = []
+    for _ in range(runs):
+        started = time.time()
+        server = start_server(base_port, server_args, offsets)
+        starts.append(time.time() - started)
+        server.terminate()
+        server.wait()
+    starts.sort()
+    return {
+        'runs': runs,
+        'offsets': offsets,
+        'import': {'p50': percentile(imports, 0.5),
+                   'max': imports[-1]},
+        'start': {'p50': percentile(starts, 0.5),
+                  'p90': percentile(starts, 0.9),
+                  'max': starts[-1]},
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m hamms.bench',
+        description='Measure throughput and latency of each hamms port')
+    parser.add_argument('--port', type=int, default=BASE_PORT,
+                        help='first port in the range hamms listens on')
+    parser.add_argument('--concurrency', type=int, default=10,
+                        help='connections to keep in flight per port')
+    parser.add_argument('--duration', type=float, default=5.0,
+                        help='seconds to load each port for')
+    parser.add_argument('--timeout', type=float, default=1.0,
+                        help='seconds to wait for a response before giving '
+                             'up on a connection')
+    parser.add_argument('--modes', type=lambda s: [int(n) for n in s.split(',')],
+                        help='comma separated port offsets to run, e.g. 8,9 '
+                             '(default: all)')
+    parser.add_argument('--backends', default=['twisted'],
+                        type=lambda s: s.split(','),
+                        help='comma separated event loops to run hamms on, '
+                             'from {0} (default: twisted)'.format(
+                                 ', '.join(sorted(BACKEND_ARGS))))
+    parser.add_argument('--external', action='store_true',
+                        help="don't start hamms; load a server that's "
+                             "already running (server CPU isn't reported)")
+    parser.add_argument('--startup', type=int, metavar='N',
+                        help='instead of loading the ports, time N starts of '
+                             'hamms with only the --modes ports')
+    parser.add_argument('--output', help='write JSON results to this file '
+                                         'instead of stdout')
+    parser.add_argument('server_args', nargs=argparse.REMAINDER,
+                        help='arguments for the hamms server, after --')
+    return parser.parse_args(argv)
+
+
+def _summary(result):
+    latency = result['latency']
+    p50 = latency['p50'] * 1000 if latency['p50'] is not None else float('nan')
+    p99 = latency['p99'] * 1000 if latency['p99'] is not None else float('nan')
+    cpu = result['server_cpu_percent']
+    return ("{backend:<8} {port} {mode:<22} {conns:>9.1f} conn/s {reqs:>9.1f} req/s "
+            "p50 {p50:>8.2f}ms p99 {p99:>8.2f}ms cpu {cpu}".format(
+                backend=result['backend'], port=result['port'],
+                mode=result['mode'],
+                conns=result['connections_per_sec'],
+                reqs=result['requests_per_sec'], p50=p50, p99=p99,
+                cpu='-' if cpu is None else '{0:.0f}%'.format(cpu)))
+
+
+def backend_offsets(backend, offsets=None):
+    """ The port offsets in ``offsets`` (all of them by default) that
+    ``backend`` can run. """
+    return [offset for offset, mode, path in MODES
+            if (offsets is None or offset in offsets) and
+            (backend == 'twisted' or mode in ASYNCIO_MODES)]
+
+
+def bench_backend(args, backend, server_args):
+    """ Load each port on hamms running on ``backend``. """
+    offsets = backend_offsets(backend, args.modes)
+    server = None
+    if not args.external:
+        server = start_server(args.port, BACKEND_ARGS[backend] + server_args,
+                              offsets if backend != 'twisted' else args.modes)
+    try:
+        results = []
+        for offset, mode, path in MODES:
+            if offset not in offsets:
+                continue
+            result = bench_mode(args.port, offset, mode, path,
+                                server.pid if server else None,
+                                args.concurrency, args.duration, args.timeout)
+            result['backend'] = backend
+            sys.stderr.write(_summary(result) + '\n')
+            results.append(result)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    return results
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    server_args = [a for a in args.server_args if a != '--']
+    if args.startup:
+        startup = bench_startup(args.port, args.startup, args.modes,
+                                server_args)
+        sys.stderr.write("import p50 {0:.3f}s start p50 {1:.3f}s p90 "
+                         "{2:.3f}s\n".format(startup['import']['p50'],
+                                              startup['start']['p50'],
+                                              startup['start']['p90']))
+        _write_report(args, {
+            'version': __version__,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.time(),
+            'server_args': server_args,
+            'startup': startup,
+        })
+        return
+
+    for backend in args.backends:
+        if backend not in BACKEND_ARGS:
+            raise ValueError("unknown backend: {0}".format(backend))
+    results = []
+    for backend in args.backends:
+        results.extend(bench_backend(args, backend, server_args))
+
+    _write_report(args, {
+        'version': __version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.time(),
+        'concurrency': args.concurrency,
+        'duration': args.duration,
+        'timeout': args.timeout,
+        'server_args': server_args,
+        'backends': args.backends,
+        'results': results,
+    })
+
+
+def _write_report(args, report):
+    report = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        sys.stdout.write(report + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUCache(object):
+    """ A dict-like cache that holds at most ``maxsize`` entries, evicting
+    the least recently used one when it is full.
+
+    Safe to share between the reactor and thread pool workers.
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.data[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def __len__(self):
+        return len(self.data)
@@ -0,0 +1,127 @@
+from bisect import bisect_right
+import random
+
+from twisted.internet import protocol
+
+from . import CHAOS_PORT, MODES
+from .decisions import Decisions
+
+# Decisions drawn from the random number generator at a time.
+DEFAULT_BATCH_SIZE = 4096
+
+
+class ChaosSchedule(object):
+    """ A reproducible sequence of modes, one for each connection to the
+    chaos port.
+
+    Each decision picks a mode with probability proportional to its weight.
+    Decisions are drawn from a :class:`random.Random` seeded with ``seed``,
+    ``batch_size`` at a time, so taking the next one is a list lookup, and
+    two schedules with the same seed and weights make the same decisions in
+    the same order.
+
+    :param dict weights: mode name -> weight. Weights are relative, and a
+        weight of 0 leaves the mode out.
+    :param int seed: seeds the random number generator; a random seed is
+        picked, and reported by :meth:`state`, if it's None.
+    """
+
+    def __init__(self, weights, seed=None, batch_size=DEFAULT_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.seed = None
+        self.weights = None
+        self.reset(seed, weights)
+
+    def reset(self, seed=None, weights=None):
+        """ Start the schedule again from its first decision, with a new
+        ``seed`` or ``weights`` if they're given. """
+        if weights is not None:
+            self._set_weights(weights)
+        if seed is not None:
+            self.seed = seed
+        elif self.seed is None:
+            self.seed = random.SystemRandom().randint(0, 2 ** 32 - 1)
+        self.random = random.Random(self.seed)
+        self.position = 0
+        self.counts = [0] * len(self.modes)
+        self.upcoming = []
+        self.index = 0
+
+    def _set_weights(self, weights):
+        modes = sorted(weights)
+        cumulative = []
+        total = 0
+        for mode in modes:
+            weight = weights[mode]
+            if weight < 0:
+                raise ValueError("weight for {0} is negative".format(mode))
+            total += weight
+            cumulative.append(total)
+        if not total:
+            raise ValueError("at least one mode needs a positive weight")
+        # Sorted, so the same weights give the same schedule however the
+        # dict orders them.
+        self.modes = modes
+        self.weights = dict(weights)
+        self.cumulative = cumulative
+
+    def _batch(self):
+        rand = self.random.random
+        cumulative = self.cumulative
+        total = cumulative[-1]
+        return [bisect_right(cumulative, rand() * total)
+                for _ in xrange(self.batch_size)]
+
+    def next(self):
+        """ The mode for the next connection. """
+        if self.index >= len(self.upcoming):
+            self.upcoming = self._batch()
+            self.index = 0
+        choice = self.upcoming[self.index]
+        self.index += 1
+        self.position += 1
+        self.counts[choice] += 1
+        return self.modes[choice]
+
+    def peek(self, count):
+        """ The modes for the next ``count`` connections, without using them
+        up. """
+        while len(self.upcoming) - self.index < count:
+            self.upcoming = self.upcoming[self.index:] + self._batch()
+            self.index = 0
+        return [self.modes[choice]
+                for choice in self.upcoming[self.index:self.index + count]]
+
+    def state(self):
+        """ The seed and weights, how many decisions have been made, and how
+        many times each mode was picked. """
+        return {
+            'seed': self.seed,
+            'weights': self.weights,
+            'position': self.position,
+            'counts': dict(zip(self.modes, self.counts)),
+        }
+
+
+class ChaosFactory(protocol.Factory):
+    """ Give each connection to the protocol of the mode ``schedule`` picks
+    for it, built by that mode's factory in ``factories``.
+
+    :param decisions: a :class:`~hamms.decisions.Decisions` each pick goes
+        through, as the mode's port offset, so it can be recorded or
+        replayed. By default the schedule decides.
+    """
+
+    def __init__(self, schedule, factories, decisions=None):
+        self.schedule = schedule
+        self.factories = factories
+        self.decisions = decisions if decisions is not None else Decisions()
+        self.offsets = dict(MODES)
+        self.names = dict((offset, name) for name, offset in MODES)
+
+    def _pick(self):
+        return self.offsets[self.schedule.next()]
+
+    def buildProtocol(self, addr):
+        mode = self.names[self.decisions.decide(CHAOS_PORT, self._pick)]
+        return self.factories[mode].buildProtocol(addr)
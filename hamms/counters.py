@@ -0,0 +1,316 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+import itertools
+import sqlite3
+import threading
+import time
+
+# Defaults for the retries port's counter store.
+DEFAULT_MAX_ENTRIES = 10000
+DEFAULT_TTL = 60 * 60
+
+
+class _Stripe(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # key -> (tries remaining, expiry time, update number), least
+        # recently updated first
+        self.entries = OrderedDict()
+        self.evictions = 0
+        self.expirations = 0
+
+    def expire(self, now):
+        """ Drop expired entries, and return how many there were. Must be
+        called with the lock held. """
+        expired = 0
+        while self.entries:
+            key = next(iter(self.entries))
+            if self.entries[key][1] > now:
+                break
+            del self.entries[key]
+            expired += 1
+        self.expirations += expired
+        return expired
+
+    def store(self, key, value, expires, order):
+        """ Return True if ``key`` is new. Must be called with the lock
+        held. """
+        new = self.entries.pop(key, None) is None
+        self.entries[key] = (value, expires, order)
+        return new
+
+
+class RetryCounterStore(object):
+    """ Retry counters for the retries port.
+
+    Counters are split across ``stripes`` independently locked dicts, so
+    thread pool workers can update different keys concurrently while updates
+    to the same key stay atomic. The store holds at most ``max_entries``
+    counters, and a counter that hasn't been updated for ``ttl`` seconds is
+    forgotten.
+
+    LRU order is kept per stripe: when the store is full, a new counter
+    evicts the least recently updated counter in its own stripe, or if that
+    stripe holds nothing else, the least recently updated of the other
+    stripes' oldest counters.
+
+    :param int max_entries: maximum number of counters to keep.
+    :param float ttl: seconds a counter lives after its last update.
+    :param int stripes: number of independently locked partitions.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL,
+                 stripes=16, clock=time.time):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.stripes = [_Stripe() for _ in range(stripes)]
+        # Counters across every stripe. Taken with a stripe's lock held, so
+        # never take a stripe's lock while holding it.
+        self.count = 0
+        self.count_lock = threading.Lock()
+        # Orders updates across stripes, even ones made in the same clock
+        # tick; next() on it is atomic.
+        self.updates = itertools.count()
+
+    def _stripe(self, key):
+        return self.stripes[hash(key) % len(self.stripes)]
+
+    def _update(self, stripe, key, value, now):
+        """ Store ``value`` for ``key``. Must be called with the stripe's
+        lock held; returns True if the store is over its limit and ``key``'s
+        stripe had nothing else to evict. """
+        change = -stripe.expire(now)
+        if stripe.store(key, value, now + self.ttl, next(self.updates)):
+            change += 1
+        if not change:
+            return False
+        with self.count_lock:
+            self.count += change
+            if self.count <= self.max_entries:
+                return False
+            if len(stripe.entries) < 2:
+                return True
+            # The oldest entry can't be key, which was just moved to the end.
+            stripe.entries.popitem(last=False)
+            stripe.evictions += 1
+            self.count -= 1
+            return self.count > self.max_entries
+
+    def _evict(self, keep):
+        """ Evict the oldest counters at the head of any stripe, other than
+        ``keep``, until the store is within its limit. Takes one stripe's
+        lock at a time. """
+        while True:
+            with self.count_lock:
+                if self.count <= self.max_entries:
+                    return
+            oldest = None
+            for stripe in self.stripes:
+                with stripe.lock:
+                    if not stripe.entries:
+                        continue
+                    key = next(iter(stripe.entries))
+                    order = stripe.entries[key][2]
+                if key != keep and (oldest is None or order < oldest[0]):
+                    oldest = (order, stripe, key)
+            if oldest is None:
+                return
+            order, stripe, key = oldest
+            with stripe.lock:
+                # Unless it was updated since.
+                if stripe.entries.get(key, (None, None, None))[2] != order:
+                    continue
+                del stripe.entries[key]
+                stripe.evictions += 1
+                with self.count_lock:
+                    self.count -= 1
+
+    def decrement(self, key, tries):
+        """ Decrement the counter for ``key``, creating it with ``tries``
+        tries if it doesn't exist, and return the number of tries left. """
+        stripe = self._stripe(key)
+        now = self.clock()
+        with stripe.lock:
+            if key in stripe.entries and stripe.entries[key][1] > now:
+                remaining = stripe.entries[key][0] - 1
+            else:
+                remaining = tries - 1
+            full = self._update(stripe, key, remaining, now)
+        if full:
+            self._evict(key)
+        return remaining
+
+    def set(self, key, tries):
+        """ Reset the counter for ``key`` to ``tries``. """
+        stripe = self._stripe(key)
+        now = self.clock()
+        with stripe.lock:
+            full = self._update(stripe, key, tries, now)
+        if full:
+            self._evict(key)
+
+    def snapshot(self):
+        """ A dict of every live counter. """
+        now = self.clock()
+        counters = {}
+        for stripe in self.stripes:
+            with stripe.lock:
+                expired = stripe.expire(now)
+                if expired:
+                    with self.count_lock:
+                        self.count -= expired
+                for key, entry in stripe.entries.items():
+                    counters[key] = entry[0]
+        return counters
+
+    def clear(self):
+        for stripe in self.stripes:
+            with stripe.lock:
+                cleared = len(stripe.entries)
+                stripe.entries.clear()
+                with self.count_lock:
+                    self.count -= cleared
+
+    def stats(self):
+        stats = {
+            'entries': 0,
+            'max_entries': self.max_entries,
+            'ttl': self.ttl,
+            'evictions': 0,
+            'expirations': 0,
+        }
+        for stripe in self.stripes:
+            with stripe.lock:
+                stats['entries'] += len(stripe.entries)
+                stats['evictions'] += stripe.evictions
+                stats['expirations'] += stripe.expirations
+        return stats
+
+
+class SQLiteCounterStore(object):
+    """ Retry counters kept in a SQLite database, so several hamms processes
+    can share them.
+
+    The database runs in WAL mode and every update happens in a ``BEGIN
+    IMMEDIATE`` transaction, which makes decrements atomic across threads and
+    processes. The number of entries is kept in the stats table alongside
+    them, so enforcing the limit doesn't count the table. It has the same
+    interface, limits and statistics as :class:`RetryCounterStore`.
+
+    :param str path: the database file; created if it doesn't exist.
+    """
+
+    def __init__(self, path, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL,
+                 clock=time.time):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.local = threading.local()
+        with self._transaction() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS counters ("
+                       "key TEXT PRIMARY KEY, remaining INTEGER, expires REAL)")
+            db.execute("CREATE INDEX IF NOT EXISTS counters_expires "
+                       "ON counters (expires)")
+            db.execute("CREATE TABLE IF NOT EXISTS stats ("
+                       "name TEXT PRIMARY KEY, value INTEGER)")
+            db.execute("INSERT OR IGNORE INTO stats VALUES ('evictions', 0)")
+            db.execute("INSERT OR IGNORE INTO stats VALUES ('expirations', 0)")
+            db.execute("INSERT OR IGNORE INTO stats "
+                       "SELECT 'entries', COUNT(*) FROM counters")
+
+    def _connection(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            # Transactions are managed by hand in _transaction.
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.local.db = db
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        db = self._connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def _bump(self, db, name, count):
+        if count:
+            db.execute("UPDATE stats SET value = value + ? WHERE name = ?",
+                       (count, name))
+
+    def _entries(self, db):
+        return db.execute("SELECT value FROM stats "
+                          "WHERE name = 'entries'").fetchone()[0]
+
+    def _expire(self, db, now):
+        cursor = db.execute("DELETE FROM counters WHERE expires <= ?", (now,))
+        self._bump(db, 'expirations', cursor.rowcount)
+        self._bump(db, 'entries', -cursor.rowcount)
+
+    def _update(self, db, key, value, expires):
+        """ Store ``value`` for ``key`` if it's there, and return whether
+        it was. """
+        cursor = db.execute("UPDATE counters SET remaining = ?, expires = ? "
+                            "WHERE key = ?", (value, expires, key))
+        return cursor.rowcount > 0
+
+    def _insert(self, db, key, value, expires):
+        db.execute("INSERT INTO counters VALUES (?, ?, ?)",
+                   (key, value, expires))
+        self._bump(db, 'entries', 1)
+        # Only a new key can take the store over its limit.
+        count = self._entries(db)
+        if count > self.max_entries:
+            cursor = db.execute(
+                "DELETE FROM counters WHERE key IN (SELECT key FROM counters "
+                "ORDER BY expires LIMIT ?)", (count - self.max_entries,))
+            self._bump(db, 'evictions', cursor.rowcount)
+            self._bump(db, 'entries', -cursor.rowcount)
+
+    def decrement(self, key, tries):
+        now = self.clock()
+        with self._transaction() as db:
+            self._expire(db, now)
+            row = db.execute("SELECT remaining FROM counters WHERE key = ?",
+                             (key,)).fetchone()
+            if row is None:
+                remaining = tries - 1
+                self._insert(db, key, remaining, now + self.ttl)
+            else:
+                remaining = row[0] - 1
+                self._update(db, key, remaining, now + self.ttl)
+        return remaining
+
+    def set(self, key, tries):
+        now = self.clock()
+        with self._transaction() as db:
+            self._expire(db, now)
+            if not self._update(db, key, tries, now + self.ttl):
+                self._insert(db, key, tries, now + self.ttl)
+
+    def snapshot(self):
+        with self._transaction() as db:
+            self._expire(db, self.clock())
+            rows = db.execute("SELECT key, remaining FROM counters").fetchall()
+        return dict(rows)
+
+    def clear(self):
+        with self._transaction() as db:
+            db.execute("DELETE FROM counters")
+            db.execute("UPDATE stats SET value = 0 WHERE name = 'entries'")
+
+    def stats(self):
+        with self._transaction() as db:
+            stats = dict(db.execute("SELECT name, value FROM stats"))
+        stats['max_entries'] = self.max_entries
+        stats['ttl'] = self.ttl
+        return stats
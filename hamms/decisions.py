@@ -0,0 +1,221 @@
+""" Record the random choices hamms makes, and replay them.
+
+Usage::
+
+    python -m hamms --record-decisions run.log
+    python -m hamms --replay-decisions run.log
+    python -m hamms.decisions run.log
+
+The randomized ports (drop-random and chaos) make each choice through a
+decision source. A :class:`DecisionLog` records every choice, and a
+:class:`DecisionReplay` hands the recorded choices back, port by port and in
+the same order, so the run that exposed a client bug can be repeated.
+Running this module prints a log, one decision per line.
+
+A log is an 8 byte magic string and the time the log was started, followed
+by fixed size records of the port offset, the decision's sequence number on
+that port, seconds since the log started, and the decision, a small
+integer. Records are packed as decisions are made and written in batches
+by a background thread, so recording costs the reactor a ``struct.pack``
+and a list append per decision.
+"""
+from collections import defaultdict
+import logging
+import os
+try:
+    from Queue import Full, Queue
+except ImportError:
+    from queue import Full, Queue
+import random
+import struct
+import sys
+from threading import Thread
+import time
+
+from twisted.internet import reactor, task
+
+logger = logging.getLogger("hamms")
+
+MAGIC = 'HAMMSDL1'
+HEADER = struct.Struct('<8sd')
+# Port offset, sequence number, seconds since the log started, decision.
+RECORD = struct.Struct('<BIdB')
+
+# Records packed before they're handed to the writer thread.
+DEFAULT_BATCH_SIZE = 1024
+# Batches the writer thread can fall behind by before records are dropped.
+DEFAULT_QUEUE_SIZE = 1024
+# Seconds between writes of a partly filled batch.
+DEFAULT_FLUSH_INTERVAL = 1.0
+
+
+class Decisions(object):
+    """ Make every decision live, without recording it.
+
+    :ivar random: a :class:`random.Random` for the ports to make decisions
+        with, rather than the module-level one other code shares.
+    """
+
+    def __init__(self, seed=None):
+        self.random = random.Random(seed)
+
+    def decide(self, port, pick):
+        """ The next decision for the port at offset ``port``. ``pick`` is
+        called to make it, unless it's replayed from a log. """
+        return pick()
+
+    def reset(self):
+        """ Start again from the first decision, if they're replayed. """
+
+    def close(self):
+        """ Write out anything that's recorded. """
+
+
+class DecisionLog(Decisions):
+    """ Make decisions live, and append each one to the log at ``path``.
+
+    :param str path: file to write to, replacing any that exists. ``{pid}``
+        is replaced with the process id, so several workers can record side
+        by side.
+    :param clock: an IReactorTime provider, the reactor by default, to
+        write out partly filled batches with.
+    """
+
+    def __init__(self, path, seed=None, batch_size=DEFAULT_BATCH_SIZE,
+                 queue_size=DEFAULT_QUEUE_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL, clock=None):
+        Decisions.__init__(self, seed)
+        self.path = path.format(pid=os.getpid())
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.clock = clock or reactor
+        self.started = time.time()
+        self.sequences = defaultdict(int)
+        self.pending = []
+        self.recorded = 0
+        self.dropped = 0
+        self.queue = Queue(queue_size)
+        self.file = open(self.path, 'wb')
+        self.file.write(HEADER.pack(MAGIC, self.started))
+        self.thread = Thread(target=self._run, name='hamms-decision-log')
+        self.thread.daemon = True
+        self.thread.start()
+        self._loop = None
+
+    def decide(self, port, pick):
+        decision = pick()
+        sequence = self.sequences[port]
+        self.sequences[port] = sequence + 1
+        self.pending.append(RECORD.pack(port, sequence,
+                                        time.time() - self.started, decision))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        elif self._loop is None:
+            self._loop = task.LoopingCall(self.flush)
+            self._loop.clock = self.clock
+            self._loop.start(self.flush_interval, now=False)
+        return decision
+
+    def flush(self):
+        """ Hand the records packed so far to the writer thread. """
+        if not self.pending:
+            return
+        count = len(self.pending)
+        try:
+            self.queue.put_nowait(''.join(self.pending))
+            self.recorded += count
+        except Full:
+            # The log is useless for replay from here on, but that's better
+            # than stalling every connection on a slow disk.
+            self.dropped += count
+        self.pending = []
+
+    def close(self):
+        """ Write out everything recorded so far, then close the file. """
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        if self.dropped:
+            logger.warning("dropped {n} decisions from {path}; it can't be "
+                           "replayed exactly".format(n=self.dropped,
+                                                     path=self.path))
+
+    def _run(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                self.file.close()
+                return
+            self.file.write(batch)
+            self.file.flush()
+
+
+def read_decisions(path):
+    """ The start time of the log at ``path``, and a list of its records as
+    (port offset, sequence number, seconds, decision) tuples. A record cut
+    off by a crash is ignored. """
+    with open(path, 'rb') as f:
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size or \
+                HEADER.unpack(header)[0] != MAGIC:
+            raise ValueError("{0} is not a hamms decision log".format(path))
+        started = HEADER.unpack(header)[1]
+        data = f.read()
+    size = RECORD.size
+    end = len(data) - len(data) % size
+    return started, [RECORD.unpack_from(data, offset)
+                     for offset in xrange(0, end, size)]
+
+
+class DecisionReplay(Decisions):
+    """ Repeat the decisions recorded in the log at ``path``: each port gets
+    the decisions it made in that run, in the same order. A port that asks
+    for more decisions than were recorded makes the rest live. """
+
+    def __init__(self, path, seed=None):
+        Decisions.__init__(self, seed)
+        self.path = path
+        started, records = read_decisions(path)
+        by_port = defaultdict(list)
+        for port, sequence, seconds, decision in records:
+            by_port[port].append((sequence, decision))
+        self.recorded = dict(
+            (port, [decision for sequence, decision in sorted(decisions)])
+            for port, decisions in by_port.items())
+        self.positions = defaultdict(int)
+        self.exhausted = set()
+
+    def reset(self):
+        self.positions.clear()
+        self.exhausted.clear()
+
+    def decide(self, port, pick):
+        recorded = self.recorded.get(port, ())
+        position = self.positions[port]
+        if position < len(recorded):
+            self.positions[port] = position + 1
+            return recorded[position]
+        if port not in self.exhausted:
+            self.exhausted.add(port)
+            logger.warning("replayed all {n} decisions for port offset "
+                           "{port}; making the rest live".format(
+                               n=len(recorded), port=port))
+        return pick()
+
+
+def main(argv=None):
+    args = sys.argv[1:] if argv is None else argv
+    if len(args) != 1:
+        sys.stderr.write("usage: python -m hamms.decisions <log>\n")
+        sys.exit(2)
+    started, records = read_decisions(args[0])
+    for port, sequence, seconds, decision in records:
+        sys.stdout.write("{time:.6f} {port} {sequence} {decision}\n".format(
+            time=started + seconds, port=port, sequence=sequence,
+            decision=decision))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+from twisted.internet.error import ConnectionDone
+from twisted.protocols.policies import ProtocolWrapper, WrappingFactory
+from twisted.python.failure import Failure
+from twisted.web.http import HTTPChannel
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+
+# Header that picks a mode on the dispatch port, as an alternative to a
+# /mode/<name> path prefix.
+MODE_HEADER = 'X-Hamms-Mode'
+
+
+def check_channel(channel=None):
+    """ Raise RuntimeError unless ``channel``, an HTTPChannel, buffers bytes
+    the way :meth:`HandoverProtocol.handover` expects.
+
+    The handover takes over HTTPChannel's line buffer and its private
+    ``_dataBuffer`` list, which aren't public API. setup.py pins the Twisted
+    versions this has been tested with; on any other version this check
+    fails loudly, rather than a handover quietly losing pipelined bytes.
+    """
+    if channel is None:
+        channel = HTTPChannel()
+    if (not callable(getattr(channel, 'clearLineBuffer', None)) or
+            not isinstance(getattr(channel, '_dataBuffer', None), list)):
+        raise RuntimeError("the dispatch port doesn't support this version "
+                           "of Twisted's HTTPChannel")
+
+
+class _Forward(list):
+    """ Stands in for a detached channel's buffer of bytes that arrived while
+    it handled a request, and passes anything the channel adds to it on to
+    the protocol that took the connection over. """
+
+    def __init__(self, protocol):
+        list.__init__(self)
+        self.protocol = protocol
+
+    def append(self, data):
+        if data:
+            self.protocol.dataReceived(data)
+
+
+class HandoverProtocol(ProtocolWrapper):
+    """ Run an HTTP channel, which can hand its connection over to another
+    protocol part way through.
+
+    The dispatch port parses every request as HTTP, so that the web modes
+    can share kept-alive connections. A request for one of the raw modes
+    calls :meth:`handover`, and from then on the raw mode's protocol owns the
+    connection, as if the client had connected to its own port.
+    """
+
+    def __init__(self, factory, wrappedProtocol):
+        ProtocolWrapper.__init__(self, factory, wrappedProtocol)
+        self.channel = wrappedProtocol
+        self.handed_over = False
+
+    def handover(self, protocol, data, http_channel=None):
+        """ Detach the HTTP channel and connect ``protocol`` instead, as if
+        it had just received ``data``. If the request came in on
+        ``http_channel``, whatever the client sent after it follows. """
+        if self.handed_over:
+            raise RuntimeError("connection was already handed over")
+        self.handed_over = True
+        if http_channel is not None:
+            # Pipelined bytes the channel hasn't parsed yet, and ones it set
+            # aside while handling the request. The rest of the read the
+            # request ended in is only set aside once this returns, so it's
+            # forwarded as it's added.
+            data += http_channel.clearLineBuffer()
+            data += ''.join(http_channel._dataBuffer)
+            http_channel._dataBuffer = _Forward(protocol)
+        # Same steps Twisted takes to switch a channel over to HTTP/2: the
+        # channel stops being the transport's producer and its timeout is
+        # cancelled, by telling it the connection is gone.
+        self.transport.unregisterProducer()
+        self.channel.connectionLost(Failure(ConnectionDone("handed over")))
+        self.transport.resumeProducing()
+        self.wrappedProtocol = protocol
+        protocol.makeConnection(self)
+        if data and not self.disconnecting:
+            protocol.dataReceived(data)
+
+
+class HandoverFactory(WrappingFactory):
+    """ Wrap an HTTP site so its connections can be handed over. """
+
+    protocol = HandoverProtocol
+
+    def __init__(self, wrappedFactory):
+        check_channel()
+        WrappingFactory.__init__(self, wrappedFactory)
+
+    def logPrefix(self):
+        return self.wrappedFactory.logPrefix()
+
+
+def request_head(request, body=''):
+    """ Rebuild the raw head of a twisted.web ``request``, without the
+    ``/mode/<name>`` prefix the dispatch port picked the mode with. The
+    channel has already decoded a chunked ``body``, so its length is sent
+    instead. """
+    target = '/' + '/'.join(request.postpath)
+    query = request.uri.partition('?')[2]
+    if query:
+        target += '?' + query
+    lines = ['{0} {1} {2}'.format(request.method, target,
+                                  request.clientproto)]
+    chunked = request.requestHeaders.hasHeader('transfer-encoding')
+    for name, values in request.requestHeaders.getAllRawHeaders():
+        if chunked and name.lower() == 'transfer-encoding':
+            continue
+        for value in values:
+            lines.append('{0}: {1}'.format(name, value))
+    if chunked:
+        lines.append('Content-Length: {0}'.format(len(body)))
+    return '\r\n'.join(lines) + '\r\n\r\n'
+
+
+class HandoverResource(Resource):
+    """ Give the connection to a protocol from ``factory``, a raw mode's
+    factory, and let it answer the request. """
+
+    isLeaf = True
+
+    def __init__(self, factory):
+        Resource.__init__(self)
+        self.factory = factory
+
+    def render(self, request):
+        transport = request.channel.transport
+        protocol = self.factory.buildProtocol(transport.getPeer())
+        request.content.seek(0)
+        body = request.content.read()
+        transport.handover(protocol, request_head(request, body) + body,
+                           request.channel)
+        # The channel was told the connection is gone, so the request is
+        # never finished.
+        return NOT_DONE_YET
@@ -0,0 +1,79 @@
+import logging
+try:
+    from Queue import Full, Queue
+except ImportError:
+    from queue import Full, Queue
+from threading import Thread
+
+DEFAULT_QUEUE_SIZE = 10000
+
+
+class QueueHandler(logging.Handler):
+    """ Put log records on a bounded queue without formatting them.
+
+    Records are dropped, and counted in ``dropped``, when the queue is full,
+    so a slow log destination never blocks the reactor.
+    """
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+
+class QueueListener(object):
+    """ Format and write records from a :class:`QueueHandler`'s queue with
+    ``handlers``, in a background thread. """
+
+    def __init__(self, queue, handlers):
+        self.queue = queue
+        self.handlers = handlers
+        self.thread = Thread(target=self._run, name='hamms-logging')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        """ Write out everything that is queued, then stop. """
+        self.queue.put(None)
+        self.thread.join()
+
+    def restore(self):
+        """ Undo :func:`log_in_background`: give the handlers back to the
+        logger they were taken from, then stop. """
+        self.target.removeHandler(self.handler)
+        for handler in self.handlers:
+            self.target.addHandler(handler)
+        self.stop()
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                return
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+
+def log_in_background(target=None, maxsize=DEFAULT_QUEUE_SIZE):
+    """ Move ``target``'s handlers (the root logger's by default) behind a
+    queue, so formatting and I/O happen in a background thread. Returns the
+    started :class:`QueueListener`. """
+    target = target or logging.getLogger()
+    queue = Queue(maxsize)
+    listener = QueueListener(queue, list(target.handlers))
+    for handler in listener.handlers:
+        target.removeHandler(handler)
+    listener.target = target
+    listener.handler = QueueHandler(queue)
+    target.addHandler(listener.handler)
+    listener.start()
+    return listener
@@ -0,0 +1,240 @@
+from bisect import bisect_left
+from collections import OrderedDict
+import time
+
+from twisted.protocols.policies import ProtocolWrapper, WrappingFactory
+
+# Upper bounds, in seconds, of the latency histogram buckets. Hamms
+# deliberately holds connections open, so the buckets run out to minutes.
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+
+
+class Counter(object):
+    """ A number that only goes up.
+
+    Increments are plain attribute updates. Only update a counter from one
+    thread, normally the reactor's, or hold a lock while you do.
+    """
+
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Gauge(Counter):
+    """ A number that goes up and down. """
+
+    __slots__ = ()
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram(object):
+    """ Counts of observations that fell in each of a fixed set of buckets.
+
+    :param tuple buckets: sorted upper bounds; a final +Inf bucket is implied.
+    """
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Family(object):
+    """ A metric, with one child :class:`Counter`, :class:`Gauge` or
+    :class:`Histogram` per combination of label values. """
+
+    def __init__(self, name, kind, help, labelnames, make):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.labelnames = labelnames
+        self.make = make
+        self.children = OrderedDict()
+
+    def labels(self, *values):
+        """ The child for ``values``, created the first time it's asked for.
+        Look children up once and keep them, rather than on every update. """
+        values = tuple(str(v) for v in values)
+        child = self.children.get(values)
+        if child is None:
+            child = self.children.setdefault(values, self.make())
+        return child
+
+    def attach(self, child, *values):
+        """ Report an existing ``child`` under ``values``. """
+        self.children[tuple(str(v) for v in values)] = child
+
+
+def _escape(value):
+    return (value.replace('\\', r'\\').replace('"', r'\"')
+            .replace('\n', r'\n'))
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(name, _escape(value))
+                          for name, value in pairs) + '}'
+
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Registry(object):
+    """ A set of metrics, rendered in the Prometheus text format.
+
+    Collectors are functions called just before rendering, for values that
+    are cheaper to read when asked for than to keep up to date.
+    """
+
+    def __init__(self):
+        self.families = OrderedDict()
+        self.collectors = []
+
+    def _add(self, name, kind, help, labelnames, make):
+        family = Family(name, kind, help, tuple(labelnames), make)
+        self.families[name] = family
+        return family
+
+    def counter(self, name, help, labelnames=()):
+        return self._add(name, 'counter', help, labelnames, Counter)
+
+    def gauge(self, name, help, labelnames=()):
+        return self._add(name, 'gauge', help, labelnames, Gauge)
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._add(name, 'histogram', help, labelnames,
+                         lambda: Histogram(buckets))
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def render(self):
+        for collector in self.collectors:
+            collector()
+        lines = []
+        for family in self.families.values():
+            lines.append('# HELP {0} {1}'.format(family.name, family.help))
+            lines.append('# TYPE {0} {1}'.format(family.name, family.kind))
+            for values, child in list(family.children.items()):
+                if family.kind == 'histogram':
+                    lines.extend(self._histogram_lines(family, values, child))
+                else:
+                    lines.append('{0}{1} {2}'.format(
+                        family.name, _labels(family.labelnames, values),
+                        _number(child.value)))
+        return '\n'.join(lines) + '\n'
+
+    def _histogram_lines(self, family, values, histogram):
+        name, names = family.name, family.labelnames
+        cumulative = 0
+        bounds = [_number(b) for b in histogram.buckets] + ['+Inf']
+        for bound, count in zip(bounds, histogram.counts):
+            cumulative += count
+            yield '{0}_bucket{1} {2}'.format(
+                name, _labels(names, values, [('le', bound)]), cumulative)
+        yield '{0}_sum{1} {2}'.format(name, _labels(names, values),
+                                       _number(histogram.sum))
+        yield '{0}_count{1} {2}'.format(name, _labels(names, values),
+                                         histogram.count)
+
+
+class ServerMetrics(Registry):
+    """ The metrics hamms keeps about itself. """
+
+    def __init__(self):
+        Registry.__init__(self)
+        labels = ('port', 'mode')
+        self.connections = self.counter(
+            'hamms_connections_total', 'Connections accepted.', labels)
+        self.active = self.gauge(
+            'hamms_connections_active', 'Connections currently open.', labels)
+        self.bytes_sent = self.counter(
+            'hamms_bytes_sent_total', 'Bytes written to clients.', labels)
+        self.connection_duration = self.histogram(
+            'hamms_connection_duration_seconds',
+            'Time from accepting a connection to closing it.', labels)
+        self.requests = self.counter(
+            'hamms_requests_total', 'HTTP requests answered by the web ports.',
+            labels + ('status',))
+        self.request_duration = self.histogram(
+            'hamms_request_duration_seconds',
+            'Time to answer an HTTP request on the web ports.', labels)
+        self.pool_threads = self.gauge(
+            'hamms_pool_threads', 'Threads in each thread pool.', ('pool',))
+        self.pool_busy = self.gauge(
+            'hamms_pool_busy', 'Busy threads in each thread pool.', ('pool',))
+        self.pool_queued = self.gauge(
+            'hamms_pool_queued', 'Work waiting for a thread.', ('pool',))
+        self.pool_wait = self.histogram(
+            'hamms_pool_wait_seconds',
+            'Time work waited for a thread to start it.', ('pool',))
+        self.timers = self.gauge(
+            'hamms_slow_byte_streams',
+            'Slow-byte responses waiting for their next write.')
+        self.throttled = self.gauge(
+            'hamms_throttled_streams',
+            'Bandwidth-throttled responses being sent.')
+
+
+class MetricsProtocol(ProtocolWrapper):
+    """ Count a connection and the bytes written to it. """
+
+    def makeConnection(self, transport):
+        self.started = time.time()
+        self.factory.connections.inc()
+        self.factory.active.inc()
+        ProtocolWrapper.makeConnection(self, transport)
+
+    def write(self, data):
+        self.factory.bytes_sent.inc(len(data))
+        ProtocolWrapper.write(self, data)
+
+    def writeSequence(self, data):
+        self.factory.bytes_sent.inc(sum(len(piece) for piece in data))
+        ProtocolWrapper.writeSequence(self, data)
+
+    def connectionLost(self, reason):
+        self.factory.active.dec()
+        self.factory.duration.observe(time.time() - self.started)
+        ProtocolWrapper.connectionLost(self, reason)
+
+
+class MetricsFactory(WrappingFactory):
+    """ Wrap ``wrappedFactory`` so its connections are counted in
+    ``metrics``, labelled with ``port`` and ``mode``. """
+
+    protocol = MetricsProtocol
+
+    def __init__(self, wrappedFactory, metrics, port, mode):
+        WrappingFactory.__init__(self, wrappedFactory)
+        # Looked up once here, so the per-connection cost is attribute access.
+        self.connections = metrics.connections.labels(port, mode)
+        self.active = metrics.active.labels(port, mode)
+        self.bytes_sent = metrics.bytes_sent.labels(port, mode)
+        self.duration = metrics.connection_duration.labels(port, mode)
+
+    def logPrefix(self):
+        return self.wrappedFactory.logPrefix()
@@ -49,3 +49,7 @@ morsedict = {
         ' ': ' '
 }
 
+
+def encode(message):
+    """ Encode ``message`` letter by letter, without separators. """
+    return ''.join(morsedict[letter] for letter in message)
@@ -0,0 +1,146 @@
+import urlparse
+
+# Longest request head the parser will buffer.
+MAX_HEAD_SIZE = 64 * 1024
+
+
+class HeadTooLarge(Exception):
+    """ The client sent more than the parser's limit without finishing a
+    request head. """
+
+
+class RequestHead(object):
+    """ A parsed request line, with the headers and query string parsed only
+    if they're asked for.
+
+    :ivar str raw: the request line and headers, without the blank line that
+        ends them.
+    :ivar str method: e.g. ``GET``, or None if the request line is malformed.
+    :ivar str target: the request target as sent, e.g. ``/foo?bar=1``.
+    :ivar str version: e.g. ``HTTP/1.1``.
+    """
+
+    __slots__ = ('raw', 'method', 'target', 'version', '_query', '_headers')
+
+    def __init__(self, raw):
+        self.raw = raw
+        self._query = None
+        self._headers = None
+        end = raw.find('\r\n')
+        parts = (raw if end < 0 else raw[:end]).split(' ')
+        if len(parts) == 3:
+            self.method, self.target, self.version = parts
+        else:
+            self.method = self.target = self.version = None
+
+    @property
+    def valid(self):
+        return self.method is not None
+
+    @property
+    def request_line(self):
+        end = self.raw.find('\r\n')
+        return self.raw if end < 0 else self.raw[:end]
+
+    @property
+    def path(self):
+        if self.target is None:
+            return None
+        return self.target.split('?', 1)[0]
+
+    @property
+    def query(self):
+        """ The query string, as a dict of lists like ``parse_qs`` returns. """
+        if self._query is None:
+            if self.target is None or '?' not in self.target:
+                self._query = {}
+            else:
+                self._query = urlparse.parse_qs(self.target.split('?', 1)[1])
+        return self._query
+
+    @property
+    def headers(self):
+        """ (name, value) pairs, in the order they were sent. """
+        if self._headers is None:
+            self._headers = []
+            for line in self.raw.split('\r\n')[1:]:
+                name, sep, value = line.partition(':')
+                if sep:
+                    self._headers.append((name.strip(), value.strip()))
+        return self._headers
+
+    def header(self, name, default=''):
+        """ The value of the first ``name`` header, compared without regard
+        to case. Scans the raw head instead of parsing every header. """
+        needle = '\r\n' + name.lower() + ':'
+        head = self.raw.lower()
+        start = head.find(needle)
+        if start < 0:
+            return default
+        start += len(needle)
+        end = head.find('\r\n', start)
+        return self.raw[start:end if end >= 0 else len(head)].strip()
+
+    def keep_alive(self):
+        """ Whether the client asked to keep the connection open. """
+        connection = self.header('connection').lower()
+        if self.version == 'HTTP/1.1':
+            return 'close' not in connection
+        return 'keep-alive' in connection
+
+
+class RequestParser(object):
+    """ Split a stream of bytes into request heads.
+
+    Feed it data as it arrives; a request split across several reads is
+    buffered until the blank line that ends its head, and several requests
+    that arrive in one read all come back from the same :meth:`feed`. Each
+    search resumes where the last one stopped, so a slow client doesn't make
+    the parser rescan its buffer. None of the ports look at request bodies,
+    so bodies with a Content-Length are skipped rather than buffered;
+    chunked request bodies aren't supported.
+
+    :param int max_size: raise :class:`HeadTooLarge` if a head grows past
+        this many bytes.
+    """
+
+    def __init__(self, max_size=MAX_HEAD_SIZE):
+        self.max_size = max_size
+        self.buffer = ''
+        self.scanned = 0
+        # Body bytes still to be skipped before the next head starts.
+        self.skip = 0
+
+    def feed(self, data):
+        """ Add ``data`` and return a list of the :class:`RequestHead` objects
+        it completed. """
+        if self.skip:
+            skipped = min(self.skip, len(data))
+            self.skip -= skipped
+            data = data[skipped:]
+        self.buffer += data
+        heads = []
+        while self.buffer:
+            # Backing up 3 bytes catches a terminator split across reads.
+            end = self.buffer.find('\r\n\r\n', max(0, self.scanned - 3))
+            if end < 0:
+                self.scanned = len(self.buffer)
+                if self.scanned > self.max_size:
+                    raise HeadTooLarge(self.scanned)
+                break
+            if end > self.max_size:
+                raise HeadTooLarge(end)
+            head = RequestHead(self.buffer[:end])
+            heads.append(head)
+            start = end + 4 + _content_length(head)
+            self.skip = max(0, start - len(self.buffer))
+            self.buffer = self.buffer[start:]
+            self.scanned = 0
+        return heads
+
+
+def _content_length(head):
+    try:
+        return max(0, int(head.header('content-length', '0')))
+    except ValueError:
+        return 0
@@ -0,0 +1,351 @@
+""" Keep hamms servers warm, for test processes to lease.
+
+Usage::
+
+    python -m hamms.pool --size 4 -- --keep-alive
+
+Starts ``--size`` hamms servers in subprocesses, each on ports the OS picks,
+and listens on a Unix socket for test processes that want one. A test
+process leases a server, which is its own until the lease is returned::
+
+    from hamms.pool import lease
+
+    with lease() as server:
+        port = server.ports['retries']
+        ...
+
+Leasing costs one round trip over the socket rather than a server start.
+When a lease is returned, the server's state, such as the retries counters,
+is reset before anyone else can lease it. Arguments after ``--`` are passed
+to every server.
+
+The protocol is a line of text each way: the client sends ``lease``, and
+once a server is free the pool answers with a JSON object holding its
+``id`` and ``ports``, mode name -> port number. The lease lasts until the
+client closes the connection.
+"""
+import argparse
+from collections import deque
+import httplib
+import json
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from twisted.internet import defer, protocol, reactor, task, threads
+from twisted.protocols.basic import LineReceiver
+
+logger = logging.getLogger("hamms")
+
+DEFAULT_SIZE = 4
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), 'hamms-pool.sock')
+# Seconds between checks on the servers, for ones that have started
+# listening or have died.
+POLL_INTERVAL = 0.05
+# A server that dies sooner than this after starting is probably failing on
+# startup; wait before starting it again instead of spinning.
+MIN_UPTIME = 1.0
+RESTART_DELAY = 1.0
+
+
+def _server_argv(server_args, ports_file):
+    """ Command line arguments that start a server on OS-picked ports, which
+    writes them to ``ports_file``. The admin port is always included, since
+    that's how the pool resets a server. """
+    argv = list(server_args)
+    for i, arg in enumerate(argv):
+        if arg == '--ports' and i + 1 < len(argv):
+            argv[i + 1] += ',admin'
+        elif arg.startswith('--ports='):
+            argv[i] += ',admin'
+    return ['--port', '0', '--ports-file', ports_file] + argv
+
+
+class Server(object):
+    """ One hamms subprocess in the pool.
+
+    :ivar int id: identifies the server in leases and log lines.
+    :ivar dict ports: mode name -> port number, or None until it's listening.
+    """
+
+    def __init__(self, id, server_args, directory, output=None):
+        self.id = id
+        self.server_args = server_args
+        self.ports_file = os.path.join(directory, '{0}.json'.format(id))
+        self.output = output
+        self.process = None
+        self.started = None
+        self.ports = None
+
+    def start(self):
+        if os.path.exists(self.ports_file):
+            os.remove(self.ports_file)
+        self.ports = None
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'hamms'] +
+            _server_argv(self.server_args, self.ports_file),
+            stdout=self.output, stderr=self.output)
+        self.started = time.time()
+
+    def poll(self):
+        """ Returns 'running', 'ready' the first time the server is seen to be
+        listening, or 'exited'. """
+        if self.process.poll() is not None:
+            return 'exited'
+        if self.ports is None and os.path.exists(self.ports_file):
+            with open(self.ports_file) as f:
+                self.ports = json.load(f)
+            return 'ready'
+        return 'running'
+
+    def reset(self, timeout=5):
+        """ Ask the server to reset its state. Blocks, so run it in a
+        thread. """
+        conn = httplib.HTTPConnection('127.0.0.1', self.ports['admin'],
+                                      timeout=timeout)
+        try:
+            conn.request('POST', '/reset')
+            response = conn.getresponse()
+            response.read()
+        finally:
+            conn.close()
+        if response.status != 200:
+            raise RuntimeError("reset failed with status {0}".format(
+                response.status))
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+
+
+class Pool(object):
+    """ Start ``size`` servers and hand them out one lease at a time.
+
+    :param list server_args: command line arguments for each server.
+    :param output: file the servers write their output to, or None to
+        inherit ours.
+    """
+
+    def __init__(self, size, server_args=(), output=None, clock=None):
+        self.directory = tempfile.mkdtemp(prefix='hamms-pool-')
+        self.servers = [Server(i, list(server_args), self.directory, output)
+                        for i in range(size)]
+        self.clock = clock or reactor
+        # Servers that are listening and not leased, and the leases waiting
+        # for one of them.
+        self.free = deque()
+        self.waiting = deque()
+        self.leased = set()
+        self._loop = None
+
+    def start(self):
+        for server in self.servers:
+            server.start()
+        self._loop = task.LoopingCall(self._check)
+        self._loop.clock = self.clock
+        self._loop.start(POLL_INTERVAL, now=False)
+
+    def stop(self):
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        for server in self.servers:
+            server.stop()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _check(self):
+        for server in self.servers:
+            if server.process is None:
+                continue
+            state = server.poll()
+            if state == 'ready':
+                logger.info("server {id} is listening".format(id=server.id))
+                self._give(server)
+            elif state == 'exited':
+                self._restart(server)
+
+    def _restart(self, server):
+        logger.warning("server {id} exited with status {status}, "
+                       "restarting".format(id=server.id,
+                                           status=server.process.returncode))
+        if server in self.free:
+            self.free.remove(server)
+        # A leased server is restarted now, but only rejoins the pool when
+        # its lease is returned.
+        delay = 0
+        if time.time() - server.started < MIN_UPTIME:
+            delay = RESTART_DELAY
+        server.process = None
+        server.ports = None
+        self.clock.callLater(delay, server.start)
+
+    def acquire(self):
+        """ A Deferred that fires with a free server, once there is one. """
+        if self.free:
+            server = self.free.popleft()
+            self.leased.add(server)
+            return defer.succeed(server)
+        d = defer.Deferred(lambda d: self.waiting.remove(d))
+        self.waiting.append(d)
+        return d
+
+    def release(self, server):
+        """ Reset ``server``, then give it to the next lease. """
+        self.leased.discard(server)
+        if server.ports is None:
+            # It died while leased and hasn't come back yet; it's given out
+            # again once it's listening.
+            return
+        process = server.process
+        d = threads.deferToThread(server.reset)
+
+        def failed(failure):
+            logger.warning("server {id} failed to reset, restarting: "
+                           "{error}".format(id=server.id,
+                                            error=failure.getErrorMessage()))
+            # Unless it already died and was restarted.
+            if server.process is process:
+                server.stop()
+                self._restart(server)
+        d.addCallbacks(lambda _: self._give(server), failed)
+        return d
+
+    def _give(self, server):
+        if server in self.leased or server in self.free:
+            return
+        if server.process is None or server.process.poll() is not None:
+            return
+        if self.waiting:
+            self.leased.add(server)
+            self.waiting.popleft().callback(server)
+        else:
+            self.free.append(server)
+
+
+class LeaseProtocol(LineReceiver):
+    """ One client's lease: ``lease`` waits for a free server and answers
+    with its ports, and closing the connection returns it. """
+
+    delimiter = '\n'
+
+    def connectionMade(self):
+        self.pending = None
+        self.server = None
+
+    def lineReceived(self, line):
+        if line.strip() != 'lease':
+            self.sendLine(json.dumps({'error': 'unknown command'}))
+            self.transport.loseConnection()
+            return
+        if self.pending is not None or self.server is not None:
+            self.sendLine(json.dumps({'error': 'already leased'}))
+            return
+        d = self.pending = self.factory.pool.acquire()
+        d.addCallback(self._leased)
+        # Cancelled if the client goes away first.
+        d.addErrback(lambda failure: failure.trap(
+            defer.CancelledError))
+
+    def _leased(self, server):
+        self.pending = None
+        self.server = server
+        self.sendLine(json.dumps({'id': server.id, 'ports': server.ports},
+                                 sort_keys=True))
+
+    def connectionLost(self, reason):
+        if self.pending is not None:
+            self.pending.cancel()
+        if self.server is not None:
+            self.factory.pool.release(self.server)
+            self.server = None
+
+
+class LeaseFactory(protocol.Factory):
+
+    protocol = LeaseProtocol
+
+    def __init__(self, pool):
+        self.pool = pool
+
+
+class Lease(object):
+    """ A server leased from the pool listening on ``path``, until
+    :meth:`release` is called or the process exits. Doesn't import Twisted,
+    so leasing adds nothing to a test process's startup.
+
+    :ivar int id: which of the pool's servers this is.
+    :ivar dict ports: mode name -> port number.
+    :param float timeout: seconds to wait for a free server.
+    """
+
+    def __init__(self, path=DEFAULT_SOCKET, timeout=30):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.settimeout(timeout)
+            self.sock.connect(path)
+            self.sock.sendall('lease\n')
+            line = self.sock.makefile('r').readline()
+        except Exception:
+            self.sock.close()
+            raise
+        if not line:
+            self.sock.close()
+            raise RuntimeError("the pool closed the connection")
+        response = json.loads(line)
+        if 'error' in response:
+            self.sock.close()
+            raise RuntimeError(response['error'])
+        self.id = response['id']
+        self.ports = response['ports']
+
+    def release(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+lease = Lease
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m hamms.pool',
+        description='Keep hamms servers running for test processes to lease')
+    parser.add_argument('--size', type=int, default=DEFAULT_SIZE,
+                        help='number of servers to keep running')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET,
+                        help='Unix socket to take lease requests on')
+    parser.add_argument('--verbose', action='store_true',
+                        help="show the servers' output")
+    parser.add_argument('server_args', nargs=argparse.REMAINDER,
+                        help='arguments for each hamms server, after --')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    server_args = [a for a in args.server_args if a != '--']
+    output = None if args.verbose else open(os.devnull, 'w')
+    pool = Pool(args.size, server_args, output)
+    # wantPID takes a lock next to the socket, and removes the socket a
+    # pool that's no longer running left behind.
+    reactor.listenUNIX(args.socket, LeaseFactory(pool), wantPID=True)
+    pool.start()
+    reactor.addSystemEventTrigger('before', 'shutdown', pool.stop)
+    logger.info("Leasing {size} servers on {path}".format(size=args.size,
+                                                          path=args.socket))
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+from twisted.internet import reactor
+from twisted.internet.interfaces import IPullProducer, IPushProducer
+from zope.interface import implementer
+
+# Size of the shared buffers repeated bodies are written from. Writing the
+# same string object over and over means a body of any length costs one
+# buffer, not one copy per connection.
+CHUNK_SIZE = 64 * 1024
+
+
+@implementer(IPullProducer)
+class RepeatedBytesProducer(object):
+    """ Write ``prefix``, then ``length`` bytes taken from ``chunk`` over and
+    over, then ``suffix``.
+
+    This is a pull producer: the consumer asks for more data each time its
+    write buffer drains, so a slow reader never makes the server buffer more
+    than one chunk per connection, however large ``length`` is.
+
+    :param consumer: the transport to write to.
+    :param str chunk: the buffer to repeat.
+    :param int length: number of bytes of ``chunk`` data to write.
+    :param finished: called with no arguments once everything is written.
+    """
+
+    def __init__(self, consumer, chunk, length, prefix='', suffix='',
+                 finished=None):
+        self.consumer = consumer
+        self.chunk = chunk
+        self.remaining = length
+        self.prefix = prefix
+        self.suffix = suffix
+        self.finished = finished
+        self.stopped = False
+
+    def start(self):
+        self.consumer.registerProducer(self, False)
+
+    def resumeProducing(self):
+        if self.stopped:
+            return
+        if self.prefix:
+            self.consumer.write(self.prefix)
+            self.prefix = ''
+        elif self.remaining >= len(self.chunk):
+            self.consumer.write(self.chunk)
+            self.remaining -= len(self.chunk)
+        elif self.remaining > 0:
+            self.consumer.write(self.chunk[:self.remaining])
+            self.remaining = 0
+        elif self.suffix:
+            self.consumer.write(self.suffix)
+            self.suffix = ''
+        else:
+            self.stopped = True
+            self.consumer.unregisterProducer()
+            if self.finished is not None:
+                self.finished()
+
+    def stopProducing(self):
+        self.stopped = True
+
+
+@implementer(IPullProducer)
+class IteratorProducer(object):
+    """ Write each string ``pieces`` yields, one per resumeProducing call.
+
+    Like :class:`RepeatedBytesProducer`, the consumer pulls data as its write
+    buffer drains, so only the current piece is held in memory.
+
+    :param finished: called with no arguments once everything is written.
+    """
+
+    def __init__(self, consumer, pieces, finished=None):
+        self.consumer = consumer
+        self.pieces = iter(pieces)
+        self.finished = finished
+        self.stopped = False
+
+    def start(self):
+        self.consumer.registerProducer(self, False)
+
+    def resumeProducing(self):
+        if self.stopped:
+            return
+        try:
+            piece = next(self.pieces)
+        except StopIteration:
+            self.stopped = True
+            self.consumer.unregisterProducer()
+            if self.finished is not None:
+                self.finished()
+        else:
+            self.consumer.write(piece)
+
+    def stopProducing(self):
+        self.stopped = True
+
+
+@implementer(IPushProducer)
+class StreamingProducer(object):
+    """ Write each string ``pieces`` yields, as fast as the consumer will
+    take them, until it pauses us.
+
+    This is a push producer: it writes in a loop until the transport's
+    buffer fills and the transport calls :meth:`pauseProducing`, then picks
+    up again on :meth:`resumeProducing` once the buffer drains. With a lazy
+    ``pieces`` that yields the same shared buffers over and over, the body
+    can be any length, even endless, in constant memory.
+
+    After ``burst`` writes without being paused, it lets the reactor run
+    other connections before carrying on.
+
+    :param finished: called with no arguments once everything is written.
+    """
+
+    def __init__(self, consumer, pieces, finished=None, burst=16, clock=None):
+        self.consumer = consumer
+        self.pieces = iter(pieces)
+        self.finished = finished
+        self.burst = burst
+        self.clock = clock or reactor
+        self.paused = False
+        self.stopped = False
+        self._producing = False
+        self._call = None
+
+    def start(self):
+        self.consumer.registerProducer(self, True)
+        self.resumeProducing()
+
+    def resumeProducing(self):
+        self.paused = False
+        self._call = None
+        # Writing can pause and resume us synchronously; the running loop
+        # will notice.
+        if self._producing:
+            return
+        self._producing = True
+        try:
+            self._produce()
+        finally:
+            self._producing = False
+
+    def _produce(self):
+        for _ in xrange(self.burst):
+            if self.paused or self.stopped:
+                return
+            try:
+                piece = next(self.pieces)
+            except StopIteration:
+                self.stopped = True
+                self.consumer.unregisterProducer()
+                if self.finished is not None:
+                    self.finished()
+                return
+            self.consumer.write(piece)
+        if not (self.paused or self.stopped):
+            self._call = self.clock.callLater(0, self.resumeProducing)
+
+    def pauseProducing(self):
+        self.paused = True
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+
+    def stopProducing(self):
+        self.stopped = True
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
@@ -0,0 +1,198 @@
+import logging
+import math
+import random
+
+from twisted.internet import reactor, task
+from twisted.internet.interfaces import IPushProducer
+from zope.interface import implementer
+
+from .producers import CHUNK_SIZE
+
+# Seconds between ticks of the shared timer.
+DEFAULT_RESOLUTION = 0.05
+
+logger = logging.getLogger("hamms")
+
+
+@implementer(IPushProducer)
+class ThrottledStream(object):
+    """ A body of ``length`` bytes written at about ``rate`` bytes a second.
+
+    Create these with :meth:`ThrottleScheduler.add`. Each tick adds tokens
+    to the stream's bucket and writes as many bytes as there are whole
+    tokens. The bytes are slices of one shared buffer, so a stream costs the
+    same memory whatever its length.
+
+    The stream is registered as the transport's producer, so while the
+    client isn't reading, the transport pauses it and no data is buffered.
+    """
+
+    def __init__(self, scheduler, transport, chunk, length, rate, jitter=0.0,
+                 stall_at=None, stall=0.0, finished=None):
+        self.scheduler = scheduler
+        self.transport = transport
+        self.chunk = chunk
+        self.remaining = length
+        self.rate = float(rate)
+        self.jitter = jitter
+        self.stall_at = stall_at
+        self.stall = stall
+        self.finished = finished
+        if math.isinf(self.rate) or math.isnan(self.rate) or self.rate <= 0:
+            raise ValueError("rate must be positive and finite", rate)
+        # Enough for a couple of ticks, so a late tick doesn't lose bytes,
+        # and at least one byte, so very slow streams still make progress.
+        self.capacity = max(1.0, 2 * self.rate * scheduler.resolution)
+        self.tokens = 0.0
+        self.sent = 0
+        self.stalled_until = None
+        self.paused = False
+        self.done = False
+
+    def tick(self, now, elapsed):
+        """ Add tokens for ``elapsed`` seconds and write what they allow.
+        Returns False once the stream is finished. """
+        if self.done:
+            return False
+        if self.stalled_until is not None:
+            if now < self.stalled_until:
+                return True
+            self.stalled_until = None
+        rate = self.rate
+        if self.jitter:
+            rate *= max(0.0, 1 + self.scheduler.random.uniform(-self.jitter,
+                                                               self.jitter))
+        self.tokens = min(self.capacity, self.tokens + rate * elapsed)
+        if self.paused:
+            return True
+
+        # The epsilon keeps float error from costing a byte on some ticks.
+        count = min(int(self.tokens + 1e-9), self.remaining)
+        if self.stall_at is not None and self.sent < self.stall_at:
+            count = min(count, self.stall_at - self.sent)
+        if count > 0:
+            self.tokens -= count
+            self._write(count)
+        if self.stall_at is not None and self.sent == self.stall_at:
+            self.stall_at = None
+            self.stalled_until = now + self.stall
+        if self.remaining == 0:
+            self._finish()
+            return False
+        return True
+
+    def _write(self, count):
+        self.sent += count
+        self.remaining -= count
+        full, rest = divmod(count, len(self.chunk))
+        pieces = [self.chunk] * full
+        if rest:
+            pieces.append(self.chunk[:rest])
+        self.transport.writeSequence(pieces)
+
+    def _finish(self):
+        self.done = True
+        self.transport.unregisterProducer()
+        if self.finished is not None:
+            self.finished()
+
+    def abort(self):
+        """ Stop without finishing the body, and close the connection. """
+        self.done = True
+        self.transport.unregisterProducer()
+        self.transport.loseConnection()
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+    def stopProducing(self):
+        self.cancel()
+
+    def cancel(self):
+        self.scheduler.cancel(self)
+
+
+class ThrottleScheduler(object):
+    """ Drive every throttled stream from one shared timer.
+
+    A single LoopingCall ticks every ``resolution`` seconds while there are
+    streams, and each tick visits every stream once, so thousands of
+    throttled connections cost one timer rather than one each.
+
+    :param float resolution: seconds between ticks.
+    :param clock: an IReactorTime provider, the reactor by default.
+    """
+
+    def __init__(self, resolution=DEFAULT_RESOLUTION, clock=None, seed=None):
+        self.resolution = resolution
+        self.clock = clock or reactor
+        self.random = random.Random(seed)
+        self.streams = set()
+        self._loop = None
+
+    @property
+    def active(self):
+        return len(self.streams)
+
+    def add(self, transport, length, rate, chunk='a' * CHUNK_SIZE, **kwargs):
+        """ Write ``length`` bytes of ``chunk`` data to ``transport`` at
+        ``rate`` bytes a second. See :class:`ThrottledStream` for the other
+        arguments. """
+        stream = ThrottledStream(self, transport, chunk, length, rate,
+                                 **kwargs)
+        transport.registerProducer(stream, True)
+        self.streams.add(stream)
+        if self._loop is None:
+            self._start()
+        return stream
+
+    def _start(self):
+        loop = self._loop = task.LoopingCall.withCount(self._advance)
+        loop.clock = self.clock
+        loop.start(self.resolution, now=False).addErrback(self._failed, loop)
+
+    def cancel(self, stream):
+        if stream.done:
+            return
+        stream.done = True
+        self.streams.discard(stream)
+        self._maybe_stop()
+
+    def _advance(self, count):
+        now = self.clock.seconds()
+        elapsed = count * self.resolution
+        for stream in list(self.streams):
+            try:
+                if stream.tick(now, elapsed):
+                    continue
+            except Exception:
+                # One broken stream mustn't stop the timer every other
+                # stream shares.
+                logger.exception("throttled stream failed, closing it")
+                self._abort(stream)
+            self.streams.discard(stream)
+        self._maybe_stop()
+
+    def _abort(self, stream):
+        try:
+            stream.abort()
+        except Exception:
+            logger.exception("couldn't close a failed throttled stream")
+
+    def _failed(self, failure, loop):
+        # The timer stopped on an error, so start a new one for the streams
+        # that are left.
+        logger.error("throttle timer failed: %s", failure.getTraceback())
+        if self._loop is loop:
+            self._loop = None
+            if self.streams:
+                self._start()
+
+    def _maybe_stop(self):
+        if not self.streams and self._loop is not None:
+            if self._loop.running:
+                self._loop.stop()
+            self._loop = None
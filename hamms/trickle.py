@@ -0,0 +1,104 @@
+from twisted.internet import reactor, task
+
+# Seconds between ticks of the shared timer. Stream intervals are rounded to
+# a whole number of ticks.
+DEFAULT_RESOLUTION = 0.05
+
+
+class TrickleStream(object):
+    """ A response being written a few bytes at a time.
+
+    Create these with :meth:`TrickleScheduler.add`, and call :meth:`cancel`
+    when the connection goes away.
+    """
+
+    def __init__(self, scheduler, transport, data, chunk_size, ticks):
+        self.scheduler = scheduler
+        self.transport = transport
+        self.data = data
+        self.chunk_size = chunk_size
+        self.ticks = ticks
+        self.offset = 0
+        self.slot = None
+        self.done = False
+
+    def step(self):
+        """ Write the next chunk, or close the connection once everything
+        has been written. Returns True if the stream wants another tick. """
+        if self.offset >= len(self.data):
+            self.done = True
+            self.transport.loseConnection()
+            return False
+        end = self.offset + self.chunk_size
+        self.transport.write(self.data[self.offset:end])
+        self.offset = end
+        return True
+
+    def cancel(self):
+        self.scheduler.cancel(self)
+
+
+class TrickleScheduler(object):
+    """ Drive every slow connection from one shared timer.
+
+    Instead of scheduling a DelayedCall per byte, streams are kept in a timer
+    wheel: a dict mapping a tick number to the streams that are due on that
+    tick. A single LoopingCall advances the wheel, and only runs while there
+    are streams to advance.
+
+    :param float resolution: seconds between ticks.
+    :param clock: an IReactorTime provider, the reactor by default.
+    """
+
+    def __init__(self, resolution=DEFAULT_RESOLUTION, clock=None):
+        self.resolution = resolution
+        self.clock = clock or reactor
+        self.now = 0
+        self.wheel = {}
+        self.active = 0
+        self._loop = None
+
+    def add(self, transport, data, chunk_size=1, interval=5.0):
+        """ Write ``chunk_size`` bytes of ``data`` to ``transport`` every
+        ``interval`` seconds, starting ``interval`` seconds from now, then
+        close the connection one interval after the last write. """
+        ticks = max(1, int(round(interval / self.resolution)))
+        stream = TrickleStream(self, transport, data, max(1, chunk_size), ticks)
+        self.active += 1
+        self._schedule(stream)
+        return stream
+
+    def cancel(self, stream):
+        if stream.done:
+            return
+        stream.done = True
+        self.active -= 1
+        streams = self.wheel.get(stream.slot)
+        if streams is not None:
+            streams.discard(stream)
+            if not streams:
+                del self.wheel[stream.slot]
+        self._maybe_stop()
+
+    def _schedule(self, stream):
+        stream.slot = self.now + stream.ticks
+        self.wheel.setdefault(stream.slot, set()).add(stream)
+        if self._loop is None:
+            self._loop = task.LoopingCall.withCount(self._advance)
+            self._loop.clock = self.clock
+            self._loop.start(self.resolution, now=False)
+
+    def _advance(self, count):
+        for _ in range(count):
+            self.now += 1
+            for stream in self.wheel.pop(self.now, ()):
+                if stream.step():
+                    self._schedule(stream)
+                else:
+                    self.active -= 1
+        self._maybe_stop()
+
+    def _maybe_stop(self):
+        if not self.wheel and self._loop is not None:
+            self._loop.stop()
+            self._loop = None
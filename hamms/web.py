@@ -0,0 +1,383 @@
+""" The ports served with twisted.web, which is only imported once
+:func:`hamms.listen` builds one of them. """
+import copy
+import json
+from threading import Lock, Thread
+import time
+
+from twisted.internet import reactor
+from twisted.python.threadpool import ThreadPool
+from twisted.web.resource import Resource, getChildForRequest
+from twisted.web.server import NOT_DONE_YET, Site
+from twisted.web.wsgi import WSGIResource
+
+from . import (CHUNK_SIZE, SERVER_HEADER, _chaos_weights, _echo_headers, _log,
+               _parse_chaos_weights, _should_log, unparseable_variant)
+from .accesslog import request_record
+from .dispatch import MODE_HEADER
+from .metrics import Histogram
+from .producers import IteratorProducer
+
+
+class HammsSite(Site):
+    # Set by listen(): the port and mode requests are reported under, and
+    # where they are reported.
+    port = None
+    mode = None
+    access_log = None
+    metrics = None
+
+    def getResourceFor(self, request):
+        request.setHeader('Server', SERVER_HEADER)
+        request.hamms_started = time.time()
+        request.hamms_mode = self.mode
+        if self.access_log is not None:
+            request.notifyFinish().addErrback(self._client_gone, request)
+        request.site = self
+        request.sitepath = copy.copy(request.prepath)
+        return getChildForRequest(self.rootFor(request), request)
+
+    def rootFor(self, request):
+        """ The resource to look ``request`` up in. """
+        return self.resource
+
+    def _client_gone(self, failure, request):
+        self.access_log.record(request_record(request, request.hamms_mode,
+                                              close_reason='client'))
+
+    def log(self, request):
+        mode = request.hamms_mode
+        if self.metrics is not None:
+            self.metrics.requests.labels(self.port, mode, request.code).inc()
+            self.metrics.request_duration.labels(self.port, mode).observe(
+                time.time() - request.hamms_started)
+        if self.access_log is not None:
+            self.access_log.record(request_record(request, mode))
+        Site.log(self, request)
+
+
+class DispatchSite(HammsSite):
+    """ Serve every mode from one port.
+
+    Each request picks its mode with a ``/mode/<name>`` path prefix, which is
+    stripped before the mode sees the request, or an ``X-Hamms-Mode: <name>``
+    header. Web modes answer on the same connection, so it can be kept alive
+    and reused for other modes; a raw mode takes the connection over.
+
+    :param dict modes: mode name -> the resource that serves it.
+    """
+
+    def __init__(self, modes):
+        HammsSite.__init__(self, ModeIndexResource(sorted(modes)))
+        self.modes = modes
+
+    def rootFor(self, request):
+        name = request.getHeader(MODE_HEADER)
+        if name is None and request.postpath[:1] == ['mode'] and \
+                len(request.postpath) > 1:
+            name = request.postpath[1]
+            request.prepath.extend(request.postpath[:2])
+            del request.postpath[:2]
+        resource = self.modes.get(name)
+        if resource is None:
+            return self.resource
+        request.hamms_mode = name
+        return resource
+
+
+class ModeIndexResource(Resource):
+    """ 404 for requests to the dispatch port that don't name a mode. """
+
+    isLeaf = True
+
+    def __init__(self, names):
+        Resource.__init__(self)
+        self.names = names
+
+    def render(self, request):
+        request.setResponseCode(404)
+        request.setHeader('Content-Type', 'application/json')
+        return json.dumps({
+            'error': 'Pick a mode with a /mode/<name> path or an '
+                     '{header} header'.format(header=MODE_HEADER),
+            'modes': self.names,
+            'success': False,
+        })
+
+class MeteredThreadPool(ThreadPool):
+    """ A ThreadPool that keeps track of how saturated it is.
+
+    Every WSGI app gets its own pool so a flood of requests to one port can't
+    starve the others. :meth:`stats` reports how much work is waiting for a
+    thread, how many threads are busy and how long work waited to start.
+    """
+
+    @staticmethod
+    def threadFactory(*args, **kw):
+        # Like the rest of HammsServer, never keep the process alive.
+        thread = Thread(*args, **kw)
+        thread.daemon = True
+        return thread
+
+    def __init__(self, minthreads=5, maxthreads=20, name=None):
+        ThreadPool.__init__(self, minthreads, maxthreads, name)
+        self._stats_lock = Lock()
+        self.queued = 0
+        self.busy = 0
+        self.completed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.waits = Histogram()
+
+    def callInThreadWithCallback(self, onResult, func, *args, **kw):
+        queued_at = time.time()
+        with self._stats_lock:
+            self.queued += 1
+
+        def metered(*args, **kw):
+            wait = time.time() - queued_at
+            with self._stats_lock:
+                self.queued -= 1
+                self.busy += 1
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+                self.waits.observe(wait)
+            try:
+                return func(*args, **kw)
+            finally:
+                with self._stats_lock:
+                    self.busy -= 1
+                    self.completed += 1
+
+        ThreadPool.callInThreadWithCallback(self, onResult, metered, *args,
+                                            **kw)
+
+    def stats(self):
+        with self._stats_lock:
+            started = self.completed + self.busy
+            return {
+                'min_threads': self.min,
+                'max_threads': self.max,
+                'threads': len(self.threads),
+                'queued': self.queued,
+                'busy': self.busy,
+                'completed': self.completed,
+                'wait_avg': self.wait_total / started if started else 0.0,
+                'wait_max': self.wait_max,
+            }
+
+
+def wsgi_site(_reactor, listeners, name, app, min_threads, max_threads):
+    """ Serve the WSGI ``app`` from its own :class:`MeteredThreadPool`,
+    registered in ``listeners`` as ``name``. """
+    pool = MeteredThreadPool(min_threads, max_threads, name="hamms-" + name)
+    _reactor.callWhenRunning(pool.start)
+    _reactor.addSystemEventTrigger('during', 'shutdown', pool.stop)
+    listeners.pools[name] = pool
+    listeners.metrics.pool_wait.attach(pool.waits, name)
+    return HammsSite(WSGIResource(_reactor, pool, app))
+
+
+class MetricsResource(Resource):
+    """ Serve the server's metrics in the Prometheus text format. """
+
+    isLeaf = True
+
+    def __init__(self, metrics):
+        Resource.__init__(self)
+        self.metrics = metrics
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        return self.metrics.render()
+
+
+class ResetResource(Resource):
+    """ ``POST /reset`` forgets the state earlier requests left behind; see
+    :meth:`~hamms.Listeners.reset`. """
+
+    isLeaf = True
+
+    def __init__(self, listeners):
+        Resource.__init__(self)
+        self.listeners = listeners
+
+    def render_POST(self, request):
+        self.listeners.reset()
+        request.setHeader('Content-Type', 'application/json')
+        return json.dumps({'reset': True})
+
+
+# Most upcoming chaos decisions GET /chaos will list.
+MAX_CHAOS_PEEK = 1000
+
+
+def _json(request, value):
+    request.setHeader('Content-Type', 'application/json')
+    return json.dumps(value, sort_keys=True)
+
+
+class ChaosResource(Resource):
+    """ ``GET /chaos`` reports the chaos port's schedule: its seed and
+    weights, how many connections it has decided, how often it picked each
+    mode, and with ``?next=<n>``, the modes it will pick next. """
+
+    def __init__(self, schedule):
+        Resource.__init__(self)
+        self.schedule = schedule
+        self.putChild('reset', ChaosResetResource(schedule))
+
+    def render_GET(self, request):
+        state = self.schedule.state()
+        try:
+            count = int(request.args.get('next', [0])[0])
+        except ValueError:
+            count = 0
+        if count > 0:
+            state['next'] = self.schedule.peek(min(count, MAX_CHAOS_PEEK))
+        return _json(request, state)
+
+
+class ChaosResetResource(Resource):
+    """ ``POST /chaos/reset`` starts the schedule again from the beginning,
+    with a new ``?seed=<int>`` or ``?weights=<mode>=<weight>,...`` if they're
+    given. New weights can only name modes the port started with. """
+
+    isLeaf = True
+
+    def __init__(self, schedule):
+        Resource.__init__(self)
+        self.schedule = schedule
+
+    def render_POST(self, request):
+        try:
+            seed = request.args.get('seed', [None])[0]
+            seed = int(seed) if seed is not None else None
+            weights = request.args.get('weights', [None])[0]
+            if weights is not None:
+                weights = _chaos_weights(_parse_chaos_weights(weights))
+                # Only the modes the port started with were built.
+                added = set(weights) - set(self.schedule.modes)
+                if added:
+                    raise ValueError("the chaos port can't pick {0}".format(
+                        ', '.join(sorted(added))))
+            self.schedule.reset(seed, weights)
+        except ValueError as e:
+            request.setResponseCode(400)
+            return _json(request, {'error': str(e)})
+        return _json(request, self.schedule.state())
+
+
+class AdminResource(Resource):
+    """ The admin port, for looking at hamms itself rather than testing
+    clients against it. """
+
+    def __init__(self, listeners):
+        Resource.__init__(self)
+        self.putChild('metrics', MetricsResource(listeners.metrics))
+        self.putChild('reset', ResetResource(listeners))
+        if listeners.chaos is not None:
+            self.putChild('chaos', ChaosResource(listeners.chaos))
+
+# Longest ?sleep= the sleep port accepts, in seconds.
+MAX_SLEEP = 3600
+
+
+class SleepResource(Resource):
+    """ Sleep for ?sleep=<float> seconds, then echo the request headers.
+
+    The delay is a reactor timer rather than a blocking call in the thread
+    pool, so the number of concurrent sleepers is only bounded by the number
+    of open file descriptors.
+    """
+
+    PORT = 8
+    isLeaf = True
+
+    def render(self, request):
+        request.setHeader('Content-Type', 'application/json')
+        n = request.args.get('sleep', [5])[0]
+        try:
+            n = float(n)
+            if not 0 <= n <= MAX_SLEEP:
+                raise ValueError(n)
+        except ValueError:
+            request.setResponseCode(400)
+            _log_request(self.PORT, request)
+            return json.dumps({
+                'error': 'Please pass a number of seconds between 0 and '
+                         '{max}'.format(max=MAX_SLEEP),
+                'success': False,
+            })
+
+        call = reactor.callLater(n, self._finish, request)
+        request.notifyFinish().addErrback(lambda _: call.cancel())
+        return NOT_DONE_YET
+
+    def _finish(self, request):
+        _log_request(self.PORT, request)
+        request.write(json.dumps(_request_headers(request)))
+        request.finish()
+
+
+def _request_headers(request):
+    return _echo_headers((name, ', '.join(values)) for name, values in
+                         request.requestHeaders.getAllRawHeaders())
+
+def _log_request(port_offset, request):
+    if not _should_log(port_offset):
+        return
+    url_line = "{method} {uri} HTTP/1.0".format(method=request.method,
+                                                uri=request.uri)
+    ua = request.getHeader('user-agent') or ''
+    _log(request.getClientIP(), request.getHost().port, url_line,
+         request.code, ua=ua)
+
+def _repeat_body(body, size):
+    """ Yield ``size`` bytes of ``body`` repeated, in ~CHUNK_SIZE pieces. """
+    chunk = body * max(1, CHUNK_SIZE // len(body))
+    while size > len(chunk):
+        yield chunk
+        size -= len(chunk)
+    yield chunk[:size]
+
+class UnparseableResource(Resource):
+    """ Respond with a content type the Accept header says the client can't
+    parse.
+
+    Pass ``?size=<int>`` to get a body of exactly that many bytes, made by
+    repeating the usual one. It is streamed with backpressure, so any size
+    uses the same amount of memory.
+    """
+
+    PORT = 14
+    isLeaf = True
+
+    def render(self, request):
+        content_type, body = unparseable_variant(
+            request.getHeader('accept') or '')
+        size = request.args.get('size', [None])[0]
+        if size is None:
+            request.setHeader('Content-Type', content_type)
+            _log_request(self.PORT, request)
+            return body
+
+        try:
+            size = int(size)
+            if size < 0:
+                raise ValueError(size)
+        except ValueError:
+            request.setResponseCode(400)
+            request.setHeader('Content-Type', 'application/json')
+            _log_request(self.PORT, request)
+            return json.dumps({
+                'error': 'Please pass a non-negative integer size',
+                'success': False,
+            })
+
+        request.setHeader('Content-Type', content_type)
+        request.setHeader('Content-Length', str(size))
+        _log_request(self.PORT, request)
+        IteratorProducer(request, _repeat_body(body, size),
+                         finished=request.finish).start()
+        return NOT_DONE_YET
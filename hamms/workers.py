@@ -0,0 +1,85 @@
+import errno
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+logger = logging.getLogger("hamms")
+
+# A worker that dies sooner than this after starting is probably failing on
+# startup; wait before starting it again instead of spinning.
+MIN_UPTIME = 1.0
+RESTART_DELAY = 1.0
+
+
+def reuse_port_socket(port, interface='', backlog=50):
+    """ A listening socket for ``port`` that other processes can bind too,
+    with the kernel spreading connections between them. """
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        raise RuntimeError("SO_REUSEPORT is not supported on this platform")
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((interface, port))
+        sock.listen(backlog)
+        sock.setblocking(False)
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+
+class Supervisor(object):
+    """ Run ``workers`` hamms processes that all bind the same ports with
+    SO_REUSEPORT, and restart any that die.
+
+    :param list argv: command line arguments for each worker.
+    :param int workers: number of worker processes.
+    """
+
+    def __init__(self, argv, workers):
+        self.argv = argv
+        self.workers = workers
+        self.children = {}
+        self.stopping = False
+
+    def spawn(self):
+        child = subprocess.Popen([sys.executable, '-m', 'hamms'] + self.argv)
+        self.children[child.pid] = (child, time.time())
+        logger.info("started worker {pid}".format(pid=child.pid))
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+        for child, started in self.children.values():
+            try:
+                child.terminate()
+            except OSError:
+                pass
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for _ in range(self.workers):
+            self.spawn()
+
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if pid not in self.children:
+                continue
+            child, started = self.children.pop(pid)
+            if self.stopping:
+                continue
+            logger.warning("worker {pid} exited with status {status}, "
+                           "restarting".format(pid=pid, status=status))
+            if time.time() - started < MIN_UPTIME:
+                time.sleep(RESTART_DELAY)
+            self.spawn()
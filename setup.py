@@ -13,5 +13,9 @@ setup(
     url='https://github.com/kevinburke/hamms',
     keywords=['testing', 'server', 'http',],
     # XXX, pin these down
-    install_requires=['flask', 'httpbin', 'twisted'],
+    # The dispatch port relies on HTTPChannel internals, tested with these
+    # versions of Twisted; see hamms.dispatch.check_channel.
+    install_requires=['flask', 'httpbin', 'twisted>=20.3,<21'],
+    # The asyncio backend, which needs asyncio's backport on Python 2.
+    extras_require={'asyncio': ['trollius; python_version < "3"']},
 )
@@ -0,0 +1,94 @@
+import json
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_equal, assert_true
+from twisted.internet.protocol import Factory, Protocol
+from twisted.python.failure import Failure
+from twisted.internet.error import ConnectionDone
+from twisted.test.proto_helpers import StringTransport
+
+from hamms.accesslog import AccessLog, AccessLogFactory
+
+
+def _read(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+class Echo(Protocol):
+    def dataReceived(self, data):
+        self.request_line = data.split('\r\n', 1)[0]
+        self.status = 200
+        self.transport.writeSequence(['HTTP/1.1 200 OK\r\n', '\r\n'])
+        self.transport.loseConnection()
+
+
+def test_access_log_writes_lines():
+    d = tempfile.mkdtemp()
+    try:
+        log = AccessLog(os.path.join(d, 'access.log'))
+        log.record({'mode': 'a'})
+        log.record({'mode': 'b'})
+        log.close()
+        assert_equal(_read(log.path), [{'mode': 'a'}, {'mode': 'b'}])
+        assert_equal(log.stats()['written'], 2)
+    finally:
+        shutil.rmtree(d)
+
+
+def test_access_log_pid_and_rotation():
+    d = tempfile.mkdtemp()
+    try:
+        log = AccessLog(os.path.join(d, 'access-{pid}.log'), max_bytes=1,
+                        backup_count=2, batch_size=1)
+        assert_equal(log.path,
+                     os.path.join(d, 'access-{0}.log'.format(os.getpid())))
+        for i in range(4):
+            log.record({'n': i})
+        log.close()
+        assert_equal(_read(log.path + '.1'), [{'n': 3}])
+        assert_equal(_read(log.path + '.2'), [{'n': 2}])
+        assert_true(not os.path.exists(log.path + '.3'))
+    finally:
+        shutil.rmtree(d)
+
+
+def test_access_log_drops_when_full():
+    d = tempfile.mkdtemp()
+    try:
+        log = AccessLog(os.path.join(d, 'access.log'), queue_size=1)
+        # Stop the writer first, so nothing drains the queue.
+        log.close()
+        log.record({'n': 1})
+        log.record({'n': 2})
+        assert_equal(log.dropped, 1)
+    finally:
+        shutil.rmtree(d)
+
+
+class ListLog(object):
+    def __init__(self):
+        self.entries = []
+
+    def record(self, entry):
+        self.entries.append(entry)
+
+
+def test_access_log_protocol():
+    access_log = ListLog()
+    factory = AccessLogFactory(Factory.forProtocol(Echo), access_log, 'echo')
+    proto = factory.buildProtocol(None)
+    transport = StringTransport()
+    proto.makeConnection(transport)
+    proto.dataReceived('GET /foo HTTP/1.1\r\nHost: x\r\n\r\n')
+    proto.connectionLost(Failure(ConnectionDone()))
+    assert_equal(len(access_log.entries), 1)
+    entry = access_log.entries[0]
+    assert_equal(entry['mode'], 'echo')
+    assert_equal(entry['request'], 'GET /foo HTTP/1.1')
+    assert_equal(entry['status'], 200)
+    assert_equal(entry['bytes_sent'], len(transport.value()))
+    assert_equal(entry['close_reason'], 'server')
+    assert_equal(entry['peer'], transport.getPeer().host)
@@ -0,0 +1,111 @@
+import logging
+import socket
+import time
+
+from nose.plugins.skip import SkipTest
+from nose.tools import assert_equal, assert_raises, assert_true
+import requests
+
+from hamms import HammsServer, asyncio_available
+from hamms.logs import QueueHandler
+
+hs = None
+ports = None
+
+
+def setup():
+    global hs, ports
+    if not asyncio_available():
+        raise SkipTest("neither asyncio nor trollius is installed")
+    hs = HammsServer(backend='asyncio')
+    ports = hs.start(beginning_port=0)
+
+
+def teardown():
+    if hs is not None:
+        hs.stop()
+
+
+def _exchange(port, request='GET / HTTP/1.1\r\n\r\n', timeout=2):
+    sock = socket.create_connection(('127.0.0.1', port), timeout)
+    data = ''
+    try:
+        sock.sendall(request)
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                return data
+            data += chunk
+    finally:
+        sock.close()
+
+
+def test_modes():
+    assert_equal(sorted(ports), [
+        'drop-random', 'empty-immediate', 'empty-on-receive', 'incomplete',
+        'listen-forever', 'malformed-immediate', 'malformed-on-receive',
+        'slow-byte', 'very-slow-byte'])
+
+
+def test_empty_and_malformed():
+    assert_equal(_exchange(ports['empty-on-receive']), '')
+    assert_equal(_exchange(ports['malformed-on-receive']), 'foo bar')
+
+
+def test_listen_forever():
+    with assert_raises(socket.timeout):
+        _exchange(ports['listen-forever'], timeout=0.2)
+
+
+def test_slow_byte():
+    started = time.time()
+    data = _exchange(ports['slow-byte'],
+                     'GET /?bytes=16&interval=0.05 HTTP/1.1\r\n\r\n')
+    assert_true(data.startswith('HTTP/1.1 204 No Content\r\n'))
+    assert_true(time.time() - started >= 0.1)
+
+
+def test_drop_random_keep_alive():
+    session = requests.Session()
+    url = 'http://127.0.0.1:{port}?failrate=0&keepalive=1'.format(
+        port=ports['drop-random'])
+    for _ in range(3):
+        r = session.get(url)
+        assert_equal(r.status_code, 200)
+        assert_equal(r.json(), {'success': True})
+
+
+def test_incomplete():
+    data = _exchange(ports['incomplete'])
+    assert_true(data.startswith('HTTP/1.1 200 OK\r\n'))
+    assert_true('Content-Length: 2085' in data)
+
+
+def test_restart():
+    """ Unlike the reactor, an asyncio server can be started again """
+    server = HammsServer(backend='asyncio')
+    server.start(beginning_port=0, modes=['empty-on-receive'])
+    server.stop()
+    port = server.start(beginning_port=0,
+                        modes=['empty-on-receive'])['empty-on-receive']
+    assert_equal(_exchange(port), '')
+    server.stop()
+
+
+def test_log_in_background():
+    root = logging.getLogger()
+    handlers = list(root.handlers)
+    server = HammsServer(backend='asyncio')
+    server.start(beginning_port=0, modes=['incomplete'],
+                 log_in_background=True)
+    try:
+        assert_true(isinstance(root.handlers[-1], QueueHandler))
+    finally:
+        server.stop()
+    assert_equal(root.handlers, handlers)
+
+
+def test_unsupported_mode():
+    with assert_raises(ValueError):
+        HammsServer(backend='asyncio').start(beginning_port=0,
+                                             modes=['status'])
@@ -0,0 +1,41 @@
+from nose.tools import assert_equal
+
+from hamms import select_modes
+from hamms.bench import (MODES, PATHS, backend_offsets, parse_args,
+                         percentile)
+
+
+def test_percentile():
+    values = range(1, 101)
+    assert_equal(percentile(values, 0.5), 50)
+    assert_equal(percentile(values, 0.99), 99)
+    assert_equal(percentile(values, 1.0), 100)
+    assert_equal(percentile([7], 0.99), 7)
+    assert_equal(percentile([], 0.5), None)
+
+
+def test_modes_cover_every_port():
+    assert_equal([offset for offset, mode, path in MODES], list(range(1, 17)) + [18, 19, 20])
+    # Every path is for a mode hamms serves.
+    assert_equal(select_modes(list(PATHS)), set(PATHS))
+
+
+def test_parse_args():
+    args = parse_args(['--modes', '8,9', '--', '--max-threads', '20'])
+    assert_equal(args.modes, [8, 9])
+    assert_equal(args.server_args, ['--', '--max-threads', '20'])
+
+
+def test_parse_startup_args():
+    args = parse_args(['--startup', '5', '--modes', '9'])
+    assert_equal(args.startup, 5)
+    assert_equal(args.modes, [9])
+
+
+
+def test_backend_offsets():
+    args = parse_args(['--backends', 'twisted,asyncio'])
+    assert_equal(args.backends, ['twisted', 'asyncio'])
+    assert_equal(backend_offsets('asyncio'), [1, 2, 3, 4, 5, 6, 7, 13, 16])
+    assert_equal(backend_offsets('asyncio', [9, 13]), [13])
+    assert_equal(backend_offsets('twisted', [9, 13]), [9, 13])
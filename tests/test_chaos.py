@@ -0,0 +1,82 @@
+from nose.tools import assert_equal, assert_raises, assert_true
+
+from hamms import _chaos_weights
+from hamms.chaos import ChaosFactory, ChaosSchedule
+
+
+def _take(schedule, count):
+    return [schedule.next() for _ in range(count)]
+
+
+def test_schedule_is_reproducible():
+    weights = {'status': 3, 'drop-random': 1, 'incomplete': 1}
+    first = ChaosSchedule(weights, seed=42, batch_size=7)
+    second = ChaosSchedule(weights, seed=42, batch_size=100)
+    assert_equal(_take(first, 50), _take(second, 50))
+    assert_true(_take(ChaosSchedule(weights, seed=43), 50) !=
+                _take(ChaosSchedule(weights, seed=42), 50))
+
+
+def test_schedule_follows_weights():
+    schedule = ChaosSchedule({'status': 3, 'incomplete': 1, 'huge': 0},
+                             seed=1)
+    _take(schedule, 4000)
+    counts = schedule.state()['counts']
+    assert_equal(counts['huge'], 0)
+    assert_true(2800 < counts['status'] < 3200)
+    assert_equal(schedule.state()['position'], 4000)
+
+
+def test_peek_and_reset():
+    schedule = ChaosSchedule({'status': 1, 'incomplete': 1}, seed=5,
+                             batch_size=4)
+    upcoming = schedule.peek(10)
+    assert_equal(_take(schedule, 10), upcoming)
+    schedule.reset()
+    assert_equal(schedule.state()['position'], 0)
+    assert_equal(_take(schedule, 10), upcoming)
+    schedule.reset(seed=6, weights={'status': 1})
+    assert_equal(_take(schedule, 3), ['status'] * 3)
+    assert_equal(schedule.state()['seed'], 6)
+
+
+def test_random_seed_is_reported():
+    schedule = ChaosSchedule({'status': 1, 'incomplete': 1})
+    upcoming = _take(schedule, 20)
+    seed = schedule.state()['seed']
+    assert_equal(_take(ChaosSchedule({'status': 1, 'incomplete': 1},
+                                     seed=seed), 20), upcoming)
+
+
+def test_bad_weights():
+    with assert_raises(ValueError):
+        ChaosSchedule({'status': -1, 'incomplete': 2})
+    with assert_raises(ValueError):
+        ChaosSchedule({'status': 0})
+    with assert_raises(ValueError):
+        _chaos_weights({'dispatch': 1})
+    with assert_raises(ValueError):
+        _chaos_weights({'nonexistent': 1})
+    assert_equal(_chaos_weights({9: 2, 'incomplete': 1}),
+                 {'status': 2, 'incomplete': 1})
+    assert_true('chaos' not in _chaos_weights())
+    assert_true('huge' not in _chaos_weights())
+    assert_true('throttle' not in _chaos_weights())
+    assert_true('status' in _chaos_weights())
+
+
+class _Factory(object):
+    def __init__(self, name):
+        self.name = name
+
+    def buildProtocol(self, addr):
+        return self.name
+
+
+def test_factory_follows_schedule():
+    weights = {'status': 1, 'incomplete': 1}
+    factory = ChaosFactory(ChaosSchedule(weights, seed=3),
+                           {'status': _Factory('status'),
+                            'incomplete': _Factory('incomplete')})
+    built = [factory.buildProtocol(None) for _ in range(20)]
+    assert_equal(built, _take(ChaosSchedule(weights, seed=3), 20))
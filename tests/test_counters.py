@@ -0,0 +1,146 @@
+import os
+import tempfile
+from threading import Thread
+
+from nose.tools import assert_equal, assert_true
+
+from hamms.counters import RetryCounterStore, SQLiteCounterStore
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_decrement():
+    store = RetryCounterStore()
+    assert_equal(store.decrement('key', 3), 2)
+    assert_equal(store.decrement('key', 3), 1)
+    assert_equal(store.decrement('other', 5), 4)
+    store.set('key', 7)
+    assert_equal(store.decrement('key', 3), 6)
+    assert_equal(store.snapshot(), {'key': 6, 'other': 4})
+
+
+def test_concurrent_decrements_are_atomic():
+    store = RetryCounterStore()
+
+    def hammer():
+        for _ in range(1000):
+            store.decrement('key', 100000)
+
+    threads = [Thread(target=hammer) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert_equal(store.snapshot(), {'key': 100000 - 8000})
+
+
+def test_max_entries_evicts_least_recently_updated():
+    store = RetryCounterStore(max_entries=2, stripes=1)
+    store.decrement('a', 3)
+    store.decrement('b', 3)
+    store.decrement('a', 3)
+    store.decrement('c', 3)
+    assert_equal(store.snapshot(), {'a': 1, 'c': 2})
+    assert_equal(store.stats()['evictions'], 1)
+
+
+def test_max_entries_is_the_bound_across_stripes():
+    store = RetryCounterStore(max_entries=5)
+    for key in 'abcde':
+        store.decrement(key, 3)
+    assert_equal(sorted(store.snapshot()), list('abcde'))
+    assert_equal(store.stats()['evictions'], 0)
+    store.decrement('f', 3)
+    store.decrement('g', 3)
+    counters = store.snapshot()
+    assert_equal(len(counters), 5)
+    assert_true('f' in counters and 'g' in counters)
+    assert_equal(store.stats()['evictions'], 2)
+    store.clear()
+    for key in 'vwxyz':
+        store.set(key, 3)
+    assert_equal(len(store.snapshot()), 5)
+
+
+def test_ttl():
+    clock = FakeClock()
+    store = RetryCounterStore(ttl=10, clock=clock)
+    store.decrement('key', 3)
+    clock.now = 5
+    assert_equal(store.decrement('key', 3), 1)
+    clock.now = 16
+    assert_equal(store.snapshot(), {})
+    assert_equal(store.decrement('key', 3), 2)
+    stats = store.stats()
+    assert_equal(stats['expirations'], 1)
+    assert_equal(stats['entries'], 1)
+
+
+def test_sqlite_store_shares_counters():
+    path = os.path.join(tempfile.mkdtemp(), 'counters.db')
+    store = SQLiteCounterStore(path)
+    other = SQLiteCounterStore(path)
+    assert_equal(store.decrement('key', 3), 2)
+    assert_equal(other.decrement('key', 3), 1)
+    other.set('key', 7)
+    assert_equal(store.decrement('key', 3), 6)
+    assert_equal(store.snapshot(), {'key': 6})
+
+
+def test_sqlite_store_limits():
+    clock = FakeClock()
+    path = os.path.join(tempfile.mkdtemp(), 'counters.db')
+    store = SQLiteCounterStore(path, max_entries=2, ttl=10, clock=clock)
+    store.decrement('a', 3)
+    clock.now = 1
+    store.decrement('b', 3)
+    clock.now = 2
+    store.decrement('c', 3)
+    assert_equal(store.snapshot(), {'b': 2, 'c': 2})
+    clock.now = 11.5
+    assert_equal(store.snapshot(), {'c': 2})
+    stats = store.stats()
+    assert_equal(stats['evictions'], 1)
+    assert_equal(stats['expirations'], 1)
+    assert_equal(stats['entries'], 1)
+
+
+def test_sqlite_store_counts_entries_across_stores():
+    path = os.path.join(tempfile.mkdtemp(), 'counters.db')
+    store = SQLiteCounterStore(path, max_entries=3)
+    other = SQLiteCounterStore(path, max_entries=3)
+    for key in 'abcde':
+        store.decrement(key, 3)
+        other.set(key, 5)
+    assert_equal(sorted(store.snapshot()), ['c', 'd', 'e'])
+    assert_equal(other.stats()['entries'], 3)
+    assert_equal(store.stats()['evictions'], 2)
+    other.clear()
+    assert_equal(store.stats()['entries'], 0)
+
+    # A database written before the count was kept gets it counted once.
+    store.set('a', 1)
+    store._connection().execute("DELETE FROM stats WHERE name = 'entries'")
+    assert_equal(SQLiteCounterStore(path).stats()['entries'], 1)
+
+
+def test_sqlite_concurrent_decrements_are_atomic():
+    path = os.path.join(tempfile.mkdtemp(), 'counters.db')
+    store = SQLiteCounterStore(path)
+
+    def hammer():
+        for _ in range(100):
+            store.decrement('key', 100000)
+
+    threads = [Thread(target=hammer) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert_equal(store.snapshot(), {'key': 100000 - 400})
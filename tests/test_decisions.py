@@ -0,0 +1,118 @@
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_equal, assert_raises, assert_true
+from twisted.internet import task
+from twisted.test.proto_helpers import StringTransport
+
+from hamms import CHAOS_PORT, DropRandomRequestsFactory, decision_source
+from hamms.chaos import ChaosFactory, ChaosSchedule
+from hamms.decisions import (RECORD, DecisionLog, DecisionReplay,
+                             read_decisions)
+
+DROP_REQUEST = 'GET /?failrate=0.5 HTTP/1.1\r\nHost: localhost\r\n\r\n'
+
+
+def setup():
+    global directory
+    directory = tempfile.mkdtemp()
+
+
+def teardown():
+    shutil.rmtree(directory)
+
+
+def _path(name):
+    return os.path.join(directory, name)
+
+
+def _drop_random(factory, count):
+    """ Whether each of ``count`` requests to ``factory`` was answered. """
+    answered = []
+    for _ in range(count):
+        proto = factory.buildProtocol(None)
+        transport = StringTransport()
+        proto.makeConnection(transport)
+        proto.dataReceived(DROP_REQUEST)
+        answered.append(int(bool(transport.value())))
+    return answered
+
+
+def test_log_round_trip():
+    clock = task.Clock()
+    log = DecisionLog(_path('round-trip.log'), batch_size=3, clock=clock)
+    picks = iter([1, 0, 0, 1, 1])
+    for port in [13, 13, 20, 13, 20]:
+        log.decide(port, lambda: next(picks))
+    # Two records are still waiting for the flush interval.
+    assert_equal(log.recorded, 3)
+    clock.advance(log.flush_interval)
+    assert_equal(log.recorded, 5)
+    log.close()
+    started, records = read_decisions(log.path)
+    assert_equal(started, log.started)
+    assert_equal([(port, sequence, decision)
+                  for port, sequence, _, decision in records],
+                 [(13, 0, 1), (13, 1, 0), (20, 0, 0), (13, 2, 1), (20, 1, 1)])
+
+
+def test_read_ignores_partial_record():
+    log = DecisionLog(_path('partial.log'), clock=task.Clock())
+    log.decide(13, lambda: 1)
+    log.close()
+    with open(log.path, 'ab') as f:
+        f.write(RECORD.pack(13, 1, 0.5, 0)[:5])
+    assert_equal(len(read_decisions(log.path)[1]), 1)
+
+    with open(_path('other.log'), 'wb') as f:
+        f.write('not a decision log')
+    assert_raises(ValueError, read_decisions, _path('other.log'))
+
+
+def test_replay_drop_random():
+    log = DecisionLog(_path('drop.log'), clock=task.Clock())
+    recorded = _drop_random(DropRandomRequestsFactory(log), 40)
+    log.close()
+    assert_true(0 < sum(recorded) < 40)
+
+    replay = DecisionReplay(log.path)
+    assert_equal(_drop_random(DropRandomRequestsFactory(replay), 40),
+                 recorded)
+    replay.reset()
+    assert_equal(_drop_random(DropRandomRequestsFactory(replay), 40),
+                 recorded)
+    # Past the end of the log, requests are dropped at random again.
+    assert_equal(len(_drop_random(DropRandomRequestsFactory(replay), 5)), 5)
+
+
+class _Factory(object):
+
+    def __init__(self, mode):
+        self.mode = mode
+
+    def buildProtocol(self, addr):
+        return self.mode
+
+
+def test_replay_chaos():
+    weights = {'status': 1, 'incomplete': 1, 'huge': 1}
+    factories = dict((mode, _Factory(mode)) for mode in weights)
+    log = DecisionLog(_path('chaos.log'), clock=task.Clock())
+    factory = ChaosFactory(ChaosSchedule(weights), factories, log)
+    built = [factory.buildProtocol(None) for _ in range(30)]
+    log.close()
+    assert_equal(set(port for port, _, _, _ in read_decisions(log.path)[1]),
+                 set([CHAOS_PORT]))
+
+    # A different seed, which the replayed decisions override.
+    factory = ChaosFactory(ChaosSchedule(weights, seed=1), factories,
+                           DecisionReplay(log.path))
+    assert_equal([factory.buildProtocol(None) for _ in range(30)], built)
+
+
+def test_decision_source():
+    assert_raises(ValueError, decision_source, _path('a.log'), _path('b.log'))
+    log = decision_source(_path('{pid}.log'), clock=task.Clock())
+    log.close()
+    assert_equal(log.path, _path('{0}.log'.format(os.getpid())))
@@ -1,4 +1,7 @@
 import errno
+import socket
+from threading import Thread
+import time
 try:
     from httplib import BadStatusLine, LineTooLong
 except ImportError:
@@ -73,13 +76,53 @@ def test_5507():
 
 def test_5508():
     with assert_raises(requests.exceptions.ReadTimeout) as cm:
-        url = 'http://127.0.0.1:{port}?sleep=0.002'.format(port=BASE_PORT+8)
-        requests.get(url, timeout=0.001)
+        url = 'http://127.0.0.1:{port}?sleep=0.5'.format(port=BASE_PORT+8)
+        requests.get(url, timeout=0.05)
 
     url = 'http://127.0.0.1:{port}?sleep=0.001'.format(port=BASE_PORT+8)
     r = requests.get(url, timeout=0.02)
     assert_equal(r.status_code, 200)
 
+    r = requests.get(url, headers={'X-Hamms-Test': 'sleepy'})
+    assert_equal(r.json()['headers']['X-Hamms-Test'], 'sleepy')
+
+    url = 'http://127.0.0.1:{port}?sleep=foo'.format(port=BASE_PORT+8)
+    r = requests.get(url)
+    assert_equal(r.status_code, 400)
+
+    for n in ['-1', 'inf', 'nan', '1e300', '3601']:
+        url = 'http://127.0.0.1:{port}?sleep={n}'.format(port=BASE_PORT+8,
+                                                         n=n)
+        r = requests.get(url, timeout=2)
+        assert_equal(r.status_code, 400)
+
+def test_5508_concurrent_sleepers():
+    # More sleepers than there are threads in the reactor's thread pool.
+    url = 'http://127.0.0.1:{port}?sleep=0.5'.format(port=BASE_PORT+8)
+    results = []
+    threads = [Thread(target=lambda: results.append(requests.get(url)))
+               for _ in range(30)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert_true(time.time() - start < 2)
+    assert_equal([r.status_code for r in results], [200] * 30)
+
+def test_5506_custom_rate():
+    url = 'http://127.0.0.1:{port}?interval=0.05&bytes=16'.format(
+        port=BASE_PORT+6)
+    r = requests.get(url, timeout=2)
+    assert_equal(r.status_code, 204)
+    assert_equal(r.headers['Server'], 'Hamms/{version}'.format(version=version))
+
+    url = 'http://127.0.0.1:{port}'.format(port=BASE_PORT+6)
+    for query in ['?bytes=abc', '?bytes=0', '?interval=nan',
+                  '?interval=-1', '?interval=inf']:
+        r = requests.get(url + query, timeout=2)
+        assert_equal(r.status_code, 400)
+
 def test_5509():
     url = 'http://127.0.0.1:{port}'.format(port=BASE_PORT+9)
     r = requests.get(url)
@@ -93,6 +136,34 @@ def test_5509():
     r = requests.get(url)
     assert_equal(r.status_code, 503)
 
+def test_5509_compatible():
+    url = 'http://127.0.0.1:{port}'.format(port=BASE_PORT+9)
+    r = requests.get(url + '?status=301', allow_redirects=False)
+    assert_equal(r.headers['Location'], '/redirect/1')
+    r = requests.get(url + '?status=401')
+    assert_equal(r.headers['WWW-Authenticate'], 'Basic realm="Fake Realm"')
+    r = requests.get(url + '?status=402')
+    assert_equal(r.text, 'Fuck you, pay me!')
+    r = requests.head(url + '?status=402')
+    assert_equal(r.headers['Content-Length'], '17')
+    assert_equal(r.content, '')
+    r = requests.get(url + '?status=abc')
+    assert_equal(r.status_code, 500)
+    assert_equal(requests.get(url + '/nope').status_code, 404)
+    assert_equal(requests.post(url).status_code, 405)
+    # Header names are cased the way Twisted writes them.
+    data = _exchange(BASE_PORT + 9, 'GET /?status=401 HTTP/1.1\r\n'
+                                    'Host: hamms\r\nConnection: close\r\n\r\n')
+    assert_true('\r\nWWW-Authenticate: ' in data)
+    assert_true('\r\nContent-Length: 0\r\n' in data)
+
+    # Kept alive, like Twisted's web ports.
+    s = requests.Session()
+    statuses = [s.get(url + '?status=' + code).status_code
+                for code in ('429', '500', '503', '200')]
+    assert_equal(statuses, [429, 500, 503, 200])
+    assert_equal(len(s.get_adapter(url).poolmanager.pools), 1)
+
 def test_5510():
     # Would need to wait 5 seconds to assert anything about this.
     url = 'http://127.0.0.1:{port}'.format(port=BASE_PORT+10)
@@ -119,6 +190,22 @@ def test_5511():
     r = requests.get(url)
     assert_equal(len(r.headers['Cookie']), 1024*63)
 
+def test_5511_many_headers():
+    url = 'http://127.0.0.1:{port}?size=10&count=3'.format(port=BASE_PORT+11)
+    r = requests.get(url, headers={'X-Hamms-Test': 'yes'})
+    assert_equal(r.headers['Cookie'], ', '.join(['a'*10] * 3))
+    assert_equal(r.json()['headers']['X-Hamms-Test'], 'yes')
+
+    # Too large to cache, so the header block is streamed.
+    url = 'http://127.0.0.1:{port}?size=20000&count=60'.format(
+        port=BASE_PORT+11)
+    r = requests.get(url)
+    assert_equal(r.headers['Cookie'], ', '.join(['a'*20000] * 60))
+
+    url = 'http://127.0.0.1:{port}?size=-1'.format(port=BASE_PORT+11)
+    r = requests.get(url)
+    assert_equal(r.status_code, 400)
+
 def test_5512():
     url = 'http://127.0.0.1:{port}?tries=foo'.format(port=BASE_PORT+12)
     r = requests.get(url)
@@ -211,6 +298,17 @@ def test_5514():
     r = requests.get(url, headers={'Accept': 'application/*;q=0.3,text/morse;q=0.5'})
     assert_equal(r.headers['content-type'], 'text/csv')
 
+def test_5514_size():
+    url = 'http://127.0.0.1:{port}?size=1000000'.format(port=BASE_PORT+14)
+    r = requests.get(url, headers={'Accept': 'application/json'})
+    assert_equal(r.headers['content-type'], 'text/morse')
+    assert_equal(len(r.content), 1000000)
+    assert_equal(set(r.content), set('.- '))
+
+    url = 'http://127.0.0.1:{port}?size=foo'.format(port=BASE_PORT+14)
+    r = requests.get(url)
+    assert_equal(r.status_code, 400)
+
 def test_5515():
     url = 'http://127.0.0.1:{port}'.format(port=BASE_PORT+15)
     r = requests.get(url, stream=True, timeout=0.005)
@@ -241,3 +339,150 @@ def teardown():
     # We can't stop the reactor in case other test files are going to run.
     # hs.stop()
     pass
+
+def test_5599_metrics():
+    requests.get('http://127.0.0.1:{port}?status=418'.format(port=BASE_PORT+9))
+    r = requests.get('http://127.0.0.1:{port}/metrics'.format(
+        port=BASE_PORT+99))
+    assert_equal(r.status_code, 200)
+    assert_true(r.headers['Content-Type'].startswith('text/plain'))
+    assert_true('hamms_requests_total{{port="{port}",mode="status",'
+                'status="418"}}'.format(port=BASE_PORT+9) in r.text)
+    assert_true('hamms_connections_total{{port="{port}",mode="status"}}'
+                .format(port=BASE_PORT+9) in r.text)
+    assert_true('hamms_pool_wait_seconds_count{pool="status"}' in r.text)
+
+def test_5599_reset():
+    url = 'http://127.0.0.1:{port}?key=reset&tries=2'.format(port=BASE_PORT+12)
+    r = requests.get(url)
+    assert_equal(r.json()['tries_remaining'], 1)
+    r = requests.post('http://127.0.0.1:{port}/reset'.format(
+        port=BASE_PORT+99))
+    assert_equal(r.status_code, 200)
+    r = requests.get(url)
+    assert_equal(r.json()['tries_remaining'], 1)
+
+def test_5517_dispatch():
+    url = 'http://127.0.0.1:{port}'.format(port=BASE_PORT+17)
+    session = requests.Session()
+    r = session.get(url + '/mode/status?status=418')
+    assert_equal(r.status_code, 418)
+    r = session.get(url + '/?sleep=0', headers={'X-Hamms-Mode': 'sleep'})
+    assert_equal(r.status_code, 200)
+    assert_equal(r.json()['headers']['X-Hamms-Mode'], 'sleep')
+    r = session.get(url + '/mode/retries/counters')
+    assert_true(r.json()['success'])
+
+    r = session.get(url + '/mode/drop-random?failrate=0')
+    assert_equal(r.json(), {'success': True})
+    with assert_raises(requests.exceptions.ReadTimeout):
+        session.get(url + '/mode/listen-forever', timeout=0.01)
+
+    r = requests.get(url + '/mode/nonexistent')
+    assert_equal(r.status_code, 404)
+    assert_true('slow-byte' in r.json()['modes'])
+
+def test_5518_throttle():
+    url = 'http://127.0.0.1:{port}'.format(port=BASE_PORT+18)
+    start = time.time()
+    r = requests.get(url + '?size=2000&rate=10000')
+    assert_equal(r.status_code, 200)
+    assert_equal(len(r.content), 2000)
+    assert_true(time.time() - start >= 0.15)
+
+    r = requests.get(url + '?rate=0')
+    assert_equal(r.status_code, 400)
+
+    for query in ['?rate=inf', '?rate=nan', '?stall=inf']:
+        r = requests.get(url + query)
+        assert_equal(r.status_code, 400)
+    # The shared timer still runs.
+    r = requests.get(url + '?size=100&rate=10000', timeout=2)
+    assert_equal(r.content, 'a' * 100)
+
+def test_5519_huge():
+    url = 'http://127.0.0.1:{port}'.format(port=BASE_PORT+19)
+    r = requests.get(url + '?size=200000')
+    assert_equal(r.status_code, 200)
+    assert_equal(r.headers['content-length'], '200000')
+    assert_equal(r.content, 'a' * 200000)
+
+    r = requests.get(url + '?size=100000&chunked=1')
+    assert_equal(r.headers['transfer-encoding'], 'chunked')
+    assert_equal(r.content, 'a' * 100000)
+
+    r = requests.get(url + '?size=inf', stream=True)
+    received = 0
+    for chunk in r.iter_content(65536):
+        received += len(chunk)
+        if received > 1024 * 1024:
+            break
+    r.close()
+    assert_true(received > 1024 * 1024)
+
+    with assert_raises(requests.exceptions.ChunkedEncodingError):
+        requests.get(url + '?size=100000&malformed_at=1000')
+
+    r = requests.get(url + '?size=-1')
+    assert_equal(r.status_code, 400)
+
+def test_5520_chaos():
+    admin = 'http://127.0.0.1:{port}'.format(port=BASE_PORT+99)
+    r = requests.post(admin + '/chaos/reset?seed=1&weights=status=1')
+    assert_equal(r.json()['position'], 0)
+    r = requests.get('http://127.0.0.1:{port}?status=418'.format(
+        port=BASE_PORT+20))
+    assert_equal(r.status_code, 418)
+    # The dispatch port strips its prefix before handing the connection on.
+    r = requests.get('http://127.0.0.1:{port}/mode/chaos?status=418'.format(
+        port=BASE_PORT+17))
+    assert_equal(r.status_code, 418)
+    r = requests.get(admin + '/chaos?next=2')
+    assert_equal(r.json()['counts'], {'status': 2})
+    assert_equal(r.json()['next'], ['status', 'status'])
+    r = requests.post(admin + '/chaos/reset?weights=huge=1')
+    assert_equal(r.status_code, 400)
+
+def _exchange(port, data, timeout=2):
+    sock = socket.create_connection(('127.0.0.1', port), timeout)
+    received = ''
+    try:
+        sock.sendall(data)
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                return received
+            received += chunk
+    finally:
+        sock.close()
+
+def test_5517_dispatch_pipelined():
+    """ Requests pipelined behind a handover reach the raw mode """
+    port = BASE_PORT + 17
+    data = _exchange(port, 'GET /mode/drop-random?failrate=0&keepalive=1 '
+                           'HTTP/1.1\r\nHost: hamms\r\n\r\n'
+                           'GET /?failrate=0 HTTP/1.1\r\nHost: hamms\r\n\r\n')
+    assert_equal(data.count('{"success": true}'), 2)
+
+    # The first request's body is passed on, and skipped, too.
+    data = _exchange(port, 'POST /mode/drop-random?failrate=0&keepalive=1 '
+                           'HTTP/1.1\r\nHost: hamms\r\nContent-Length: 5\r\n'
+                           '\r\nhello'
+                           'GET /?failrate=0 HTTP/1.1\r\nHost: hamms\r\n\r\n')
+    assert_equal(data.count('{"success": true}'), 2)
+    data = _exchange(port, 'POST /mode/drop-random?failrate=0&keepalive=1 '
+                           'HTTP/1.1\r\nHost: hamms\r\n'
+                           'Transfer-Encoding: chunked\r\n\r\n'
+                           '5\r\nhello\r\n0\r\n\r\n'
+                           'GET /?failrate=0 HTTP/1.1\r\nHost: hamms\r\n\r\n')
+    assert_equal(data.count('{"success": true}'), 2)
+
+def test_dispatch_checks_channel():
+    """ A Twisted without the HTTPChannel buffers handover uses is refused """
+    from twisted.web.http import HTTPChannel
+    from hamms.dispatch import check_channel
+    check_channel()
+    channel = HTTPChannel()
+    del channel._dataBuffer
+    with assert_raises(RuntimeError):
+        check_channel(channel)
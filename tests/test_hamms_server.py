@@ -1,19 +1,29 @@
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
 try:
     from httplib import BadStatusLine
 except ImportError:
     from http.client import BadStatusLine
 
-from nose.tools import assert_equal, assert_raises, assert_is_instance
+from nose.plugins.skip import SkipTest
+from nose.tools import (assert_equal, assert_raises, assert_is_instance,
+                        assert_true)
 import requests
 
-from hamms import HammsServer, reactor
+from hamms import HammsServer, listen, reactor, select_modes
+from hamms.accesslog import AccessLog
 
 hs = HammsServer()
 
 def test_custom_port():
     """ Should be able to specify a custom port to listen on """
     try:
-        # XXX port find_unused_port method and use it
         port=14100
         hs.start(beginning_port=port)
         r = requests.get('http://127.0.0.1:{port}'.format(port=port+9))
@@ -27,3 +37,166 @@ def test_custom_port():
         # We can't stop the reactor in case other test files are going to run.
         # hs.stop()
         pass
+
+def test_pool_stats():
+    """ Each app gets its own thread pool with saturation stats """
+    port = 14200
+    server = HammsServer()
+    server.start(beginning_port=port, min_threads=1, max_threads=3)
+    r = requests.get('http://127.0.0.1:{port}?key=pool-stats&tries=1'.format(
+        port=port+12))
+    assert_equal(r.status_code, 200)
+
+    stats = server.pool_stats()
+    assert_equal(sorted(stats.keys()), ['retries', 'status', 'toolong_content'])
+    assert_equal(stats['retries']['max_threads'], 3)
+    assert_equal(stats['retries']['completed'] + stats['retries']['busy'], 1)
+    assert_equal(stats['retries']['queued'], 0)
+    # The status port answers without the pool, which only the dispatch
+    # port uses.
+    assert_equal(stats['status']['completed'], 0)
+
+def test_overrun_size():
+    """ The Content-Length overrun port sends overrun_size body bytes """
+    port = 14300
+    server = HammsServer()
+    server.start(beginning_port=port, overrun_size=5 * 1024 * 1024 + 7)
+    sock = socket.create_connection(('127.0.0.1', port+10))
+    data = []
+    while True:
+        chunk = sock.recv(1024 * 1024)
+        if not chunk:
+            break
+        data.append(chunk)
+    sock.close()
+    headers, body = ''.join(data).split('\r\n\r\n', 1)
+    assert_true('Content-Length: 3' in headers)
+    assert_equal(len(body), 5 * 1024 * 1024 + 7)
+
+def test_reuse_port():
+    """ With reuse_port, several listeners can share the same ports """
+    port = 14400
+    listen(reactor, base_port=port, reuse_port=True)
+    listen(reactor, base_port=port, reuse_port=True)
+    r = requests.get('http://127.0.0.1:{port}'.format(port=port+9))
+    assert_equal(r.status_code, 200)
+
+
+def test_access_log():
+    """ Requests to raw and web ports show up in the access log """
+    port = 14500
+    d = tempfile.mkdtemp()
+    try:
+        access_log = AccessLog(os.path.join(d, 'access.log'))
+        listen(reactor, base_port=port, access_log=access_log)
+        requests.get('http://127.0.0.1:{port}?status=201'.format(
+            port=port+9))
+        requests.get('http://127.0.0.1:{port}'.format(port=port+5))
+        for _ in range(100):
+            if access_log.stats()['written'] >= 2:
+                break
+            time.sleep(0.01)
+        with open(access_log.path) as f:
+            entries = dict((e['mode'], e) for e in map(json.loads, f))
+        assert_equal(entries['status']['status'], 201)
+        assert_equal(entries['status']['request'],
+                     'GET /?status=201 HTTP/1.1')
+        assert_equal(entries['malformed-on-receive']['request'],
+                     'GET / HTTP/1.1')
+        assert_equal(entries['malformed-on-receive']['close_reason'], 'server')
+        assert_true(entries['malformed-on-receive']['bytes_sent'] > 0)
+    finally:
+        shutil.rmtree(d)
+
+
+def test_single_port():
+    """ With single_port, only the dispatch and admin ports listen """
+    port = 14600
+    listeners = listen(reactor, base_port=port, single_port=True)
+    assert_equal(sorted(listeners.ports), [17, 99])
+    r = requests.get('http://127.0.0.1:{port}/mode/status?status=201'.format(
+        port=port+17))
+    assert_equal(r.status_code, 201)
+
+
+def test_modes():
+    """ With modes, only those ports listen """
+    port = 14700
+    listeners = listen(reactor, base_port=port, modes=['status', 12])
+    assert_equal(sorted(listeners.ports), [9, 12])
+    r = requests.get('http://127.0.0.1:{port}?status=201'.format(port=port+9))
+    assert_equal(r.status_code, 201)
+    assert_equal(sorted(listeners.pools), ['retries'])
+    with assert_raises(requests.exceptions.ConnectionError):
+        requests.get('http://127.0.0.1:{port}'.format(port=port+8))
+
+
+def test_select_modes():
+    assert_equal(select_modes(['9', 'sleep', 99]), set(['status', 'sleep',
+                                                          'admin']))
+    assert_true('huge' in select_modes())
+    with assert_raises(ValueError):
+        select_modes(['nope'])
+
+
+def test_import_is_lazy():
+    """ Importing hamms doesn't import Flask or twisted.web """
+    code = ('import sys, hamms; '
+            'print(sorted(m for m in ("flask", "httpbin", "werkzeug", '
+            '"twisted.web") if m in sys.modules))')
+    output = subprocess.check_output([sys.executable, '-c', code])
+    assert_equal(output.strip(), '[]')
+
+
+def test_ephemeral_ports():
+    """ With beginning_port=0, every mode gets a port the OS picks """
+    server = HammsServer()
+    ports = server.start(beginning_port=0, modes=['status', 'sleep',
+                                                  'dispatch', 'admin'])
+    assert_equal(sorted(ports), ['admin', 'dispatch', 'sleep', 'status'])
+    assert_equal(ports, server.ports)
+    r = requests.get('http://127.0.0.1:{port}?status=201'.format(
+        port=ports['status']))
+    assert_equal(r.status_code, 201)
+    r = requests.get('http://127.0.0.1:{port}/mode/sleep?sleep=0'.format(
+        port=ports['dispatch']))
+    assert_equal(r.status_code, 200)
+    r = requests.get('http://127.0.0.1:{port}/metrics'.format(
+        port=ports['admin']))
+    assert_true('hamms_requests_total{{port="{port}",mode="status",'
+                'status="201"}}'.format(port=ports['status']) in r.text)
+
+    # A second server never collides with the first.
+    other = HammsServer().start(beginning_port=0, modes=['status'])
+    assert_true(other['status'] != ports['status'])
+
+
+
+def _open_sockets():
+    sockets = set()
+    for fd in os.listdir('/proc/self/fd'):
+        try:
+            target = os.readlink(os.path.join('/proc/self/fd', fd))
+        except OSError:
+            # The descriptor listdir itself had open.
+            continue
+        if target.startswith('socket:'):
+            sockets.add(target)
+    return sockets
+
+
+def test_chaos_binds_one_port():
+    """ The modes the chaos port picks from don't bind ports of their own """
+    if not os.path.isdir('/proc/self/fd'):
+        raise SkipTest("needs /proc to count sockets")
+    before = _open_sockets()
+    listeners = listen(reactor, base_port=0, modes=['chaos'])
+    try:
+        assert_equal(sorted(listeners.ports), [20])
+        assert_equal(len(_open_sockets() - before), 1)
+        # Their metrics are labelled with the port that serves them.
+        factories = listeners.ports[20].factory.wrappedFactory.factories
+        assert_equal(factories['status'].port,
+                     listeners.mode_ports()['chaos'])
+    finally:
+        listeners.ports[20].stopListening()
@@ -0,0 +1,65 @@
+from nose.tools import assert_equal, assert_true
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
+
+from hamms import DropRandomRequestsFactory, LargeHeaderFactory
+
+REQUEST = 'GET /?failrate=0&keepalive=1 HTTP/1.1\r\nHost: x\r\n\r\n'
+
+
+def _connect(factory):
+    proto = factory.buildProtocol(None)
+    proto.callLater = Clock().callLater
+    transport = StringTransport()
+    proto.makeConnection(transport)
+    return proto, transport
+
+
+def test_pipelined_requests_share_a_connection():
+    proto, transport = _connect(DropRandomRequestsFactory())
+    proto.dataReceived(REQUEST * 3)
+    assert_equal(transport.value().count('HTTP/1.1 200 OK'), 3)
+    assert_true('Content-Length: 17' in transport.value())
+    assert_true(not transport.disconnecting)
+
+
+def test_without_keepalive_the_connection_closes():
+    proto, transport = _connect(DropRandomRequestsFactory())
+    proto.dataReceived(REQUEST.replace('keepalive=1', 'keepalive=0') * 2)
+    assert_equal(transport.value().count('HTTP/1.1 200 OK'), 1)
+    assert_true(transport.disconnecting)
+
+
+def test_connection_header_needs_keep_alive_enabled():
+    request = 'GET /?failrate=0 HTTP/1.1\r\nConnection: keep-alive\r\n\r\n'
+    proto, transport = _connect(DropRandomRequestsFactory())
+    proto.dataReceived(request)
+    assert_true(transport.disconnecting)
+
+    proto, transport = _connect(DropRandomRequestsFactory(keep_alive=True))
+    proto.dataReceived(request)
+    assert_true(not transport.disconnecting)
+
+
+def test_request_cap():
+    proto, transport = _connect(DropRandomRequestsFactory(max_requests=2))
+    proto.dataReceived(REQUEST * 3)
+    assert_equal(transport.value().count('HTTP/1.1 200 OK'), 2)
+    assert_true(transport.value().endswith('{"success": true}'))
+    assert_true(transport.disconnecting)
+
+
+def test_idle_timeout():
+    clock = Clock()
+    proto = LargeHeaderFactory(idle_timeout=2).buildProtocol(None)
+    proto.callLater = clock.callLater
+    transport = StringTransport()
+    proto.makeConnection(transport)
+    proto.dataReceived('GET /?size=10&keepalive=1 HTTP/1.1\r\n\r\n')
+    assert_true('Connection: keep-alive' in transport.value())
+    clock.advance(1.5)
+    proto.dataReceived('GET /?size=10&keepalive=1 HTTP/1.1\r\n\r\n')
+    clock.advance(1.5)
+    assert_true(not transport.disconnecting)
+    clock.advance(1)
+    assert_true(transport.disconnecting)
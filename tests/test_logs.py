@@ -0,0 +1,51 @@
+import logging
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+from nose.tools import assert_equal
+
+from hamms.logs import QueueHandler, log_in_background
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.lines = []
+
+    def emit(self, record):
+        self.lines.append(self.format(record))
+
+
+def test_log_in_background():
+    log = logging.getLogger('hamms.test.background')
+    log.propagate = False
+    target = ListHandler()
+    log.addHandler(target)
+    listener = log_in_background(log)
+    log.warning('%s %s', 'hello', 'world')
+    listener.stop()
+    assert_equal(target.lines, ['hello world'])
+    assert_equal(log.handlers[0].__class__, QueueHandler)
+
+
+def test_queue_handler_drops_when_full():
+    handler = QueueHandler(Queue(1))
+    record = logging.makeLogRecord({'msg': 'hi'})
+    handler.emit(record)
+    handler.emit(record)
+    assert_equal(handler.dropped, 1)
+
+
+def test_restore():
+    log = logging.getLogger('hamms.test.restore')
+    log.propagate = False
+    target = ListHandler()
+    log.addHandler(target)
+    listener = log_in_background(log)
+    log.warning('queued')
+    listener.restore()
+    log.warning('direct')
+    assert_equal(target.lines, ['queued', 'direct'])
+    assert_equal(log.handlers, [target])
@@ -0,0 +1,49 @@
+from nose.tools import assert_equal, assert_in
+
+from hamms.metrics import Histogram, Registry
+
+
+def test_histogram_buckets():
+    h = Histogram((1, 5))
+    for value in (0.5, 1, 3, 10):
+        h.observe(value)
+    assert_equal(h.counts, [2, 1, 1])
+    assert_equal(h.count, 4)
+    assert_equal(h.sum, 14.5)
+
+
+def test_render_counter_and_gauge():
+    registry = Registry()
+    hits = registry.counter('hits_total', 'Hits.', ('port',))
+    hits.labels(5501).inc()
+    hits.labels(5501).inc(2)
+    depth = registry.gauge('depth', 'Depth.')
+    registry.add_collector(lambda: depth.labels().set(7))
+    assert_equal(registry.render(), '\n'.join([
+        '# HELP hits_total Hits.',
+        '# TYPE hits_total counter',
+        'hits_total{port="5501"} 3',
+        '# HELP depth Depth.',
+        '# TYPE depth gauge',
+        'depth 7',
+    ]) + '\n')
+
+
+def test_render_histogram():
+    registry = Registry()
+    latency = registry.histogram('latency_seconds', 'Latency.', ('mode',),
+                                 buckets=(0.1, 1))
+    latency.labels('sleep').observe(0.5)
+    latency.labels('sleep').observe(2.0)
+    text = registry.render()
+    assert_in('latency_seconds_bucket{mode="sleep",le="0.1"} 0', text)
+    assert_in('latency_seconds_bucket{mode="sleep",le="1"} 1', text)
+    assert_in('latency_seconds_bucket{mode="sleep",le="+Inf"} 2', text)
+    assert_in('latency_seconds_sum{mode="sleep"} 2.5', text)
+    assert_in('latency_seconds_count{mode="sleep"} 2', text)
+
+
+def test_label_escaping():
+    registry = Registry()
+    registry.counter('c', 'C.', ('path',)).labels('a"b\\c').inc()
+    assert_in('c{path="a\\"b\\\\c"} 1', registry.render())
@@ -0,0 +1,88 @@
+from nose.tools import assert_equal, assert_raises, assert_true
+from twisted.test.proto_helpers import StringTransport
+
+from hamms import DropRandomRequestsServer
+from hamms.parser import HeadTooLarge, RequestHead, RequestParser
+
+REQUEST = 'GET /path?failrate=0&a=1 HTTP/1.1\r\nHost: x\r\nAccept: text/plain\r\n\r\n'
+
+
+def test_parse_head():
+    head = RequestParser().feed(REQUEST)[0]
+    assert_equal(head.method, 'GET')
+    assert_equal(head.target, '/path?failrate=0&a=1')
+    assert_equal(head.path, '/path')
+    assert_equal(head.version, 'HTTP/1.1')
+    assert_equal(head.query, {'failrate': ['0'], 'a': ['1']})
+    assert_equal(head.headers, [('Host', 'x'), ('Accept', 'text/plain')])
+    assert_equal(head.header('accept'), 'text/plain')
+    assert_equal(head.header('user-agent'), '')
+    assert_equal(head.request_line, 'GET /path?failrate=0&a=1 HTTP/1.1')
+
+
+def test_fragmented():
+    parser = RequestParser()
+    for byte in REQUEST[:-1]:
+        assert_equal(parser.feed(byte), [])
+    heads = parser.feed(REQUEST[-1])
+    assert_equal(len(heads), 1)
+    assert_equal(heads[0].path, '/path')
+
+
+def test_pipelined():
+    parser = RequestParser()
+    heads = parser.feed(REQUEST + REQUEST.replace('/path', '/other') + 'GET')
+    assert_equal([h.path for h in heads], ['/path', '/other'])
+    assert_equal(parser.feed(' /third HTTP/1.1\r\n\r\n')[0].path, '/third')
+
+
+def test_skips_bodies():
+    parser = RequestParser()
+    post = 'POST /a HTTP/1.1\r\nContent-Length: 10\r\n\r\n'
+    assert_equal(len(parser.feed(post + '01234')), 1)
+    heads = parser.feed('56789' + REQUEST)
+    assert_equal([h.path for h in heads], ['/path'])
+
+
+def test_too_large():
+    parser = RequestParser(max_size=100)
+    parser.feed('GET / HTTP/1.1\r\n')
+    with assert_raises(HeadTooLarge):
+        parser.feed('Cookie: ' + 'a' * 100)
+
+
+def test_malformed_request_line():
+    head = RequestHead('garbage')
+    assert_true(not head.valid)
+    assert_equal(head.path, None)
+    assert_equal(head.query, {})
+
+
+def test_keep_alive():
+    assert_true(RequestHead('GET / HTTP/1.1').keep_alive())
+    assert_true(not RequestHead('GET / HTTP/1.1\r\nConnection: close')
+                .keep_alive())
+    assert_true(not RequestHead('GET / HTTP/1.0').keep_alive())
+    assert_true(RequestHead('GET / HTTP/1.0\r\nConnection: Keep-Alive')
+                .keep_alive())
+
+
+def _drop_random(*chunks):
+    proto = DropRandomRequestsServer()
+    transport = StringTransport()
+    proto.makeConnection(transport)
+    for chunk in chunks:
+        proto.dataReceived(chunk)
+    return transport
+
+
+def test_drop_random_fragmented():
+    transport = _drop_random(REQUEST[:10], REQUEST[10:])
+    assert_true(transport.value().startswith('HTTP/1.1 200 OK'))
+    assert_true(transport.disconnecting)
+
+
+def test_drop_random_malformed():
+    transport = _drop_random('garbage\r\n\r\n')
+    assert_equal(transport.value(), '')
+    assert_true(transport.disconnecting)
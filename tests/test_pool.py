@@ -0,0 +1,66 @@
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from nose.tools import assert_equal, assert_true
+import requests
+
+from hamms.pool import _server_argv, lease
+
+
+def test_server_argv():
+    argv = _server_argv(['--keep-alive', '--ports', 'status'], 'ports.json')
+    assert_equal(argv, ['--port', '0', '--ports-file', 'ports.json',
+                        '--keep-alive', '--ports', 'status,admin'])
+    argv = _server_argv(['--ports=retries'], 'ports.json')
+    assert_equal(argv[-1], '--ports=retries,admin')
+
+
+def _wait_for(path, timeout=10):
+    """ Wait until the pool accepts connections on ``path``. The socket
+    file is there a moment before the pool listens on it. """
+    deadline = time.time() + timeout
+    while True:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+            return
+        except socket.error:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.01)
+        finally:
+            sock.close()
+
+
+def test_lease():
+    """ A returned lease is reset before it's leased again """
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'pool.sock')
+    pool = subprocess.Popen([sys.executable, '-m', 'hamms.pool', '--size', '1',
+                             '--socket', path, '--', '--ports', 'retries'])
+    try:
+        _wait_for(path)
+
+        with lease(path) as server:
+            assert_equal(sorted(server.ports), ['admin', 'retries'])
+            url = 'http://127.0.0.1:{port}?key=pool&tries=3'.format(
+                port=server.ports['retries'])
+            assert_equal(requests.get(url).json()['tries_remaining'], 2)
+            assert_equal(requests.get(url).json()['tries_remaining'], 1)
+            first = server.ports
+
+        started = time.time()
+        with lease(path) as server:
+            assert_true(time.time() - started < 1)
+            # The only server, so the same one, with its counters reset.
+            assert_equal(server.ports, first)
+            assert_equal(requests.get(url).json()['tries_remaining'], 2)
+    finally:
+        pool.terminate()
+        pool.wait()
+        shutil.rmtree(directory)
@@ -0,0 +1,70 @@
+from nose.tools import assert_equal, assert_true
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
+
+from hamms.producers import RepeatedBytesProducer, StreamingProducer
+
+
+def test_repeated_bytes_producer():
+    transport = StringTransport()
+    done = []
+    producer = RepeatedBytesProducer(transport, 'abcd', 10, prefix='<',
+                                     suffix='>',
+                                     finished=lambda: done.append(True))
+    producer.start()
+    assert_true(transport.producer is producer)
+    # Real transports ask a pull producer for data as soon as it registers.
+    producer.resumeProducing()
+    assert_equal(transport.value(), '<')
+
+    while transport.producer is not None:
+        producer.resumeProducing()
+    assert_equal(transport.value(), '<abcdabcdab>')
+    assert_equal(done, [True])
+
+
+def test_repeated_bytes_producer_stop():
+    transport = StringTransport()
+    producer = RepeatedBytesProducer(transport, 'abcd', 10)
+    producer.start()
+    producer.resumeProducing()
+    producer.stopProducing()
+    producer.resumeProducing()
+    assert_equal(transport.value(), 'abcd')
+
+
+def test_streaming_producer():
+    transport = StringTransport()
+    clock = Clock()
+    done = []
+    producer = StreamingProducer(transport, ['a', 'b', 'c', 'd', 'e'],
+                                 finished=lambda: done.append(True), burst=2,
+                                 clock=clock)
+    producer.start()
+    assert_true(transport.producer is producer)
+    assert_true(transport.streaming)
+    # One burst, then the reactor gets a turn.
+    assert_equal(transport.value(), 'ab')
+
+    producer.pauseProducing()
+    clock.advance(0)
+    assert_equal(transport.value(), 'ab')
+
+    producer.resumeProducing()
+    assert_equal(transport.value(), 'abcd')
+    clock.advance(0)
+    assert_equal(transport.value(), 'abcde')
+    assert_true(transport.producer is None)
+    assert_equal(done, [True])
+
+
+def test_streaming_producer_stop():
+    transport = StringTransport()
+    clock = Clock()
+    producer = StreamingProducer(transport, iter(lambda: 'a', None), burst=3,
+                                 clock=clock)
+    producer.start()
+    producer.stopProducing()
+    clock.advance(0)
+    assert_equal(transport.value(), 'aaa')
+    assert_equal(clock.getDelayedCalls(), [])
@@ -0,0 +1,95 @@
+from nose.tools import assert_equal, assert_false, assert_raises, assert_true
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
+
+from hamms.throttle import ThrottleScheduler
+
+
+def test_throttle_sends_at_rate():
+    clock = Clock()
+    throttle = ThrottleScheduler(resolution=0.25, clock=clock)
+    transport = StringTransport()
+    done = []
+    throttle.add(transport, 100, 20, chunk='abcdefghij',
+                 finished=lambda: done.append(True))
+    assert_true(transport.producer is not None)
+
+    clock.advance(0.25)
+    assert_equal(transport.value(), 'abcde')
+    clock.pump([0.25] * 9)
+    assert_equal(len(transport.value()), 50)
+    assert_equal(transport.value()[:20], 'abcde' * 4)
+    clock.pump([0.25] * 10)
+    assert_equal(len(transport.value()), 100)
+    assert_equal(done, [True])
+    assert_true(transport.producer is None)
+    assert_equal(throttle.active, 0)
+    assert_equal(clock.getDelayedCalls(), [])
+
+
+def test_throttle_pauses_with_the_transport():
+    clock = Clock()
+    throttle = ThrottleScheduler(resolution=0.25, clock=clock)
+    transport = StringTransport()
+    stream = throttle.add(transport, 100, 20)
+    clock.advance(0.25)
+    stream.pauseProducing()
+    clock.pump([0.25] * 10)
+    assert_equal(len(transport.value()), 5)
+    stream.resumeProducing()
+    clock.advance(0.25)
+    # Tokens saved while paused are capped at two ticks' worth.
+    assert_equal(len(transport.value()), 15)
+
+
+def test_throttle_stalls():
+    clock = Clock()
+    throttle = ThrottleScheduler(resolution=0.25, clock=clock)
+    transport = StringTransport()
+    throttle.add(transport, 20, 400, stall_at=10, stall=1)
+    clock.advance(0.25)
+    assert_equal(len(transport.value()), 10)
+    clock.pump([0.25] * 3)
+    assert_equal(len(transport.value()), 10)
+    clock.advance(0.25)
+    assert_equal(len(transport.value()), 20)
+
+
+def test_throttle_shares_one_timer():
+    clock = Clock()
+    throttle = ThrottleScheduler(resolution=0.25, clock=clock)
+    streams = [throttle.add(StringTransport(), 10, 10) for _ in range(1000)]
+    assert_equal(len(clock.getDelayedCalls()), 1)
+    streams[0].cancel()
+    assert_equal(throttle.active, 999)
+    assert_false(streams[0] in throttle.streams)
+
+
+def test_throttle_drops_a_failing_stream():
+    clock = Clock()
+    throttle = ThrottleScheduler(resolution=0.25, clock=clock)
+    assert_raises(ValueError, throttle.add, StringTransport(), 10,
+                  float('inf'))
+    broken = StringTransport()
+    stream = throttle.add(broken, 100, 20)
+
+    def tick(now, elapsed):
+        raise OverflowError()
+    stream.tick = tick
+    transport = StringTransport()
+    throttle.add(transport, 10, 20)
+    clock.advance(0.25)
+    # The other stream carries on, and the broken one's connection closes.
+    assert_equal(transport.value(), 'aaaaa')
+    assert_true(broken.disconnecting)
+    assert_true(broken.producer is None)
+    assert_equal(throttle.active, 1)
+    clock.advance(0.25)
+    assert_equal(transport.value(), 'a' * 10)
+    assert_equal(clock.getDelayedCalls(), [])
+
+    # Cancelling the last stream once the timer has stopped is fine.
+    throttle.add(StringTransport(), 10, 20)
+    throttle._loop.stop()
+    throttle.cancel(list(throttle.streams)[0])
+    assert_true(throttle._loop is None)
@@ -0,0 +1,48 @@
+from nose.tools import assert_equal, assert_false, assert_true
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
+
+from hamms.trickle import TrickleScheduler
+
+
+def test_trickle_writes_a_chunk_per_interval():
+    clock = Clock()
+    trickle = TrickleScheduler(resolution=0.25, clock=clock)
+    transport = StringTransport()
+    trickle.add(transport, 'hello', chunk_size=2, interval=1)
+
+    clock.advance(0.75)
+    assert_equal(transport.value(), '')
+    clock.advance(0.25)
+    assert_equal(transport.value(), 'he')
+    clock.pump([1, 1])
+    assert_equal(transport.value(), 'hello')
+    assert_false(transport.disconnecting)
+
+    clock.advance(1)
+    assert_true(transport.disconnecting)
+    assert_equal(trickle.active, 0)
+    assert_equal(clock.getDelayedCalls(), [])
+
+
+def test_trickle_shares_one_timer():
+    clock = Clock()
+    trickle = TrickleScheduler(resolution=0.25, clock=clock)
+    for _ in range(100):
+        trickle.add(StringTransport(), 'hello', interval=5)
+    assert_equal(len(clock.getDelayedCalls()), 1)
+    assert_equal(trickle.active, 100)
+
+
+def test_trickle_cancel_drops_the_stream():
+    clock = Clock()
+    trickle = TrickleScheduler(resolution=0.25, clock=clock)
+    transport = StringTransport()
+    stream = trickle.add(transport, 'hello', interval=1)
+    stream.cancel()
+
+    clock.advance(2)
+    assert_equal(transport.value(), '')
+    assert_equal(trickle.active, 0)
+    assert_equal(trickle.wheel, {})
+    assert_equal(clock.getDelayedCalls(), [])
@@ -1,6 +1,8 @@
-from nose.tools import assert_equal
+from nose.tools import assert_equal, assert_true
 
-from hamms import get_header
+from hamms import (_header_block, _header_lines, _parse_log_sample,
+                   _worker_argv, get_header, parse_args,
+                   unparseable_variant)
 
 req = "\r\n".join(["GET / HTTP/1.0",
                    "User-Agent: my-user-agent",
@@ -12,3 +14,37 @@ noreq = "\r\n".join(["GET / HTTP/1.0",
 def test_user_agent():
     assert_equal("my-user-agent", get_header("user-agent", req))
     assert_equal("", get_header("user-agent", noreq))
+
+def test_get_header_only_scans_the_head():
+    data = "\r\n".join(["GET / HTTP/1.0", "ACCEPT:  text/plain ", "",
+                         "User-Agent: in-the-body"])
+    assert_equal("text/plain", get_header("Accept", data))
+    assert_equal("", get_header("user-agent", data))
+    assert_equal("partial", get_header("accept", "GET / HTTP/1.0\r\nAccept: partial"))
+
+def test_header_lines():
+    for size, count in [(0, 1), (10, 3), (70000, 2), (100, 1000)]:
+        block = ''.join(_header_lines(size, count))
+        assert_equal(block, ('Cookie: ' + 'a'*size + '\r\n') * count)
+        assert_equal(_header_block(size, count), block)
+    assert_equal(_header_block(1024*1024, 2), None)
+
+def test_unparseable_variant():
+    content_type, body = unparseable_variant('application/json')
+    assert_equal(content_type, 'text/morse')
+    assert_true(body.startswith('-...'))
+    assert_true(unparseable_variant('application/json') is
+                unparseable_variant('application/json'))
+    assert_equal(unparseable_variant('text/morse')[0], 'application/json')
+
+def test_worker_argv():
+    options = vars(parse_args(['--port', '5500', '--workers', '4',
+                               '--retries-ttl', '1.5', '--log-sample', '1=0.5',
+                               '--log-sample', '13=0.01', '--keep-alive',
+                               '--backend', 'asyncio', '--loop', 'uvloop']))
+    worker = vars(parse_args(_worker_argv(options)))
+    assert_equal(worker, dict(options, workers=1, reuse_port=True))
+
+def test_parse_log_sample():
+    assert_equal(_parse_log_sample(['1=0.5', '13=0']), {1: 0.5, 13: 0.0})
+    assert_equal(_parse_log_sample(None), {})